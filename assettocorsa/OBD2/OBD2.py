@@ -47,6 +47,15 @@ class OBD:
 	def query(self, pid):
 		return self.commands[pid]()
 
+	def queryMany(self, pids):
+		values = {}
+		for pid in pids:
+			if self.supports(pid):
+				values[pid] = self.query(pid)
+			else:
+				values[pid] = 'unsupported'
+		return values
+
 	def getRPM(self):
 		return round(ac.getCarState(0, acsys.CS.RPM), 2)
 
@@ -100,8 +109,7 @@ class EmulationServer:
 		header = str(msgLen).encode(ENCODING)
 		header += b' ' * (HEADER_SIZE - len(header))
 
-		self.clientConn.send(header)
-		self.clientConn.send(msg)
+		self.clientConn.sendall(header + msg)
 
 
 	# Listening for clients
@@ -117,6 +125,9 @@ class EmulationServer:
 
 				if msg == '!disconnect':
 					self.connected = False
+				elif msg and msg.startswith('['):
+					# Batched request containing a JSON list of PIDs
+					self.send(obd.queryMany(json.loads(msg)))
 				elif obd.supports(msg):
 					self.send(obd.query(msg))
 				else:
@@ -0,0 +1,138 @@
+"""
+Driving Data Query Benchmark
+
+Compares per-journey driving data queries before and after the
+(journey_id, time) index and journey time bounds were added, using 31 days of
+generated 1Hz driving data. Everything is run within a transaction that is
+rolled back, so the database is left unchanged.
+
+Run from the device folder with:
+    python db/benchmark.py
+"""
+import sys
+from os import path
+from statistics import median
+from time import perf_counter
+from datetime import datetime, timedelta
+from psycopg2.extras import execute_values
+
+sys.path.insert(0, path.join(
+    path.dirname(path.dirname(path.abspath(__file__))), 'device'))
+import db  # noqa: E402
+
+DAYS = 31
+JOURNEYS_PER_DAY = 2
+JOURNEY_SECS = 60 * 60
+RUNS = 5
+"""Number of times each query is run, the median time is reported"""
+
+BEFORE_QUERIES = {
+    'journey': f"""SELECT {db.DRIVING_DATA_COLUMNS} FROM driving_data
+        WHERE journey_id=%(journeyID)s""",
+    'journeys': f"""SELECT {db.DRIVING_DATA_COLUMNS} FROM driving_data
+        WHERE journey_id = ANY(%(journeyIDs)s)
+        ORDER BY journey_id, time""",
+}
+
+AFTER_QUERIES = {
+    'journey': f"""SELECT {db.DRIVING_DATA_COLUMNS} FROM driving_data
+        WHERE journey_id=%(journeyID)s
+        AND time BETWEEN %(startTime)s AND %(endTime)s""",
+    'journeys': f"""SELECT {db.DRIVING_DATA_COLUMNS} FROM driving_data
+        WHERE journey_id = ANY(%(journeyIDs)s)
+        AND time BETWEEN %(journeysStartTime)s AND %(journeysEndTime)s
+        ORDER BY journey_id, time""",
+}
+
+
+def createDrivingData():
+    """Creates journeys with driving data for every day of the dataset,
+    returning their IDs"""
+    firstDay = datetime.combine(
+        datetime.now().date() - timedelta(days=DAYS - 1), datetime.min.time())
+    journeyIDs = []
+
+    for day in range(DAYS):
+        for i in range(JOURNEYS_PER_DAY):
+            db.cur.execute("""INSERT INTO journey DEFAULT VALUES
+                RETURNING journey_id""")
+            journeyID = db.cur.fetchone()[0]
+            journeyStart = firstDay + timedelta(days=day, hours=8 + i * 9)
+            rows = [
+                (journeyStart + timedelta(seconds=secs), journeyID, True,
+                    50, 2000, 50, 10, 50.894064, -0.999009, False, 48)
+                for secs in range(JOURNEY_SECS)
+            ]
+            execute_values(db.cur, f"""INSERT INTO driving_data
+                ({db.DRIVING_DATA_COLUMNS}) VALUES %s""", rows,
+                page_size=1000)
+            db.updateJourneyTimes(rows)
+            journeyIDs.append(journeyID)
+
+    db.cur.execute('ANALYZE driving_data')
+    db.cur.execute('ANALYZE journey')
+    return journeyIDs
+
+
+def queryParams(journeyIDs):
+    """Returns the parameters of the benchmarked queries, using a journey
+    from the middle of the dataset and the journeys of the last 5 days"""
+    journeyID = journeyIDs[len(journeyIDs) // 2]
+    recentJourneyIDs = journeyIDs[-5 * JOURNEYS_PER_DAY:]
+
+    db.cur.execute("""SELECT start_time, end_time FROM journey
+        WHERE journey_id=%s""", [journeyID])
+    startTime, endTime = db.cur.fetchone()
+    db.cur.execute("""SELECT MIN(start_time), MAX(end_time) FROM journey
+        WHERE journey_id = ANY(%s)""", [recentJourneyIDs])
+    journeysStartTime, journeysEndTime = db.cur.fetchone()
+
+    return {
+        'journeyID': journeyID,
+        'startTime': startTime,
+        'endTime': endTime,
+        'journeyIDs': recentJourneyIDs,
+        'journeysStartTime': journeysStartTime,
+        'journeysEndTime': journeysEndTime,
+    }
+
+
+def timeQueries(queries, params):
+    """Returns the median time in milliseconds and number of rows of each
+    query"""
+    results = {}
+    for name, query in queries.items():
+        times = []
+        for _ in range(RUNS):
+            start = perf_counter()
+            db.cur.execute(query, params)
+            rows = db.cur.fetchall()
+            times.append((perf_counter() - start) * 1000)
+        results[name] = (median(times), len(rows))
+    return results
+
+
+def main():
+    try:
+        print(f'Creating {DAYS} days of driving data...')
+        journeyIDs = createDrivingData()
+        params = queryParams(journeyIDs)
+
+        db.cur.execute('SAVEPOINT before_index')
+        db.cur.execute('DROP INDEX IF EXISTS driving_data_journey_id_time_idx')
+        before = timeQueries(BEFORE_QUERIES, params)
+        db.cur.execute('ROLLBACK TO SAVEPOINT before_index')
+
+        after = timeQueries(AFTER_QUERIES, params)
+    finally:
+        db.conn.rollback()
+
+    print(f'{"Query":<10}{"Rows":>8}{"Before (ms)":>14}{"After (ms)":>14}')
+    for name in BEFORE_QUERIES:
+        beforeTime, rows = before[name]
+        afterTime, _ = after[name]
+        print(f'{name:<10}{rows:>8}{beforeTime:>14.2f}{afterTime:>14.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -2632,3 +2632,9 @@ INSERT INTO driving_data VALUES ((CURRENT_DATE - INTERVAL '0 days') + TIME '07:0
 INSERT INTO driving_data VALUES ((CURRENT_DATE - INTERVAL '0 days') + TIME '07:02:20.658216', 11, true, 0, 853, 84.46, 314.02728, 50.884143212666665, -1.0277806582666666, NULL, 48);
 INSERT INTO driving_data VALUES ((CURRENT_DATE - INTERVAL '0 days') + TIME '07:02:21.808932', 11, true, 0, 853, 84.46, 314.02728, 50.883776981333334, -1.0280575541333334, NULL, 48);
 INSERT INTO driving_data VALUES ((CURRENT_DATE - INTERVAL '0 days') + TIME '07:02:22.533582', 11, false, 0, 853, 84.46, 314.02728, 50.894074882, -1.003172244, NULL, 48);
+
+
+--
+-- journey start and end times
+--
+SELECT refresh_journey_times();
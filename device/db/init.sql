@@ -15,9 +15,13 @@ CREATE TABLE journey (
     api_journey_id INTEGER UNIQUE,
     passenger_cnt INTEGER NOT NULL DEFAULT 0,
     cargo_weight INTEGER NOT NULL DEFAULT 0,  -- kg
-    roof_att_id INTEGER REFERENCES roof_att(roof_att_id) DEFAULT NULL
+    roof_att_id INTEGER REFERENCES roof_att(roof_att_id) DEFAULT NULL,
+    start_time TIMESTAMP WITHOUT TIME ZONE,  -- Time of first driving data
+    end_time TIMESTAMP WITHOUT TIME ZONE     -- Time of last driving data
 );
 
+CREATE INDEX journey_start_time_idx ON journey (start_time);
+
 CREATE TABLE driving_data (
     time TIMESTAMP WITHOUT TIME ZONE NOT NULL,
     journey_id INTEGER NOT NULL REFERENCES journey(journey_id),
@@ -34,18 +38,269 @@ CREATE TABLE driving_data (
 
 SELECT create_hypertable('driving_data','time');
 SELECT add_retention_policy('driving_data', INTERVAL '31 days');
+CREATE INDEX driving_data_journey_id_time_idx
+    ON driving_data (journey_id, time DESC);
+
+-- Performance summaries of finished journeys
+CREATE TABLE journey_performance (
+    journey_id INTEGER PRIMARY KEY
+        REFERENCES journey(journey_id) ON DELETE CASCADE,
+    driving_data_cnt INTEGER NOT NULL,
+    start_time TIMESTAMP WITHOUT TIME ZONE,
+    end_time TIMESTAMP WITHOUT TIME ZONE,
+    travel_time DOUBLE PRECISION NOT NULL,  -- seconds
+    idle_time DOUBLE PRECISION NOT NULL,    -- seconds
+    distance DOUBLE PRECISION NOT NULL,     -- km
+    driv_acc_smoothness DOUBLE PRECISION,
+    driv_acc_smoothness_cnt INTEGER NOT NULL DEFAULT 0,
+    start_acc_smoothness DOUBLE PRECISION,
+    start_acc_smoothness_cnt INTEGER NOT NULL DEFAULT 0,
+    dec_smoothness DOUBLE PRECISION,
+    dec_smoothness_cnt INTEGER NOT NULL DEFAULT 0,
+    gsi_adh DOUBLE PRECISION,
+    gsi_adh_cnt INTEGER NOT NULL DEFAULT 0,
+    spd_lim_adh DOUBLE PRECISION,
+    spd_lim_adh_cnt INTEGER NOT NULL DEFAULT 0,
+    motorway_spd DOUBLE PRECISION,
+    motorway_spd_cnt INTEGER NOT NULL DEFAULT 0,
+    idle_dur DOUBLE PRECISION,
+    idle_dur_cnt INTEGER NOT NULL DEFAULT 0
+);
+
+-- Journey and score uploads waiting to be sent to the API whilst it is
+-- unreachable, with at most one journey update spooled per journey
+CREATE TABLE api_spool (
+    spool_id SERIAL PRIMARY KEY,
+    created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT NOW(),
+    kind VARCHAR(16) NOT NULL CHECK (kind IN ('journey', 'scores')),
+    journey_id INTEGER REFERENCES journey(journey_id) ON DELETE CASCADE,
+    payload JSONB NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0  -- failed replays
+);
+
+CREATE UNIQUE INDEX api_spool_journey_idx ON api_spool (journey_id)
+    WHERE kind = 'journey';
+
 
+-- CONTINUOUS AGGREGATES
+-------------------------------------------------
+-- Daily rollups of driving data, kept up to date incrementally by TimescaleDB
+-- and combined with not yet materialised rows when queried
+CREATE MATERIALIZED VIEW driving_data_daily
+WITH (timescaledb.continuous, timescaledb.materialized_only = false) AS
+    SELECT
+        time_bucket(INTERVAL '1 day', time) AS day,
+        COUNT(*) AS driving_data_cnt,
+        SUM(speed::DOUBLE PRECISION) AS speed_sum,
+        SUM(CASE WHEN speed >= 1 AND gsi_is_indicating IS NOT NULL
+            THEN 1 ELSE 0 END) AS gsi_cnt,
+        SUM(CASE WHEN speed >= 1 AND gsi_is_indicating = FALSE
+            THEN 1 ELSE 0 END) AS gsi_adh_cnt,
+        SUM(CASE WHEN speed >= 1 AND speed_limit IS NOT NULL
+            THEN 1 ELSE 0 END) AS spd_lim_cnt,
+        SUM(CASE WHEN speed >= 1 AND speed <= speed_limit
+            THEN 1 ELSE 0 END) AS spd_lim_adh_cnt,
+        SUM(CASE WHEN speed_limit = 113 THEN 1 ELSE 0 END) AS motorway_cnt,
+        SUM(CASE WHEN speed_limit = 113
+            THEN speed::DOUBLE PRECISION ELSE 0 END) AS motorway_spd_sum,
+        SUM(CASE WHEN speed < 1 AND engine_on THEN 1 ELSE 0 END) AS idle_cnt
+    FROM driving_data
+    GROUP BY day
+WITH NO DATA;
+
+CREATE MATERIALIZED VIEW journey_driving_data_daily
+WITH (timescaledb.continuous, timescaledb.materialized_only = false) AS
+    SELECT
+        journey_id,
+        time_bucket(INTERVAL '1 day', time) AS day,
+        COUNT(*) AS driving_data_cnt,
+        SUM(speed::DOUBLE PRECISION) AS speed_sum,
+        SUM(CASE WHEN speed >= 1 AND gsi_is_indicating IS NOT NULL
+            THEN 1 ELSE 0 END) AS gsi_cnt,
+        SUM(CASE WHEN speed >= 1 AND gsi_is_indicating = FALSE
+            THEN 1 ELSE 0 END) AS gsi_adh_cnt,
+        SUM(CASE WHEN speed >= 1 AND speed_limit IS NOT NULL
+            THEN 1 ELSE 0 END) AS spd_lim_cnt,
+        SUM(CASE WHEN speed >= 1 AND speed <= speed_limit
+            THEN 1 ELSE 0 END) AS spd_lim_adh_cnt,
+        SUM(CASE WHEN speed_limit = 113 THEN 1 ELSE 0 END) AS motorway_cnt,
+        SUM(CASE WHEN speed_limit = 113
+            THEN speed::DOUBLE PRECISION ELSE 0 END) AS motorway_spd_sum,
+        SUM(CASE WHEN speed < 1 AND engine_on THEN 1 ELSE 0 END) AS idle_cnt
+    FROM driving_data
+    GROUP BY journey_id, day
+WITH NO DATA;
 
--- VIEWS
+-- Refresh the last few days as chunks fill, leaving older days untouched so
+-- that they outlive the retention policy on driving_data
+SELECT add_continuous_aggregate_policy('driving_data_daily',
+    start_offset => INTERVAL '3 days',
+    end_offset => INTERVAL '1 hour',
+    schedule_interval => INTERVAL '30 minutes');
+SELECT add_continuous_aggregate_policy('journey_driving_data_daily',
+    start_offset => INTERVAL '3 days',
+    end_offset => INTERVAL '1 hour',
+    schedule_interval => INTERVAL '30 minutes');
+
+
+-- FUNCTIONS
 -------------------------------------------------
-CREATE VIEW journey_start_times AS
+-- Performance statistics of journeys calculated from their driving data, in
+-- the same form as the stored summaries in journey_performance
+CREATE FUNCTION journey_performance_stats(journey_ids INTEGER[])
+RETURNS SETOF journey_performance AS $$
+    WITH data AS (
+        SELECT
+            journey_id,
+            time,
+            engine_on,
+            -- Speeds are read by the device from their text representation
+            speed::TEXT::DOUBLE PRECISION AS speed,
+            gsi_is_indicating,
+            speed_limit
+        FROM driving_data
+        WHERE journey_id = ANY(journey_ids)
+    ),
+    steps AS (
+        SELECT
+            *,
+            speed < 1 AND engine_on AS idling,
+            COALESCE(LAG(speed < 1 AND engine_on) OVER w, FALSE)
+                AS prev_idling,
+            LAG(speed) OVER w AS prev_speed,
+            speed - LAG(speed) OVER w AS speed_diff,
+            EXTRACT(EPOCH FROM time - LAG(time) OVER w)::DOUBLE PRECISION
+                AS time_diff,
+            LEAD(time) OVER w AS next_time,
+            LEAD(engine_on) OVER w AS next_engine_on,
+            -- Performance can't be calculated without any travel time
+            MAX(time) OVER j > MIN(time) OVER j AS has_travel_time
+        FROM data
+        WINDOW
+            w AS (PARTITION BY journey_id ORDER BY time),
+            j AS (PARTITION BY journey_id)
+    ),
+    idle_islands AS (
+        SELECT
+            *,
+            SUM(CASE WHEN idling AND NOT prev_idling THEN 1 ELSE 0 END)
+                OVER w AS idle_num
+        FROM steps
+        WINDOW w AS (PARTITION BY journey_id ORDER BY time)
+    ),
+    idles AS (
+        -- An idle stops at the next entry if the engine is turned off,
+        -- otherwise at its last entry at zero speed
+        SELECT
+            journey_id,
+            EXTRACT(EPOCH FROM MAX(CASE
+                WHEN next_engine_on IS FALSE THEN next_time ELSE time
+            END) - MIN(time))::DOUBLE PRECISION AS duration
+        FROM idle_islands
+        WHERE idling AND has_travel_time
+        GROUP BY journey_id, idle_num
+    ),
+    journey_idles AS (
+        SELECT
+            journey_id,
+            SUM(duration) AS idle_time,
+            AVG(duration) AS idle_dur,
+            COUNT(*) AS idle_dur_cnt
+        FROM idles
+        WHERE duration >= 5
+        GROUP BY journey_id
+    ),
+    journey_stats AS (
+        SELECT
+            journey_id,
+            COUNT(*) FILTER (WHERE has_travel_time) AS driving_data_cnt,
+            MIN(time) AS start_time,
+            MAX(time) AS end_time,
+            EXTRACT(EPOCH FROM MAX(time) - MIN(time))::DOUBLE PRECISION
+                AS travel_time,
+            SUM(
+                prev_speed * (5 / 18.0) * time_diff +
+                0.5 * (speed_diff * (5 / 18.0) / time_diff) * time_diff ^ 2
+            ) FILTER (WHERE time_diff > 0) / 1000 AS distance,
+            AVG(speed_diff * (5 / 18.0) / time_diff) FILTER (
+                WHERE speed_diff >= 1 AND prev_speed >= 1 AND time_diff > 0
+            ) AS driv_acc_smoothness,
+            COUNT(*) FILTER (
+                WHERE speed_diff >= 1 AND prev_speed >= 1 AND time_diff > 0
+            ) AS driv_acc_smoothness_cnt,
+            AVG(speed_diff * (5 / 18.0) / time_diff) FILTER (
+                WHERE speed_diff >= 1 AND prev_speed < 1 AND time_diff > 0
+            ) AS start_acc_smoothness,
+            COUNT(*) FILTER (
+                WHERE speed_diff >= 1 AND prev_speed < 1 AND time_diff > 0
+            ) AS start_acc_smoothness_cnt,
+            AVG(speed_diff * (5 / 18.0) / time_diff) FILTER (
+                WHERE speed_diff <= -1 AND time_diff > 0
+            ) AS dec_smoothness,
+            COUNT(*) FILTER (
+                WHERE speed_diff <= -1 AND time_diff > 0
+            ) AS dec_smoothness_cnt,
+            AVG(CASE WHEN gsi_is_indicating THEN 0 ELSE 100 END) FILTER (
+                WHERE gsi_is_indicating IS NOT NULL AND speed >= 1
+                    AND has_travel_time
+            ) AS gsi_adh,
+            COUNT(*) FILTER (
+                WHERE gsi_is_indicating IS NOT NULL AND speed >= 1
+                    AND has_travel_time
+            ) AS gsi_adh_cnt,
+            AVG(CASE WHEN speed <= speed_limit THEN 100 ELSE 0 END) FILTER (
+                WHERE speed_limit IS NOT NULL AND speed >= 1
+                    AND has_travel_time
+            ) AS spd_lim_adh,
+            COUNT(*) FILTER (
+                WHERE speed_limit IS NOT NULL AND speed >= 1
+                    AND has_travel_time
+            ) AS spd_lim_adh_cnt,
+            AVG(speed) FILTER (
+                WHERE speed_limit = 113 AND has_travel_time
+            ) AS motorway_spd,
+            COUNT(*) FILTER (
+                WHERE speed_limit = 113 AND has_travel_time
+            ) AS motorway_spd_cnt
+        FROM steps
+        GROUP BY journey_id
+    )
     SELECT
-        dd.journey_id,
-        (
-            SELECT time FROM driving_data
-            WHERE journey_id=dd.journey_id
-            ORDER BY time ASC LIMIT 1
-        ) AS start_time
-    FROM driving_data dd
-    GROUP BY dd.journey_id
-    ORDER BY journey_id;
+        s.journey_id,
+        s.driving_data_cnt::INTEGER,
+        s.start_time,
+        s.end_time,
+        s.travel_time,
+        COALESCE(i.idle_time, 0)::DOUBLE PRECISION,
+        COALESCE(s.distance, 0)::DOUBLE PRECISION,
+        s.driv_acc_smoothness::DOUBLE PRECISION,
+        s.driv_acc_smoothness_cnt::INTEGER,
+        s.start_acc_smoothness::DOUBLE PRECISION,
+        s.start_acc_smoothness_cnt::INTEGER,
+        s.dec_smoothness::DOUBLE PRECISION,
+        s.dec_smoothness_cnt::INTEGER,
+        s.gsi_adh::DOUBLE PRECISION,
+        s.gsi_adh_cnt::INTEGER,
+        s.spd_lim_adh::DOUBLE PRECISION,
+        s.spd_lim_adh_cnt::INTEGER,
+        s.motorway_spd::DOUBLE PRECISION,
+        s.motorway_spd_cnt::INTEGER,
+        i.idle_dur::DOUBLE PRECISION,
+        COALESCE(i.idle_dur_cnt, 0)::INTEGER
+    FROM journey_stats s
+    LEFT JOIN journey_idles i ON i.journey_id = s.journey_id
+    ORDER BY s.journey_id;
+$$ LANGUAGE SQL STABLE;
+
+-- Sets the start and end times of journeys from their driving data, for
+-- driving data that was not written by the device
+CREATE FUNCTION refresh_journey_times() RETURNS VOID AS $$
+    UPDATE journey
+    SET start_time = times.start_time, end_time = times.end_time
+    FROM (
+        SELECT journey_id, MIN(time) AS start_time, MAX(time) AS end_time
+        FROM driving_data
+        GROUP BY journey_id
+    ) AS times
+    WHERE journey.journey_id = times.journey_id;
+$$ LANGUAGE SQL;
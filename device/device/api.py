@@ -3,14 +3,99 @@ API Interaction
 
 Provides interaction with the EcoDriven web app REST API.
 """
+import gzip
+import json
+import threading
 from config import CONFIG
 import requests
 import requests.exceptions as reqExcs
+from requests.adapters import HTTPAdapter
 from datetime import datetime
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+
+API_POOL_SIZE = int(CONFIG.get('apiPoolSize', 2))
+"""Maximum number of connections to the API each thread keeps open for
+reuse"""
+
+API_GZIP = CONFIG.get('apiGzip', 'false').lower() == 'true'
+"""Whether request bodies are compressed with gzip"""
 
 lastRequestSuccessful = True
 
 
+def createSession():
+    """Creates a session that keeps connections to the API alive between
+    requests, with the authorization header set once for every request"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=API_POOL_SIZE)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    if CONFIG.get('apiAccessToken'):
+        session.headers['Authorization'] = f'Bearer {CONFIG["apiAccessToken"]}'
+
+    return session
+
+
+sessions = threading.local()
+"""Session of each thread, as requests sessions aren't safe to share between
+threads"""
+
+
+def getSession():
+    """Returns the calling thread's session, creating it on first use"""
+    session = getattr(sessions, 'session', None)
+    if session is None:
+        session = sessions.session = createSession()
+    return session
+
+
+breaker = CircuitBreaker()
+"""Circuit breaker of requests to the API, also read by the display to show
+whether the API can be reached"""
+
+
+def apiRequest(method, path, data):
+    """Sends a JSON request to the API using the calling thread's session,
+    raising CircuitOpenError without sending it whilst the API is unreachable.
+    Server errors are counted as failures by the circuit breaker."""
+    body = json.dumps(data).encode()
+    headers = {'Content-Type': 'application/json'}
+
+    if API_GZIP:
+        body = gzip.compress(body)
+        headers['Content-Encoding'] = 'gzip'
+
+    if not breaker.allow():
+        raise CircuitOpenError('API unreachable')
+
+    try:
+        response = getSession().request(
+            method, f'{CONFIG["apiURL"]}{path}',
+            data=body,
+            headers=headers,
+            timeout=5
+        )
+    except Exception:
+        breaker.recordFailure()
+        raise
+
+    if response.status_code >= 500:
+        breaker.recordFailure()
+    else:
+        breaker.recordSuccess()
+    return response
+
+
+def isRejected(response):
+    """Returns whether the API rejected a request due to the request itself,
+    in which case it would be rejected again if retried"""
+    return (
+        400 <= response.status_code < 500 and
+        response.status_code not in (408, 429)
+    )
+
+
 def apiCall(func):
     def wrapper(*args, **kwargs):
         if CONFIG['apiURL']:
@@ -21,14 +106,11 @@ def apiCall(func):
 
 @apiCall
 def createJourney(journey):
-    """Calls POST /api/journeys to create a journey, returning it's ID"""
+    """Calls POST /api/journeys to create a journey, returning it's ID or
+    False if the API rejected it"""
     global lastRequestSuccessful
     try:
-        response = requests.post(f'{CONFIG["apiURL"]}/journeys',
-            headers={'Authorization': f'Bearer {CONFIG["apiAccessToken"]}'},
-            json=journey,
-            timeout=5
-        )
+        response = apiRequest('POST', '/journeys', journey)
 
         if response.ok:
             lastRequestSuccessful = True
@@ -40,54 +122,62 @@ def createJourney(journey):
                 f'[{datetime.now().isoformat()}] Create journey API call ' +
                 f'failed with status code {response.status_code}'
             )
-    except (reqExcs.ConnectTimeout, reqExcs.ConnectionError):
+            if isRejected(response):
+                return False
+    except (reqExcs.Timeout, reqExcs.ConnectionError):
         lastRequestSuccessful = False
         print('Create journey API call timed out')
+    except CircuitOpenError:
+        lastRequestSuccessful = False
 
 
 @apiCall
 def updateJourney(journeyID, data):
-    """Calls PUT /api/journeys/:journeyID to update a journey"""
+    """Calls PUT /api/journeys/:journeyID to update a journey, returning
+    True if it was updated or False if the API rejected it"""
     global lastRequestSuccessful
     try:
-        response = requests.put(f'{CONFIG["apiURL"]}/journeys/{journeyID}',
-            headers={'Authorization': f'Bearer {CONFIG["apiAccessToken"]}'},
-            json=data,
-            timeout=5
-        )
+        response = apiRequest('PUT', f'/journeys/{journeyID}', data)
 
         if response.ok:
             lastRequestSuccessful = True
+            return True
         else:
             lastRequestSuccessful = False
             print(
                 f'[{datetime.now().isoformat()}] Update journey API call ' +
                 f'failed with status code {response.status_code}'
             )
-    except (reqExcs.ConnectTimeout, reqExcs.ConnectionError):
+            if isRejected(response):
+                return False
+    except (reqExcs.Timeout, reqExcs.ConnectionError):
         lastRequestSuccessful = False
         print('Update journey API call timed out')
+    except CircuitOpenError:
+        lastRequestSuccessful = False
 
 
 @apiCall
 def addScores(scores):
-    """Calls POST /api/scores to add scores"""
+    """Calls POST /api/scores to add scores, returning True if they were
+    added or False if the API rejected them"""
     global lastRequestSuccessful
     try:
-        response = requests.post(f'{CONFIG["apiURL"]}/scores',
-            headers={'Authorization': f'Bearer {CONFIG["apiAccessToken"]}'},
-            json=scores,
-            timeout=5
-        )
+        response = apiRequest('POST', '/scores', scores)
 
         if response.ok:
             lastRequestSuccessful = True
+            return True
         else:
             lastRequestSuccessful = False
             print(
                 f'[{datetime.now().isoformat()}] Add scores API call ' +
                 f'failed with status code {response.status_code}'
             )
-    except (reqExcs.ConnectTimeout, reqExcs.ConnectionError):
+            if isRejected(response):
+                return False
+    except (reqExcs.Timeout, reqExcs.ConnectionError):
         lastRequestSuccessful = False
         print('Add scores API call timed out')
+    except CircuitOpenError:
+        lastRequestSuccessful = False
@@ -0,0 +1,98 @@
+"""
+Circuit Breaker
+
+Stops outbound requests from repeatedly waiting out their timeouts whilst a
+service is unreachable. Once enough consecutive requests have failed the
+circuit opens and requests fail straight away, with a single probe request
+allowed through after a backoff that doubles each time the probe fails.
+"""
+import time
+from threading import Lock
+from config import CONFIG
+
+FAILURE_THRESHOLD = int(CONFIG.get('breakerFailureThreshold', 2))
+"""Number of consecutive failures that open the circuit"""
+
+BASE_BACKOFF = float(CONFIG.get('breakerBackoff', 5))  # Seconds
+"""Time the circuit stays open before the first probe"""
+
+MAX_BACKOFF = float(CONFIG.get('breakerMaxBackoff', 300))  # Seconds
+"""Longest time the circuit stays open before a probe"""
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitOpenError(Exception):
+    """Raised when a request is not made because its circuit is open"""
+
+
+class CircuitBreaker:
+    """Tracks the failures of requests to a service, deciding whether further
+    requests should be made"""
+
+    def __init__(self, failureThreshold=FAILURE_THRESHOLD,
+            baseBackoff=BASE_BACKOFF, maxBackoff=MAX_BACKOFF):
+        self.failureThreshold = failureThreshold
+        self.baseBackoff = baseBackoff
+        self.maxBackoff = maxBackoff
+        self.state = CLOSED
+        self.failures = 0
+        """Number of consecutive failed requests"""
+        self.backoff = baseBackoff
+        """Time the circuit stays open before the next probe"""
+        self.retryTime = None
+        """Time after which a probe request is allowed whilst open"""
+        self.rejectedRequests = 0
+        """Number of requests not made because the circuit was open"""
+        self.timesOpened = 0
+        self.lock = Lock()
+
+    def allow(self):
+        """Returns whether a request should be made, allowing a single probe
+        request once the backoff has passed"""
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+
+            if self.state == OPEN and time.time() >= self.retryTime:
+                self.state = HALF_OPEN
+                return True
+
+            self.rejectedRequests += 1
+            return False
+
+    def recordSuccess(self):
+        """Closes the circuit after a request succeeds"""
+        with self.lock:
+            self.state = CLOSED
+            self.failures = 0
+            self.backoff = self.baseBackoff
+
+    def recordFailure(self):
+        """Records a failed request, opening the circuit once the failure
+        threshold is reached or when a probe request fails"""
+        with self.lock:
+            self.failures += 1
+            if self.state == HALF_OPEN:
+                self.backoff = min(self.backoff * 2, self.maxBackoff)
+            elif self.state == OPEN or self.failures < self.failureThreshold:
+                return
+
+            self.state = OPEN
+            self.retryTime = time.time() + self.backoff
+            self.timesOpened += 1
+
+    def isOpen(self):
+        """Returns whether requests are currently failing fast"""
+        return self.state != CLOSED
+
+    def stats(self):
+        """Returns the state and statistics of the circuit"""
+        return {
+            'state': self.state,
+            'failures': self.failures,
+            'rejectedRequests': self.rejectedRequests,
+            'timesOpened': self.timesOpened
+        }
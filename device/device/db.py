@@ -5,7 +5,12 @@ Provides a connection to the database and functions to retrieve and alter
 data stored in it.
 """
 import psycopg2
+from psycopg2.extras import execute_values, Json
+import math
 import time
+from functools import wraps
+from itertools import count
+from threading import RLock
 from datetime import datetime, timedelta
 from config import CONFIG
 
@@ -18,9 +23,24 @@ conn = psycopg2.connect(
 
 cur = conn.cursor()
 
+lock = RLock()
+"""Held whilst the shared connection and cursor are in use, as they are used
+by both the main loop and background workers"""
+
+
+def synchronised(func):
+    """Runs a database function whilst holding the database lock"""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with lock:
+            return func(*args, **kwargs)
+
+    return wrapper
+
 
 # Roof Attachments
 # -------------------------------------------------------------------------
+@synchronised
 def getRoofAtt(id):
     """Retrieves a roof attachment with a given id from the database"""
     cur.execute("""SELECT weight, drag_coeff, frontal_area FROM roof_att
@@ -59,6 +79,7 @@ def journeyRowToDict(row):
     }
 
 
+@synchronised
 def createJourney():
     """Creates a new journey entry in the database, returning it's data"""
     cur.execute("""INSERT INTO journey DEFAULT VALUES
@@ -68,6 +89,7 @@ def createJourney():
     return journeyRowToDict(journey)
 
 
+@synchronised
 def getJourney(id):
     """Retrieves a journey with a given id from the database"""
     cur.execute("""SELECT journey_id, passenger_cnt, cargo_weight, roof_att_id
@@ -79,6 +101,7 @@ def getJourney(id):
         return journeyRowToDict(journey)
 
 
+@synchronised
 def getJourneyIDsWithinLastNdays(ndays):
     """Retrieves the IDs of all journeys that started in the last n days"""
     now = datetime.now()
@@ -87,13 +110,41 @@ def getJourneyIDsWithinLastNdays(ndays):
     # ndaysAgo at 00:00
     ndaysAgoMidnight = datetime.combine(ndaysAgo, datetime.min.time())
 
-    cur.execute("""SELECT journey_id FROM journey_start_times
-        WHERE start_time BETWEEN %s AND %s""", [ndaysAgoMidnight, now])
+    cur.execute("""SELECT journey_id FROM journey
+        WHERE start_time BETWEEN %s AND %s
+        ORDER BY journey_id""", [ndaysAgoMidnight, now])
     conn.commit()
 
     return [journey[0] for journey in cur.fetchall()]
 
 
+@synchronised
+def updateJourneyTimes(rows):
+    """Extends the start and end times of journeys to include the given
+    driving data rows, without committing"""
+    times = {}
+    for row in rows:
+        rowTime, journeyID = row[0], row[1]
+        if journeyID in times:
+            startTime, endTime = times[journeyID]
+            times[journeyID] = (min(startTime, rowTime), max(endTime, rowTime))
+        else:
+            times[journeyID] = (rowTime, rowTime)
+
+    values = [
+        (journeyID, startTime, endTime)
+        for journeyID, (startTime, endTime) in times.items()
+    ]
+    execute_values(cur, """
+        UPDATE journey
+        SET start_time = LEAST(journey.start_time, times.start_time),
+            end_time = GREATEST(journey.end_time, times.end_time)
+        FROM (VALUES %s) AS times (journey_id, start_time, end_time)
+        WHERE journey.journey_id = times.journey_id
+        """, values)
+
+
+@synchronised
 def getCurrentJourney():
     """Retrieves the current journey based on the timestamp of the most recent
     driving data entry"""
@@ -111,6 +162,7 @@ def getCurrentJourney():
         return getJourney(mostRecentDrivingData[1])
 
 
+@synchronised
 def getJourneyApiID(journeyID):
     """Retrieves the API journey ID from a journey with a given id"""
     cur.execute(
@@ -122,6 +174,7 @@ def getJourneyApiID(journeyID):
     return journey[0]
 
 
+@synchronised
 def updateJourneyApiID(journeyID, apiJourneyID):
     """Updates the API journey ID of a journey with a given id"""
     cur.execute(
@@ -131,6 +184,95 @@ def updateJourneyApiID(journeyID, apiJourneyID):
     conn.commit()
 
 
+# Journey Performance
+# -------------------------------------------------------------------------
+JOURNEY_PERF_MEANS = [
+    ('drivAccSmoothness', 'driv_acc_smoothness'),
+    ('startAccSmoothness', 'start_acc_smoothness'),
+    ('decSmoothness', 'dec_smoothness'),
+    ('gsiAdh', 'gsi_adh'),
+    ('spdLimAdh', 'spd_lim_adh'),
+    ('motorwaySpd', 'motorway_spd'),
+    ('idleDur', 'idle_dur'),
+]
+"""Names of the means stored in a journey performance summary and their
+column prefixes in the journey_performance table"""
+
+JOURNEY_PERF_COLUMNS = ', '.join(
+    ['journey_id', 'driving_data_cnt', 'start_time', 'end_time',
+    'travel_time', 'idle_time', 'distance'] +
+    [f'{column}, {column}_cnt' for _, column in JOURNEY_PERF_MEANS]
+)
+
+
+def journeyPerformanceRowToDict(row):
+    """Converts a row from the journey performance table into a dictionary
+    with standardised keys"""
+    summary = {
+        'journeyID': row[0],
+        'drivingDataCount': row[1],
+        'startTime': row[2],
+        'endTime': row[3],
+        'travelTime': row[4],
+        'idleTime': row[5],
+        'distance': row[6],
+    }
+
+    for i, (name, _) in enumerate(JOURNEY_PERF_MEANS):
+        summary[name] = {'value': row[7 + i * 2], 'count': row[8 + i * 2]}
+
+    return summary
+
+
+@synchronised
+def getJourneyPerformances(journeyIDs):
+    """Retrieves the stored performance summaries of the given journeys,
+    keyed by journey ID"""
+    cur.execute(f"""SELECT {JOURNEY_PERF_COLUMNS} FROM journey_performance
+        WHERE journey_id = ANY(%s)""", [list(journeyIDs)])
+    conn.commit()
+    return {
+        row[0]: journeyPerformanceRowToDict(row) for row in cur.fetchall()
+    }
+
+
+@synchronised
+def calcJourneyPerformances(journeyIDs):
+    """Calculates the performance summaries of the given journeys from their
+    driving data within the database, keyed by journey ID"""
+    cur.execute(f"""SELECT {JOURNEY_PERF_COLUMNS}
+        FROM journey_performance_stats(%s)""", [list(journeyIDs)])
+    conn.commit()
+    return {
+        row[0]: journeyPerformanceRowToDict(row) for row in cur.fetchall()
+    }
+
+
+@synchronised
+def createJourneyPerformance(summary):
+    """Stores the performance summary of a journey, replacing any existing
+    summary for the journey"""
+    values = [
+        summary['journeyID'],
+        summary['drivingDataCount'],
+        summary['startTime'],
+        summary['endTime'],
+        summary['travelTime'],
+        summary['idleTime'],
+        summary['distance'],
+    ]
+    for name, _ in JOURNEY_PERF_MEANS:
+        values += [summary[name]['value'], summary[name]['count']]
+
+    columns = JOURNEY_PERF_COLUMNS.split(', ')
+    updates = ', '.join(f'{col}=EXCLUDED.{col}' for col in columns[1:])
+    placeholders = ', '.join(['%s'] * len(columns))
+    cur.execute(f"""INSERT INTO journey_performance ({JOURNEY_PERF_COLUMNS})
+        VALUES ({placeholders})
+        ON CONFLICT (journey_id) DO UPDATE SET {updates}""", values)
+    conn.commit()
+
+
 # Driving Data
 # -------------------------------------------------------------------------
 def drivingDataRowToDict(row):
@@ -151,47 +293,395 @@ def drivingDataRowToDict(row):
     }
 
 
+DRIVING_DATA_COLUMNS = """time, journey_id, engine_on, speed, rpm,
+    fuel_level, altitude, latitude, longitude, gsi_is_indicating,
+    speed_limit"""
+"""Driving data table columns in the order used by drivingDataRowToDict"""
+
+
+@synchronised
+def getJourneysTimeRange(journeyIDs):
+    """Retrieves the earliest start time and latest end time of the given
+    journeys, or None if none of them have driving data"""
+    cur.execute("""SELECT MIN(start_time), MAX(end_time) FROM journey
+        WHERE journey_id = ANY(%s)""", [list(journeyIDs)])
+    conn.commit()
+
+    startTime, endTime = cur.fetchone()
+    if startTime is not None:
+        return startTime, endTime
+
+
+@synchronised
 def getJourneyDrivingData(journeyID):
     """Retrieves all driving data from a given journey"""
-    cur.execute("""SELECT
-            time,
-            journey_id,
-            engine_on,
-            speed,
-            rpm,
-            fuel_level,
-            altitude,
-            latitude,
-            longitude,
-            gsi_is_indicating,
-            speed_limit
-        FROM driving_data WHERE journey_id=%s""",
-        [journeyID]
+    timeRange = getJourneysTimeRange([journeyID])
+    if timeRange is None:
+        return []
+
+    # Time bounds allow chunks outside of the journey to be excluded
+    cur.execute(f"""SELECT {DRIVING_DATA_COLUMNS} FROM driving_data
+        WHERE journey_id=%s AND time BETWEEN %s AND %s""",
+        [journeyID, *timeRange]
     )
     conn.commit()
     return [drivingDataRowToDict(row) for row in cur.fetchall()]
 
 
+DRIVING_DATA_ITERSIZE = 1000
+"""Number of rows fetched from the database at a time when streaming driving
+data"""
+
+streamIDs = count()
+"""Used to give each server-side cursor a unique name"""
+
+
+def streamDrivingData(query, params, itersize=DRIVING_DATA_ITERSIZE):
+    """Yields driving data entries from a query using a server-side cursor, so
+    that only itersize rows are held in memory at a time. The database lock is
+    only held whilst each batch is fetched, so other threads can use the
+    connection between batches and a stream abandoned part way never leaves
+    the lock held."""
+    # Declared WITH HOLD so the cursor remains valid when other threads
+    # commit the connection's transaction between batches
+    streamCur = conn.cursor(
+        f'driving_data_stream_{next(streamIDs)}', withhold=True)
+    try:
+        with lock:
+            streamCur.execute(query, params)
+
+        while True:
+            with lock:
+                rows = streamCur.fetchmany(itersize)
+            if not rows:
+                break
+            for row in rows:
+                yield drivingDataRowToDict(row)
+    finally:
+        with lock:
+            streamCur.close()
+            conn.commit()
+
+
+def iterJourneyDrivingData(journeyID, itersize=DRIVING_DATA_ITERSIZE):
+    """Yields all driving data from a given journey ordered by time, without
+    holding the whole journey in memory"""
+    timeRange = getJourneysTimeRange([journeyID])
+    if timeRange is None:
+        return
+
+    yield from streamDrivingData(f"""SELECT {DRIVING_DATA_COLUMNS}
+        FROM driving_data WHERE journey_id=%s AND time BETWEEN %s AND %s
+        ORDER BY time""",
+        [journeyID, *timeRange], itersize
+    )
+
+
+def getJourneysDrivingData(journeyIDs, itersize=DRIVING_DATA_ITERSIZE):
+    """Retrieves all driving data from the given journeys in a single query,
+    yielding entries ordered by journey and then by time"""
+    if not journeyIDs:
+        return
+
+    timeRange = getJourneysTimeRange(journeyIDs)
+    if timeRange is None:
+        return
+
+    yield from streamDrivingData(f"""SELECT {DRIVING_DATA_COLUMNS}
+        FROM driving_data
+        WHERE journey_id = ANY(%s) AND time BETWEEN %s AND %s
+        ORDER BY journey_id, time""",
+        [list(journeyIDs), *timeRange], itersize
+    )
+
+
+def roundSpeedLimit(speedLimit):
+    """Rounds a speed limit to the whole km/h stored in the speed_limit column,
+    rounding halves away from zero as the database does"""
+    if speedLimit is None:
+        return None
+    return int(math.floor(speedLimit + 0.5))
+
+
+def drivingDataToRow(data):
+    """Converts driving data from the main loop into a row for the driving
+    data table, rounding the speed limit so that rows used by the current
+    journey's performance match those stored"""
+    return (
+        datetime.fromtimestamp(data['obdData']['time']),
+        data['journeyID'],
+        data['engineOn'],
+        data['obdData']['speed'],
+        data['obdData']['rpm'],
+        data['obdData']['fuelLevel'],
+        data['obdData']['alt'],
+        data['coords']['latitude'],
+        data['coords']['longitude'],
+        data['gsiIsIndicating'],
+        roundSpeedLimit(data['speedLimit'])
+    )
+
+
+@synchronised
 def createDrivingData(data):
     """Creates a new driving data entry in the database"""
+    row = drivingDataToRow(data)
     cur.execute("""
         INSERT INTO driving_data (time, journey_id, engine_on, speed, rpm,
             fuel_level, altitude, latitude, longitude, gsi_is_indicating,
             speed_limit)
             VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        """,
-        (
-            datetime.fromtimestamp(data['obdData']['time']),
-            data['journeyID'],
-            data['engineOn'],
-            data['obdData']['speed'],
-            data['obdData']['rpm'],
-            data['obdData']['fuelLevel'],
-            data['obdData']['alt'],
-            data['coords']['latitude'],
-            data['coords']['longitude'],
-            data['gsiIsIndicating'],
-            data['speedLimit']
-        )
-    )
+        """, row)
+    updateJourneyTimes([row])
+    conn.commit()
+
+
+# Driving Data Buffer
+# -------------------------------------------------------------------------
+DRIVING_DATA_FLUSH_ROWS = 30
+"""Number of buffered driving data entries at which they are written to the
+database"""
+
+DRIVING_DATA_FLUSH_INTVL = 30  # Seconds
+"""Maximum time a driving data entry is buffered before being written to the
+database"""
+
+
+class DrivingDataBuffer:
+    """Buffers driving data entries, writing them to the database in bulk
+    with a single multi-row insert and commit"""
+
+    def __init__(self, maxRows=DRIVING_DATA_FLUSH_ROWS,
+            maxAge=DRIVING_DATA_FLUSH_INTVL):
+        self.maxRows = maxRows
+        self.maxAge = maxAge
+        self.rows = []
+        """Buffered driving data rows waiting to be written"""
+        self.bufferStart = None
+        """Monotonic time at which the oldest buffered row was added"""
+        self.flushCount = 0
+        """Number of flushes that have written rows to the database"""
+        self.flushedRows = 0
+        """Total number of rows written to the database"""
+        self.lastFlushRows = 0
+        """Number of rows written by the last flush"""
+        self.lastFlushLatency = 0
+        """Seconds taken by the last flush"""
+        self.maxFlushLatency = 0
+        """Longest time in seconds taken by a flush"""
+        self.totalFlushLatency = 0
+        """Total seconds taken by all flushes"""
+        self.deferredFlushes = 0
+        """Number of flushes put off because the database was in use"""
+
+    def add(self, data):
+        """Adds a driving data entry to the buffer, flushing the buffer if it
+        has reached its size or time threshold. The flush is put off until
+        the next entry if the database is in use by another thread."""
+        if not self.rows:
+            self.bufferStart = time.monotonic()
+        self.rows.append(drivingDataToRow(data))
+
+        if (
+            len(self.rows) >= self.maxRows or
+            time.monotonic() - self.bufferStart >= self.maxAge
+        ):
+            self.flush(block=False)
+
+    def flush(self, block=True):
+        """Writes all buffered driving data entries to the database, waiting
+        for the database to be free unless block is False"""
+        if not self.rows:
+            return
+
+        if not lock.acquire(blocking=block):
+            self.deferredFlushes += 1
+            return
+
+        try:
+            start = time.perf_counter()
+            execute_values(cur, """
+                INSERT INTO driving_data (time, journey_id, engine_on, speed,
+                    rpm, fuel_level, altitude, latitude, longitude,
+                    gsi_is_indicating, speed_limit)
+                    VALUES %s
+                """, self.rows, page_size=len(self.rows))
+            updateJourneyTimes(self.rows)
+            conn.commit()
+            latency = time.perf_counter() - start
+        finally:
+            lock.release()
+
+        self.flushCount += 1
+        self.flushedRows += len(self.rows)
+        self.lastFlushRows = len(self.rows)
+        self.lastFlushLatency = latency
+        self.maxFlushLatency = max(self.maxFlushLatency, latency)
+        self.totalFlushLatency += latency
+        self.rows = []
+        self.bufferStart = None
+
+    def stats(self):
+        """Returns the flush statistics of the buffer"""
+        if self.flushCount > 0:
+            meanRows = self.flushedRows / self.flushCount
+            meanLatency = self.totalFlushLatency / self.flushCount
+        else:
+            meanRows = 0
+            meanLatency = 0
+
+        return {
+            'flushes': self.flushCount,
+            'rows': self.flushedRows,
+            'bufferedRows': len(self.rows),
+            'lastFlushRows': self.lastFlushRows,
+            'meanRowsPerFlush': meanRows,
+            'lastFlushLatency': self.lastFlushLatency,
+            'meanFlushLatency': meanLatency,
+            'maxFlushLatency': self.maxFlushLatency,
+            'deferredFlushes': self.deferredFlushes
+        }
+
+
+# Daily Driving Data Rollups
+# -------------------------------------------------------------------------
+DRIVING_DATA_ROLLUP_COLUMNS = """driving_data_cnt, speed_sum, gsi_cnt,
+    gsi_adh_cnt, spd_lim_cnt, spd_lim_adh_cnt, motorway_cnt,
+    motorway_spd_sum, idle_cnt"""
+
+
+def drivingDataRollupRowToDict(row):
+    """Converts the rollup columns of a continuous aggregate row into a
+    dictionary with standardised keys"""
+    return {
+        'drivingDataCount': row[0],
+        'speedSum': row[1],
+        'gsiCount': row[2],
+        'gsiAdhCount': row[3],
+        'spdLimCount': row[4],
+        'spdLimAdhCount': row[5],
+        'motorwayCount': row[6],
+        'motorwaySpdSum': row[7],
+        'idleCount': row[8]
+    }
+
+
+@synchronised
+def getDailyDrivingData(ndays):
+    """Retrieves the daily driving data rollups of the last n days, ordered
+    by day"""
+    ndaysAgo = datetime.now() - timedelta(days=ndays)
+    ndaysAgoMidnight = datetime.combine(ndaysAgo, datetime.min.time())
+
+    cur.execute(f"""SELECT day, {DRIVING_DATA_ROLLUP_COLUMNS}
+        FROM driving_data_daily WHERE day >= %s
+        ORDER BY day""", [ndaysAgoMidnight])
+    conn.commit()
+
+    rollups = []
+    for row in cur.fetchall():
+        rollup = drivingDataRollupRowToDict(row[1:])
+        rollup['day'] = row[0]
+        rollups.append(rollup)
+    return rollups
+
+
+@synchronised
+def getJourneysDailyDrivingData(journeyIDs):
+    """Retrieves the daily driving data rollups of the given journeys,
+    ordered by journey ID and day"""
+    cur.execute(f"""SELECT journey_id, day, {DRIVING_DATA_ROLLUP_COLUMNS}
+        FROM journey_driving_data_daily WHERE journey_id = ANY(%s)
+        ORDER BY journey_id, day""", [list(journeyIDs)])
+    conn.commit()
+
+    rollups = []
+    for row in cur.fetchall():
+        rollup = drivingDataRollupRowToDict(row[2:])
+        rollup['journeyID'] = row[0]
+        rollup['day'] = row[1]
+        rollups.append(rollup)
+    return rollups
+
+
+# API Spool
+# -------------------------------------------------------------------------
+def spoolRowToDict(row):
+    """Converts an api_spool row into a dictionary with standardised keys"""
+    return {
+        'id': row[0],
+        'kind': row[1],
+        'journeyID': row[2],
+        'payload': row[3],
+        'attempts': row[4]
+    }
+
+
+@synchronised
+def spoolJourney(journeyID, data):
+    """Spools a journey update to be sent to the API, replacing any update
+    already spooled for the journey"""
+    cur.execute("""INSERT INTO api_spool (kind, journey_id, payload)
+        VALUES ('journey', %s, %s)
+        ON CONFLICT (journey_id) WHERE kind = 'journey'
+        DO UPDATE SET payload=EXCLUDED.payload, created_at=NOW(),
+            attempts=0""",
+        [journeyID, Json(data)])
+    conn.commit()
+
+
+@synchronised
+def spoolScores(scores, maxScores=None):
+    """Spools scores to be sent to the API, deleting the oldest spooled scores
+    beyond the max if one is given"""
+    cur.execute("""INSERT INTO api_spool (kind, payload)
+        VALUES ('scores', %s)""", [Json(scores)])
+    if maxScores is not None:
+        cur.execute("""DELETE FROM api_spool WHERE kind = 'scores'
+            AND spool_id NOT IN (
+                SELECT spool_id FROM api_spool WHERE kind = 'scores'
+                ORDER BY spool_id DESC LIMIT %s
+            )""", [maxScores])
+    conn.commit()
+
+
+@synchronised
+def getSpooled(limit):
+    """Retrieves up to a limit of spooled uploads, oldest first"""
+    cur.execute("""SELECT spool_id, kind, journey_id, payload, attempts
+        FROM api_spool ORDER BY spool_id LIMIT %s""", [limit])
+    conn.commit()
+    return [spoolRowToDict(row) for row in cur.fetchall()]
+
+
+@synchronised
+def getSpooledCount():
+    """Retrieves the number of spooled uploads"""
+    cur.execute('SELECT COUNT(*) FROM api_spool')
+    conn.commit()
+    return cur.fetchone()[0]
+
+
+@synchronised
+def recordSpoolAttempt(spoolID):
+    """Counts a failed attempt to replay a spooled upload"""
+    cur.execute("""UPDATE api_spool SET attempts = attempts + 1
+        WHERE spool_id=%s""", [spoolID])
+    conn.commit()
+
+
+@synchronised
+def deleteSpooled(spoolIDs):
+    """Deletes sent uploads from the spool"""
+    cur.execute('DELETE FROM api_spool WHERE spool_id = ANY(%s)',
+        [list(spoolIDs)])
+    conn.commit()
+
+
+@synchronised
+def deleteSpooledJourney(journeyID):
+    """Deletes the update spooled for a journey, used once a newer update has
+    been sent"""
+    cur.execute("""DELETE FROM api_spool
+        WHERE kind = 'journey' AND journey_id=%s""", [journeyID])
     conn.commit()
@@ -8,6 +8,7 @@ import busio
 from digitalio import DigitalInOut, Direction, Pull
 from PIL import Image, ImageDraw
 import adafruit_ssd1306
+import time
 from threading import Thread
 from pathlib import Path
 import api
@@ -34,6 +35,9 @@ class Display:
         self.activeUI = 'eco-driving'
         self.gsi = gsi
         self.accumulatedFeedback = accFdbck
+        self.frames = 0
+        """Number of frames drawn"""
+        self.startTime = time.monotonic()
 
         self.initButtons()
         self.initDisplay()
@@ -109,6 +113,13 @@ class Display:
     def stop(self):
         self.on = False
 
+    def stats(self):
+        """Returns the number of frames drawn and the mean frame rate"""
+        return {
+            'frames': self.frames,
+            'fps': self.frames / (time.monotonic() - self.startTime)
+        }
+
     def draw(self):
         """Draw loop for the entire display"""
         while self.on:
@@ -120,10 +131,11 @@ class Display:
                 self.gsi.draw(self.imgDraw)
                 self.accumulatedFeedback.draw(self)
 
-                if not api.lastRequestSuccessful:
+                if not api.lastRequestSuccessful or api.breaker.isOpen():
                     self.imgDraw.bitmap((4, 4), self.imgs['wifiOff'], fill=1)
 
             self.display.image(self.image)
             self.display.show()
+            self.frames += 1
 
         self.clear()
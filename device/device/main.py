@@ -8,16 +8,25 @@ References
    http://psas.pdx.edu/RocketScience/PressureAltitude_Derived.pdf.
 """
 import time
-import requests
+import api
 import db
 from obd_ii import OBDConnect, obd
 from gsi import GSI
 from gps import getGPSCoords
-from performance import AccumulatedFeedback
+from performance import (
+    AccumulatedFeedback, FeedbackWindow, FeedbackWorker, JourneyPerformance,
+    loadFeedbackSnapshot, saveFeedbackSnapshot
+)
 from display import Display
-from config import CONFIG
+from scheduler import Scheduler
+import speed_limit
+from speed_limit import (
+    SpeedLimitCache, SpeedLimitThrottle, createSpeedLimitFetcher
+)
+from spool import SpoolFlusher
 from settings import SETTINGS
 
+ACQUISITION_INTVL = 0.1  # Seconds
 DRIVING_DATA_INTVL = 1  # Second
 SPD_LIM_FETCH_INTVL = 3  # Seconds
 ACC_FEEDBACK_INTVL = 60  # Seconds
@@ -25,124 +34,214 @@ ACC_FEEDBACK_INTVL = 60  # Seconds
 
 # Retrieving Data
 # -------------------------------------------------------------------------
-def getOBDData(obdConn):
-    """Retrieves required OBD data"""
-    pressure = obdConn.query(obd.commands.BAROMETRIC_PRESSURE).value
-    return {
-        'rpm': obdConn.query(obd.commands.RPM).value,
-        'speed': obdConn.query(obd.commands.SPEED).value,  # kph
-        'throttle': obdConn.query(obd.commands.THROTTLE_POS).value,  # percent
-        'fuelLevel': obdConn.query(obd.commands.FUEL_LEVEL).value,  # percent
-        'alt': 44330.8 - (4946.54 * (pressure ** 0.1902632)),  # metres [1]
-    }
-
+OBD_COMMANDS = [
+    obd.commands.RPM,
+    obd.commands.SPEED,
+    obd.commands.THROTTLE_POS,
+    obd.commands.FUEL_LEVEL,
+    obd.commands.BAROMETRIC_PRESSURE
+]
+"""OBD commands queried on each acquisition"""
 
-def getMostConfidentRoute(matchings):
-    """Retrieves the route with the highest confidence for matchings received
-    from Mapbox"""
-    highestConfidence = 0
-    route = None
 
-    for match in matchings:
-        if match['confidence'] > highestConfidence:
-            highestConfidence = match['confidence']
-            route = match
+def getOBDData(obdConn):
+    """Retrieves required OBD data in a single batched query"""
+    return obdResponsesToData(obdConn.query_many(OBD_COMMANDS))
 
-    return route
 
+def obdResponsesToData(responses):
+    """Converts the responses of the OBD commands into OBD data"""
+    rpm, speed, throttle, fuelLevel, pressure = [
+        response.value for response in responses
+    ]
+    return {
+        'rpm': rpm,
+        'speed': speed,  # kph
+        'throttle': throttle,  # percent
+        'fuelLevel': fuelLevel,  # percent
+        'alt': 44330.8 - (4946.54 * (pressure ** 0.1902632)),  # metres [1]
+    }
 
-def getSpeedLimit(coords, prevCoords):
-    """Retrieves the speed limit for the route of the given coordinates using
-    Mapbox's map matching API"""
-    currCoordsStr = f'{coords["longitude"]},{coords["latitude"]}'
-    prevCoordsStr = f'{prevCoords["longitude"]},{prevCoords["latitude"]}'
-    coordsStr = f'{currCoordsStr};{prevCoordsStr}'
 
-    try:
-        response = requests.get(
-            f'https://api.mapbox.com/matching/v5/mapbox/driving/{coordsStr}', {
-                'annotations': 'maxspeed',
-                'overview': 'full',
-                'access_token': CONFIG['mapboxAccessToken']
-            },
-            timeout=5
-        )
-
-        if response.ok:
-            data = response.json()
-            if data['code'] == "Ok":
-                route = getMostConfidentRoute(data['matchings'])
-                maxSpd = route['legs'][0]['annotation']['maxspeed']
-                speedLimit = maxSpd[0]
-
-                if speedLimit['unit'] == 'km/h':
-                    return speedLimit['speed']
-                elif speedLimit['unit'] == 'mph':
-                    return speedLimit['speed'] * 1.609344
-    except Exception:
-        pass
+# Device
+# -------------------------------------------------------------------------
+class Device:
+    """Device state shared between the jobs run by the main loop"""
+
+    def __init__(self, obdConn, journey):
+        self.obdConn = obdConn
+        self.journey = journey
+        self.gsi = GSI(SETTINGS, journey)
+        self.journeyPerf = JourneyPerformance(journey['id'])
+        self.feedbackWindow = FeedbackWindow()
+
+        # Show the last saved feedback straight away, it is then recalculated
+        # in the background once the device has started
+        snapshot = loadFeedbackSnapshot()
+        if snapshot:
+            accFeedback = AccumulatedFeedback(snapshot=snapshot)
+        else:
+            accFeedback = AccumulatedFeedback(
+                journey, self.journeyPerf, self.feedbackWindow)
+            saveFeedbackSnapshot(accFeedback)
+        self.display = Display(self.gsi, accFeedback)
+        self.obdData = None
+        self.prevOBDData = None
+        self.coords = None
+        self.prevCoords = None
+        self.spdLimCache = SpeedLimitCache()
+        self.spdLimCache.load()
+        self.spdLimFetcher = createSpeedLimitFetcher(self.spdLimCache)
+        self.spdLimThrottle = SpeedLimitThrottle()
+        self.drivingDataBuffer = db.DrivingDataBuffer()
+        self.feedbackWorker = FeedbackWorker(
+            journey, self.publishAccumulatedFeedback, self.feedbackWindow)
+        if snapshot:
+            self.feedbackWorker.request(self.journeyPerf)
+        self.spoolFlusher = SpoolFlusher()
+
+    # Jobs
+    # --------------------------------------------------------------------
+    def acquire(self):
+        """Retrieves the latest OBD data and GPS coordinates and updates the
+        GSI"""
+        self.updateAcquired(getOBDData(self.obdConn), getGPSCoords())
+
+    def updateAcquired(self, obdData, coords):
+        """Replaces the current OBD data and GPS coordinates with newly
+        acquired values and updates the GSI"""
+        self.updateCoords(coords)
+        self.updateOBDData(obdData)
+
+    def updateCoords(self, coords):
+        """Replaces the current GPS coordinates, tracking them for speed
+        limits"""
+        self.prevCoords = self.coords
+        self.coords = coords
+        if coords:
+            self.spdLimFetcher.track(coords)
+
+    def updateOBDData(self, obdData):
+        """Replaces the current OBD data and updates the GSI"""
+        self.prevOBDData = self.obdData
+        self.obdData = obdData
+        self.obdData['time'] = time.time()
+
+        if self.prevOBDData:
+            self.gsi.update(self.obdData, self.prevOBDData)
+
+    def fetchSpeedLimit(self):
+        """Requests the speed limit for the current coordinates, which is
+        fetched in the background, once the vehicle has moved or turned enough
+        for the speed limit to have changed"""
+        if self.prevCoords and self.spdLimThrottle.shouldLookup(self.coords):
+            self.spdLimFetcher.request(self.coords, self.prevCoords)
+
+    def addDrivingData(self, data):
+        """Buffers a driving data entry to be stored in the database and adds
+        it to the current journey's performance"""
+        self.storeDrivingData(data)
+        self.addJourneyPerformance(data)
+
+    def storeDrivingData(self, data):
+        """Buffers a driving data entry to be stored in the database"""
+        self.drivingDataBuffer.add(data)
+
+    def addJourneyPerformance(self, data):
+        """Adds a driving data entry to the current journey's performance,
+        converted to the values it would be retrieved with once stored"""
+        self.journeyPerf.addDrivingData(
+            db.drivingDataRowToDict(db.drivingDataToRow(data)))
+
+    def drivingDataEntry(self):
+        """Returns a driving data entry of the latest acquired data"""
+        return {
+            'obdData': self.obdData,
+            'journeyID': self.journey['id'],
+            'engineOn': True,
+            'coords': self.coords,
+            'gsiIsIndicating': self.gsi.isIndicating,
+            'speedLimit': self.spdLimFetcher.speedLimit
+        }
+
+    def writeDrivingData(self):
+        """Stores the latest driving data"""
+        self.addDrivingData(self.drivingDataEntry())
+
+    def updAccumulatedFeedback(self):
+        """Requests the accumulated feedback shown on the display to be
+        recalculated in the background"""
+        self.feedbackWorker.request(self.journeyPerf)
+
+    def publishAccumulatedFeedback(self, accFeedback):
+        """Replaces the accumulated feedback shown on the display, called by
+        the feedback worker once a recalculation is complete"""
+        self.display.accumulatedFeedback = accFeedback
+        saveFeedbackSnapshot(accFeedback)
+
+    # Shutdown
+    # --------------------------------------------------------------------
+    def stop(self):
+        """Stops the display and stores the final driving data entry along with
+        any buffered driving data"""
+        try:
+            self.display.stop()
+            self.spdLimFetcher.stop()
+            self.feedbackWorker.stop()
+            self.spoolFlusher.stop()
+            self.addDrivingData({
+                'obdData': self.obdData,
+                'journeyID': self.journey['id'],
+                'engineOn': False,
+                'coords': self.coords,
+                'gsiIsIndicating': None,
+                'speedLimit': self.spdLimFetcher.speedLimit
+            })
+        finally:
+            self.drivingDataBuffer.flush()
+            self.spdLimCache.save()
+        # Send latest data to API once any recalculation in progress has
+        # finished using the feedback window
+        self.feedbackWorker.thread.join()
+        saveFeedbackSnapshot(AccumulatedFeedback(
+            self.journey, self.journeyPerf, self.feedbackWindow))
+
+    def stats(self):
+        """Returns the statistics of the device's components"""
+        return {
+            'drivingDataBuffer': self.drivingDataBuffer.stats(),
+            'feedbackWorker': self.feedbackWorker.stats(),
+            'spoolFlusher': self.spoolFlusher.stats(),
+            'apiBreaker': api.breaker.stats(),
+            'mapboxBreaker': speed_limit.breaker.stats(),
+            'speedLimitCache': self.spdLimCache.stats(),
+            'speedLimitFetcher': self.spdLimFetcher.stats(),
+            'speedLimitThrottle': self.spdLimThrottle.stats()
+        }
 
 
 # Main Loop
 # -------------------------------------------------------------------------
 if __name__ == '__main__':
     obdConn = OBDConnect()
-    journey = db.getCurrentJourney()
-    gsi = GSI(SETTINGS, journey)
-    display = Display(gsi, AccumulatedFeedback(journey))
-    prevOBDData = None
-    prevCoords = None
-    prevSpdLim = None
-    prevSpdLimFetchTs = time.time() - SPD_LIM_FETCH_INTVL
-    prevDrivingDataEntryTs = time.time() - DRIVING_DATA_INTVL
-    prevAccFeedbackUpd = time.time()
+    device = Device(obdConn, db.getCurrentJourney())
+    scheduler = Scheduler()
+    # Jobs due at the same time run in the order they are added
+    scheduler.add('acquisition', device.acquire, ACQUISITION_INTVL)
+    scheduler.add('speedLimit', device.fetchSpeedLimit, SPD_LIM_FETCH_INTVL)
+    scheduler.add('drivingData', device.writeDrivingData, DRIVING_DATA_INTVL)
+    scheduler.add('accumulatedFeedback', device.updAccumulatedFeedback,
+        ACC_FEEDBACK_INTVL, delay=ACC_FEEDBACK_INTVL)
 
     try:
-        while obdConn.is_connected:
-            ts = time.time()
-            obdData = getOBDData(obdConn)
-            obdData['time'] = ts
-            coords = getGPSCoords()
-
-            if prevOBDData:
-                gsi.update(obdData, prevOBDData)
-
-            if prevCoords and ts - prevSpdLimFetchTs >= SPD_LIM_FETCH_INTVL:
-                speedLimit = getSpeedLimit(coords, prevCoords)
-                prevSpdLim = speedLimit
-                prevSpdLimFetchTs = ts
-            else:
-                speedLimit = prevSpdLim
-
-            if ts - prevDrivingDataEntryTs >= DRIVING_DATA_INTVL:
-                db.createDrivingData({
-                    'obdData': obdData,
-                    'journeyID': journey['id'],
-                    'engineOn': True,
-                    'coords': coords,
-                    'gsiIsIndicating': gsi.isIndicating,
-                    'speedLimit': speedLimit
-                })
-                prevDrivingDataEntryTs = ts
-
-            if ts - prevAccFeedbackUpd >= ACC_FEEDBACK_INTVL:
-                display.accumulatedFeedback = AccumulatedFeedback(journey)
-                prevAccFeedbackUpd = ts
-
-            prevOBDData = obdData
-            prevCoords = coords
+        scheduler.run(lambda: obdConn.is_connected)
     except BrokenPipeError:
         print('OBD-II Disconnected')
     finally:
         print('Exiting...')
-        display.stop()
-        db.createDrivingData({
-            'obdData': prevOBDData,
-            'journeyID': journey['id'],
-            'engineOn': False,
-            'coords': prevCoords,
-            'gsiIsIndicating': None,
-            'speedLimit': prevSpdLim
-        })
-        AccumulatedFeedback(journey)  # Send latest data to API
+        for name, stats in scheduler.stats().items():
+            print(f'{name}: {stats}')
+        device.stop()
+        for name, stats in device.stats().items():
+            print(f'{name}: {stats}')
         db.conn.close()
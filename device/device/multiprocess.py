@@ -0,0 +1,342 @@
+"""
+Multi-process Device Runtime
+
+Runs the device as separate processes so that persistence, the display and
+feedback analytics don't compete with acquisition for the GIL. The acquisition
+process polls OBD-II and GPS data, updates the GSI and writes every sample to a
+shared memory ring buffer, which the other processes read from at their own
+rate:
+
+- Persistence stores driving data samples in the database
+- Analytics tracks the current journey's performance, recalculates
+  accumulated feedback and replays spooled API uploads
+- Display draws the GSI and accumulated feedback from the latest sample
+
+Run from the device folder with:
+    python device/multiprocess.py
+"""
+import math
+import time
+import signal
+import multiprocessing
+import api
+import db
+from obd_ii import OBDConnect
+from gsi import GSI
+from gps import getGPSCoords
+from performance import (
+    AccumulatedFeedback, FeedbackWindow, FeedbackWorker, JourneyPerformance,
+    loadFeedbackSnapshot, saveFeedbackSnapshot
+)
+from display import Display
+from scheduler import Scheduler
+from speed_limit import (
+    SpeedLimitCache, SpeedLimitThrottle, createSpeedLimitFetcher
+)
+from spool import SpoolFlusher
+from settings import SETTINGS
+from sample_ring import SampleRing
+from main import (
+    ACQUISITION_INTVL, DRIVING_DATA_INTVL, SPD_LIM_FETCH_INTVL,
+    ACC_FEEDBACK_INTVL, getOBDData
+)
+
+CONTEXT = multiprocessing.get_context('spawn')
+"""Processes are spawned rather than forked so that each opens its own
+database connection instead of sharing the parent's socket"""
+
+READ_INTVL = 0.1  # Seconds
+"""Time persistence and analytics wait between reading new samples"""
+
+DISPLAY_UPDATE_INTVL = 0.05  # Seconds
+"""Time the display waits between updating the GSI from the latest sample"""
+
+SHUTDOWN_TIMEOUT = 30  # Seconds
+"""Longest time a process is given to finish before it is terminated"""
+
+
+# Samples
+# -------------------------------------------------------------------------
+def drivingDataFromSample(sample, journeyID):
+    """Converts a sample read from the ring buffer into a driving data
+    entry"""
+    return {
+        'obdData': {
+            'time': sample['time'],
+            'rpm': sample['rpm'],
+            'speed': sample['speed'],
+            'throttle': sample['throttle'],
+            'fuelLevel': sample['fuelLevel'],
+            'alt': sample['alt']
+        },
+        'journeyID': journeyID,
+        'engineOn': sample['engineOn'],
+        'coords': {
+            'latitude': sample['latitude'],
+            'longitude': sample['longitude']
+        },
+        'gsiIsIndicating': sample['gsiIsIndicating'],
+        'speedLimit': sample['speedLimit']
+    }
+
+
+def readUntilStopped(ring, stopEvent, handle):
+    """Passes every sample written to the ring to a handler until the stop
+    event is set, including the samples written before it was set"""
+    reader = ring.reader()
+    while True:
+        stopping = stopEvent.is_set()
+        for sample in reader.read():
+            handle(sample)
+        if stopping:
+            return reader
+        time.sleep(READ_INTVL)
+
+
+# Acquisition
+# -------------------------------------------------------------------------
+class Acquisition:
+    """Acquires OBD-II and GPS data in the main process, publishing samples to
+    the ring buffer"""
+
+    def __init__(self, obdConn, journey, ring):
+        self.obdConn = obdConn
+        self.ring = ring
+        self.gsi = GSI(SETTINGS, journey)
+        self.obdData = None
+        self.prevOBDData = None
+        self.coords = None
+        self.prevCoords = None
+        self.spdLimCache = SpeedLimitCache()
+        self.spdLimCache.load()
+        self.spdLimFetcher = createSpeedLimitFetcher(self.spdLimCache)
+        self.spdLimThrottle = SpeedLimitThrottle()
+
+    # Jobs
+    # --------------------------------------------------------------------
+    def acquire(self):
+        """Retrieves the latest OBD data and GPS coordinates, tracking the
+        coordinates for speed limits, updates the GSI and publishes them as a
+        sample for the display"""
+        self.prevOBDData = self.obdData
+        self.prevCoords = self.coords
+        self.obdData = getOBDData(self.obdConn)
+        self.obdData['time'] = time.time()
+        self.coords = getGPSCoords()
+        if self.coords:
+            self.spdLimFetcher.track(self.coords)
+
+        if self.prevOBDData:
+            self.gsi.update(self.obdData, self.prevOBDData)
+        self.writeSample(drivingData=False)
+
+    def fetchSpeedLimit(self):
+        """Requests the speed limit for the current coordinates once the
+        vehicle has moved or turned enough for it to have changed"""
+        if self.prevCoords and self.spdLimThrottle.shouldLookup(self.coords):
+            self.spdLimFetcher.request(self.coords, self.prevCoords)
+
+    def writeDrivingData(self):
+        """Publishes the latest acquired data as a sample to be stored"""
+        if self.obdData is not None:
+            self.writeSample(drivingData=True)
+
+    def writeSample(self, drivingData, engineOn=True):
+        """Writes the latest acquired data and GSI state to the ring buffer"""
+        self.ring.write({
+            **self.obdData,
+            **(self.coords or {}),
+            'speedLimit': self.spdLimFetcher.speedLimit,
+            'gsiIsIndicating': self.gsi.isIndicating if engineOn else None,
+            'gsiDots': self.gsi.dotDispCnt,
+            'throttleActive': self.gsi.throttleActive,
+            'engineOn': engineOn,
+            'drivingData': drivingData
+        })
+
+    # Shutdown
+    # --------------------------------------------------------------------
+    def stop(self):
+        """Publishes the final driving data entry and saves the speed limit
+        cache"""
+        try:
+            self.spdLimFetcher.stop()
+            if self.obdData is not None:
+                self.writeSample(drivingData=True, engineOn=False)
+        finally:
+            self.spdLimCache.save()
+
+    def stats(self):
+        """Returns the statistics of the speed limit components"""
+        return {
+            'speedLimitCache': self.spdLimCache.stats(),
+            'speedLimitFetcher': self.spdLimFetcher.stats(),
+            'speedLimitThrottle': self.spdLimThrottle.stats()
+        }
+
+
+# Processes
+# -------------------------------------------------------------------------
+def runChild(target, ringName, ringCapacity, *args):
+    """Attaches a child process to the ring buffer and runs it, ignoring
+    keyboard interrupts so that it is only stopped by the stop event once the
+    main process has published its final sample"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    ring = SampleRing.attach(ringName, ringCapacity)
+    try:
+        target(ring, *args)
+    finally:
+        ring.close()
+        db.conn.close()
+
+
+def runPersistence(ring, journey, stopEvent):
+    """Stores every driving data sample in the database"""
+    drivingDataBuffer = db.DrivingDataBuffer()
+
+    def handle(sample):
+        if sample['drivingData']:
+            drivingDataBuffer.add(drivingDataFromSample(sample, journey['id']))
+
+    try:
+        reader = readUntilStopped(ring, stopEvent, handle)
+    finally:
+        drivingDataBuffer.flush()
+    print(f'drivingDataBuffer: {drivingDataBuffer.stats()}')
+    print(f'persistenceReader: {reader.stats()}')
+
+
+def runAnalytics(ring, journey, stopEvent, ecoDrivingScore, apiOnline):
+    """Adds every driving data sample to the current journey's performance,
+    requesting accumulated feedback to be recalculated at a fixed rate and
+    publishing its score for the display. Recalculations run on a feedback
+    worker so that slow database queries or API calls can't stop the ring
+    buffer being read before it is overwritten."""
+    journeyPerf = JourneyPerformance(journey['id'])
+    feedbackWindow = FeedbackWindow()
+    spoolFlusher = SpoolFlusher()
+
+    def publish(accFeedback):
+        saveFeedbackSnapshot(accFeedback)
+        if accFeedback.ecoDrivingScore is not None:
+            ecoDrivingScore.value = accFeedback.ecoDrivingScore
+        apiOnline.value = (
+            api.lastRequestSuccessful and not api.breaker.isOpen())
+
+    feedbackWorker = FeedbackWorker(journey, publish, feedbackWindow)
+    # The display starts with the last saved feedback, so it is recalculated
+    # straight away
+    feedbackWorker.request(journeyPerf)
+    nextRequest = time.monotonic() + ACC_FEEDBACK_INTVL
+
+    def handle(sample):
+        nonlocal nextRequest
+        if sample['drivingData']:
+            journeyPerf.addDrivingData(db.drivingDataRowToDict(
+                db.drivingDataToRow(drivingDataFromSample(
+                    sample, journey['id']))))
+
+        if time.monotonic() >= nextRequest:
+            feedbackWorker.request(journeyPerf)
+            nextRequest = time.monotonic() + ACC_FEEDBACK_INTVL
+
+    try:
+        reader = readUntilStopped(ring, stopEvent, handle)
+    finally:
+        feedbackWorker.stop()
+        spoolFlusher.stop()
+    # Send latest data to API once any recalculation in progress has finished
+    # using the feedback window
+    feedbackWorker.thread.join()
+    publish(AccumulatedFeedback(journey, journeyPerf, feedbackWindow))
+    print(f'feedbackWorker: {feedbackWorker.stats()}')
+    print(f'spoolFlusher: {spoolFlusher.stats()}')
+    print(f'analyticsReader: {reader.stats()}')
+
+
+def runDisplay(ring, journey, stopEvent, ecoDrivingScore, apiOnline):
+    """Draws the GSI from the latest sample along with the accumulated
+    feedback published by analytics"""
+    gsi = GSI(SETTINGS, journey)
+    accFeedback = AccumulatedFeedback(snapshot=loadFeedbackSnapshot())
+    deviceDisplay = Display(gsi, accFeedback)
+
+    try:
+        while not stopEvent.is_set():
+            sample = ring.latest()
+            if sample:
+                gsi.dotDispCnt = sample['gsiDots']
+                gsi.throttleActive = sample['throttleActive']
+            if not math.isnan(ecoDrivingScore.value):
+                accFeedback.ecoDrivingScore = ecoDrivingScore.value
+            api.lastRequestSuccessful = bool(apiOnline.value)
+            time.sleep(DISPLAY_UPDATE_INTVL)
+    finally:
+        deviceDisplay.stop()
+    print(f'display: {deviceDisplay.stats()}')
+
+
+# Main
+# -------------------------------------------------------------------------
+def main():
+    journey = db.getCurrentJourney()
+    # Processes start with the last saved feedback, so one must exist
+    if loadFeedbackSnapshot() is None:
+        saveFeedbackSnapshot(AccumulatedFeedback(
+            journey, JourneyPerformance(journey['id'])))
+
+    ring = SampleRing.create()
+    stopEvent = CONTEXT.Event()
+    ecoDrivingScore = CONTEXT.Value('d', math.nan, lock=False)
+    apiOnline = CONTEXT.Value('b', 1, lock=False)
+    processes = [
+        CONTEXT.Process(name=name, target=runChild, args=(
+            target, ring.name, ring.capacity, journey, stopEvent, *args))
+        for name, target, args in [
+            ('persistence', runPersistence, ()),
+            ('analytics', runAnalytics, (ecoDrivingScore, apiOnline)),
+            ('display', runDisplay, (ecoDrivingScore, apiOnline)),
+        ]
+    ]
+    for process in processes:
+        process.start()
+
+    obdConn = OBDConnect()
+    acquisition = Acquisition(obdConn, journey, ring)
+    scheduler = Scheduler()
+    # Jobs due at the same time run in the order they are added
+    scheduler.add('acquisition', acquisition.acquire, ACQUISITION_INTVL)
+    scheduler.add(
+        'speedLimit', acquisition.fetchSpeedLimit, SPD_LIM_FETCH_INTVL)
+    scheduler.add(
+        'drivingData', acquisition.writeDrivingData, DRIVING_DATA_INTVL)
+
+    try:
+        scheduler.run(lambda: obdConn.is_connected and all(
+            process.is_alive() for process in processes))
+    except BrokenPipeError:
+        print('OBD-II Disconnected')
+    finally:
+        print('Exiting...')
+        for name, stats in scheduler.stats().items():
+            print(f'{name}: {stats}')
+        try:
+            acquisition.stop()
+        finally:
+            # Processes read every sample written before the event is set
+            stopEvent.set()
+            for process in processes:
+                process.join(SHUTDOWN_TIMEOUT)
+                if process.is_alive():
+                    print(f'Terminating {process.name} process')
+                    process.terminate()
+                    process.join()
+            for name, stats in acquisition.stats().items():
+                print(f'{name}: {stats}')
+            ring.close()
+            ring.unlink()
+            db.conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -8,6 +8,7 @@ using the python-obd library.
 """
 import socket
 import json
+import asyncio
 import obd
 from config import CONFIG
 
@@ -19,6 +20,17 @@ ENCODING = 'utf-8'
 
 # Emulation client
 # -------------------------------------------------------------------------
+def encodeMessage(data):
+    """Encodes a socket message with its header prepended"""
+    msg = str(data).encode(ENCODING)
+    msgLen = len(msg)
+
+    header = str(msgLen).encode(ENCODING)
+    # Pad the header to ensure it meets the set header size
+    header += b' ' * (HEADER_SIZE - len(header))
+    return header + msg
+
+
 class EmulatorClient:
     """Emulator client to request data from the OBD2 Assetto Corsa app"""
 
@@ -39,15 +51,8 @@ class EmulatorClient:
     # -------------------------------------------------------------------------
     def send(self, data):
         """Sends socket messages to the OBD2 AC app"""
-        msg = str(data).encode(ENCODING)
-        msgLen = len(msg)
-
-        header = str(msgLen).encode(ENCODING)
-        # Pad the header to ensure it meets the set header size
-        header += b' ' * (HEADER_SIZE - len(header))
-
-        self.client.send(header)
-        self.client.send(msg)
+        # Header and message are sent together to avoid a second send call
+        self.client.sendall(encodeMessage(data))
 
     def recv(self):
         """Receives socket messages from the OBD2 AC app"""
@@ -56,8 +61,14 @@ class EmulatorClient:
             return
 
         msgLen = int(msgLen)
-        msg = self.client.recv(msgLen).decode(ENCODING)
-        return msg
+        msg = b''
+        # Batched responses may arrive across multiple packets
+        while len(msg) < msgLen:
+            packet = self.client.recv(msgLen - len(msg))
+            if not packet:
+                return
+            msg += packet
+        return msg.decode(ENCODING)
 
     # Retrieve OBD data from Assetto Corsa
     # -------------------------------------------------------------------------
@@ -69,6 +80,68 @@ class EmulatorClient:
         self.send(pid)
         return self.recv()
 
+    def queryMany(self, pids):
+        """Sends multiple PID requests in a single message to retrieve
+        simulated data from the OBD2 AC app in one round-trip"""
+        if not self.connected:
+            return 'disconnected'
+        self.send(json.dumps([str(pid) for pid in pids]))
+        return self.recv()
+
+
+class AsyncEmulatorClient:
+    """Emulator client using an asyncio stream, so that waiting for the OBD2
+    AC app does not block other tasks"""
+
+    def __init__(self):
+        self.reader = None
+        self.writer = None
+        self.connected = False
+
+    async def connect(self):
+        """Connects to the OBD2 AC app"""
+        self.reader, self.writer = await asyncio.open_connection(
+            SERVER_HOST, SERVER_PORT)
+        self.connected = True
+
+    async def disconnect(self):
+        """Disconnects from the OBD2 AC app and closes the stream"""
+        await self.send('!disconnect')
+        self.connected = False
+        self.writer.close()
+        await self.writer.wait_closed()
+
+    async def send(self, data):
+        """Sends socket messages to the OBD2 AC app"""
+        self.writer.write(encodeMessage(data))
+        await self.writer.drain()
+
+    async def recv(self):
+        """Receives socket messages from the OBD2 AC app"""
+        try:
+            header = await self.reader.readexactly(HEADER_SIZE)
+            msgLen = int(header.decode(ENCODING))
+            msg = await self.reader.readexactly(msgLen)
+        except asyncio.IncompleteReadError:
+            return
+        return msg.decode(ENCODING)
+
+    async def query(self, pid):
+        """Sends PID requests to retreive
+        simulated data from the OBD2 AC app"""
+        if not self.connected:
+            return 'disconnected'
+        await self.send(pid)
+        return await self.recv()
+
+    async def queryMany(self, pids):
+        """Sends multiple PID requests in a single message to retrieve
+        simulated data from the OBD2 AC app in one round-trip"""
+        if not self.connected:
+            return 'disconnected'
+        await self.send(json.dumps([str(pid) for pid in pids]))
+        return await self.recv()
+
 
 # OBD Connection Emulation
 # -------------------------------------------------------------------------
@@ -107,9 +180,77 @@ class EmulatedOBD:
         else:
             raise BrokenPipeError
 
+    def query_many(self, cmds, force=False):
+        """Sends multiple commands to the car in a single request, returning
+        their responses in the same order as the given commands"""
+        msg = self.emulator.queryMany([cmd.pid for cmd in cmds])
+
+        if msg:
+            return toOBDResponses(cmds, msg)
+        else:
+            raise BrokenPipeError
+
+
+class AsyncEmulatedOBD:
+    """Emulated OBD-II connection whose queries are awaited, acting the same
+    as EmulatedOBD otherwise"""
+
+    def __init__(self):
+        self.emulator = AsyncEmulatorClient()
+
+    async def connect(self):
+        """Connects to the OBD2 AC app"""
+        await self.emulator.connect()
+
+    def status(self):
+        """Returns the OBD connection status"""
+        if self.emulator.connected is True:
+            return obd.OBDStatus.CAR_CONNECTED
+        else:
+            return obd.OBDStatus.NOT_CONNECTED
+
+    @property
+    def is_connected(self):
+        """Returns whether a connection is established with the vehicle"""
+        return self.status() == obd.OBDStatus.CAR_CONNECTED
+
+    async def close(self):
+        """Closes the OBD connection"""
+        await self.emulator.disconnect()
+
+    async def query_many(self, cmds, force=False):
+        """Sends multiple commands to the car in a single request, returning
+        their responses in the same order as the given commands"""
+        msg = await self.emulator.queryMany([cmd.pid for cmd in cmds])
+
+        if msg:
+            return toOBDResponses(cmds, msg)
+        else:
+            raise BrokenPipeError
+
+
+def toOBDResponses(cmds, msg):
+    """Converts a batched message from the OBD2 AC app into responses for the
+    given commands, in the same order as the commands"""
+    vals = json.loads(msg)
+    responses = []
+    for cmd in cmds:
+        val = vals[str(cmd.pid)]
+        response = obd.OBDResponse(cmd, {'data': val})
+        response.value = val
+        responses.append(response)
+    return responses
+
 
 # OBD connection
 # -------------------------------------------------------------------------
 def OBDConnect():
     """Opens a connection to the OBD interface"""
     return EmulatedOBD()
+
+
+async def AsyncOBDConnect():
+    """Opens a connection to the OBD interface for use with asyncio"""
+    obdConn = AsyncEmulatedOBD()
+    await obdConn.connect()
+    return obdConn
@@ -5,12 +5,34 @@ Calculates and diplays the drivers eco driving performance.
 
 .. image:: ../img/accumulated_feedback_flowchart.png
 """
+import os
+import json
+import time
+from copy import deepcopy
+from pathlib import Path
 from functools import lru_cache
-from datetime import datetime, timezone
-import api
+from itertools import groupby
+from datetime import datetime, timedelta, timezone
+from threading import Thread, Condition
+import numpy as np
 import db
+import spool
+from config import CONFIG
 from utils import kmhToMps
 
+PERFORMANCE_ENGINE = CONFIG.get('performanceEngine', 'python')
+"""Engine used to calculate journey performance from stored driving data,
+either 'python' to process each entry in turn, 'numpy' to use vectorised
+operations over the whole journey, or 'sql' to calculate the performance of
+journeys other than the current journey within the database"""
+
+FEEDBACK_SNAPSHOT_FILE = Path(
+    Path(__file__).resolve().parent.parent,
+    CONFIG.get('feedbackSnapshotFile', 'feedback.json')
+)
+"""File the most recently calculated accumulated feedback is saved to, so that
+it can be shown as soon as the device starts"""
+
 
 # Mean
 # -------------------------------------------------------------------------
@@ -49,6 +71,90 @@ class Mean:
         return f'(Mean: {self.value}, Count: {self.count})'
 
 
+# Driving Data Arrays
+# -------------------------------------------------------------------------
+def drivingDataToArrays(drivingData):
+    """Loads the driving data used to calculate performance into NumPy
+    arrays"""
+    columns = {
+        'time': [],
+        'speed': [],
+        'engineOn': [],
+        'gsiIndicating': [],
+        'spdLim': []
+    }
+
+    for data in drivingData:
+        for name, column in columns.items():
+            column.append(data[name])
+
+    gsiIndicating = columns['gsiIndicating']
+    spdLim = columns['spdLim']
+    return {
+        'time': np.array(columns['time'], dtype='datetime64[us]'),
+        'speed': np.array(columns['speed'], dtype=float),
+        'engineOn': np.array(columns['engineOn'], dtype=bool),
+        'gsiKnown': np.array([x is not None for x in gsiIndicating],
+            dtype=bool),
+        'gsiIndicating': np.array([x is True for x in gsiIndicating],
+            dtype=bool),
+        'spdLim': np.array([np.nan if x is None else x for x in spdLim],
+            dtype=float)
+    }
+
+
+def arraysRowToDict(arrays, i):
+    """Converts a row of driving data arrays back into a driving data
+    dictionary"""
+    spdLim = arrays['spdLim'][i]
+    return {
+        'time': arrays['time'][i].item(),
+        'speed': float(arrays['speed'][i]),
+        'engineOn': bool(arrays['engineOn'][i]),
+        'gsiIndicating': (
+            bool(arrays['gsiIndicating'][i]) if arrays['gsiKnown'][i]
+            else None
+        ),
+        'spdLim': None if np.isnan(spdLim) else spdLim.item()
+    }
+
+
+def arrayMean(values):
+    """Creates a mean from an array of values"""
+    if len(values) == 0:
+        return Mean()
+    return Mean(float(np.mean(values)), len(values))
+
+
+# Driving Data Rollups
+# -------------------------------------------------------------------------
+def rollupMeans(rollups):
+    """Combines daily driving data rollups into the means of the performance
+    factors that only depend on individual driving data entries"""
+    counts = {
+        name: sum(rollup[name] for rollup in rollups) for name in [
+            'gsiCount', 'gsiAdhCount', 'spdLimCount', 'spdLimAdhCount',
+            'motorwayCount', 'motorwaySpdSum'
+        ]
+    }
+    means = {'gsiAdh': Mean(), 'spdLimAdh': Mean(), 'motorwaySpd': Mean()}
+
+    if counts['gsiCount']:
+        means['gsiAdh'] = Mean(
+            100 * counts['gsiAdhCount'] / counts['gsiCount'],
+            counts['gsiCount'])
+    if counts['spdLimCount']:
+        means['spdLimAdh'] = Mean(
+            100 * counts['spdLimAdhCount'] / counts['spdLimCount'],
+            counts['spdLimCount'])
+    if counts['motorwayCount']:
+        means['motorwaySpd'] = Mean(
+            counts['motorwaySpdSum'] / counts['motorwayCount'],
+            counts['motorwayCount'])
+
+    return means
+
+
 # Journey
 # -------------------------------------------------------------------------
 class JourneyPerformance:
@@ -62,7 +168,8 @@ class JourneyPerformance:
     """Minimum number of seconds at zero speed until the time period is
     classified as idling"""
 
-    def __init__(self, journeyID):
+    def __init__(self, journeyID, summary=None, drivingData=None,
+            rollups=None):
         self.journeyID = journeyID
         self.drivingDataCount = 0
         """Number of driving data entries"""
@@ -84,7 +191,27 @@ class JourneyPerformance:
         self.spdLimAdh = Mean()
         self.motorwaySpd = Mean()
         self.idleDur = Mean()
-        self.calcPerformance()
+
+        self.prevDrivingData = None
+        """Most recently added driving data entry"""
+        self.idleStart = None
+        """Start time of the idle in progress"""
+        self.pendingIdle = None
+        """Idle time and duration mean from before the idle in progress was
+        counted"""
+        self.heldDrivingData = []
+        """Driving data held until the journey's travel time is above zero"""
+        self.rollups = rollups
+        """Daily driving data rollups of the journey, which the GSI adherence,
+        speed limit adherence and motorway speed means are loaded from instead
+        of each driving data entry"""
+
+        if summary:
+            self.loadSummary(summary)
+        else:
+            self.calcPerformance(drivingData)
+            if rollups is not None:
+                self.loadRollups()
 
     # Updating values
     # --------------------------------------------------------------------
@@ -161,58 +288,226 @@ class JourneyPerformance:
 
     # Calculate Performance
     # --------------------------------------------------------------------
-    def calcPerformance(self):
-        """Calculates performance statistics from journey driving data"""
-        drivingData = db.getJourneyDrivingData(self.journeyID)
-        if len(drivingData) == 0:
+    def calcPerformance(self, drivingData=None):
+        """Calculates performance statistics from journey driving data,
+        retrieving it from the database if it isn't given"""
+        if drivingData is None:
+            drivingData = db.iterJourneyDrivingData(self.journeyID)
+
+        if PERFORMANCE_ENGINE == 'numpy':
+            self.calcPerformanceArrays(drivingDataToArrays(drivingData))
+        else:
+            for data in drivingData:
+                self.addDrivingData(data)
+
+    def calcPerformanceArrays(self, arrays):
+        """Calculates performance statistics from driving data arrays using
+        vectorised operations, giving the same results as adding each driving
+        data entry in turn"""
+        times = arrays['time']
+        if len(times) == 0:
             return
 
-        self.drivingDataCount = 0
-        self.startTime = drivingData[0]['time']
-        self.endTime = drivingData[-1]['time']
+        self.startTime = times[0].item()
+        self.endTime = times[-1].item()
         self.travelTime = (self.endTime - self.startTime).total_seconds()
+
         if self.travelTime == 0:
+            self.heldDrivingData = [
+                arraysRowToDict(arrays, i) for i in range(len(times))
+            ]
             return
 
-        prevData = None
-        idleStart = None
+        speed = arrays['speed']
+        engineOn = arrays['engineOn']
+        spdLim = arrays['spdLim']
+        initialSpeed = speed[:-1]
+        speedDiff = np.diff(speed)
+        timeDiff = np.diff(times) / np.timedelta64(1, 's')
+
+        # Distance
+        moving = timeDiff > 0
+        acceleration = kmhToMps(speedDiff[moving]) / timeDiff[moving]
+        distance = kmhToMps(initialSpeed[moving]) * timeDiff[moving]
+        accDistance = 0.5 * acceleration * (timeDiff[moving] ** 2)
+        self.distance += float(np.sum(distance + accDistance)) / 1000
+
+        # Acceleration and deceleration smoothness
+        with np.errstate(divide='ignore', invalid='ignore'):
+            acceleration = kmhToMps(speedDiff) / timeDiff
 
-        for data in drivingData:
-            if prevData:
-                self.updDistance(prevData, data)
-                self.updAccSmoothness(prevData, data)
-                self.updDecSmoothness(prevData, data)
+        accelerating = speedDiff >= self.ACC_MIN_SPD_DIFF
+        starting = initialSpeed < 1
+        self.startAccSmoothness.combine(
+            arrayMean(acceleration[accelerating & starting]))
+        self.drivAccSmoothness.combine(
+            arrayMean(acceleration[accelerating & ~starting]))
+        self.decSmoothness.combine(
+            arrayMean(acceleration[speedDiff <= -self.ACC_MIN_SPD_DIFF]))
+
+        # Adherence and motorway speed
+        if self.rollups is None:
+            gsiCounted = arrays['gsiKnown'] & (speed >= 1)
+            self.gsiAdh.combine(arrayMean(
+                np.where(arrays['gsiIndicating'][gsiCounted], 0, 100)))
+
+            with np.errstate(invalid='ignore'):
+                spdLimCounted = ~np.isnan(spdLim) & (speed >= 1)
+                self.spdLimAdh.combine(arrayMean(np.where(
+                    speed[spdLimCounted] <= spdLim[spdLimCounted], 100, 0)))
+                self.motorwaySpd.combine(arrayMean(speed[spdLim == 113]))
+
+        # Idling, found from runs of driving data at zero speed with the
+        # engine on. An idle stops at the first entry after the run if the
+        # engine is turned off, otherwise at the last entry of the run.
+        idling = (speed < 1) & engineOn
+        edges = np.diff(np.concatenate(([0], idling.astype(np.int8), [0])))
+        runStarts = np.flatnonzero(edges == 1)
+        runEnds = np.flatnonzero(edges == -1)
+
+        if len(runEnds) and runEnds[-1] == len(times):
+            # Run continues to the end of the journey, so is still in progress
+            self.idleStart = times[runStarts[-1]].item()
+            runStarts = runStarts[:-1]
+            runEnds = runEnds[:-1]
+
+        idleStops = np.where(engineOn[runEnds], runEnds - 1, runEnds)
+        idleTimes = (times[idleStops] - times[runStarts]) / np.timedelta64(
+            1, 's')
+        idleTimes = idleTimes[idleTimes >= self.IDLE_MIN_WAIT]
+        self.idleTime += float(np.sum(idleTimes))
+        self.idleDur.combine(arrayMean(idleTimes))
+
+        self.drivingDataCount += len(times)
+        self.prevDrivingData = arraysRowToDict(arrays, len(times) - 1)
+        self.countPendingIdle()
+
+    def addDrivingData(self, data):
+        """Adds a driving data entry to the end of the journey, updating the
+        performance statistics incrementally"""
+        if self.startTime == 0:
+            self.startTime = data['time']
+        self.endTime = data['time']
+        self.travelTime = (self.endTime - self.startTime).total_seconds()
 
-                if idleStart:
-                    if data['engineOn'] is False:
-                        self.updIdle(idleStart, data['time'])
-                        idleStart = None
-                    elif data['speed'] >= 1:
-                        self.updIdle(idleStart, prevData['time'])
-                        idleStart = None
+        # Performance can't be calculated without any travel time
+        if self.travelTime == 0:
+            self.heldDrivingData.append(data)
+            return
 
+        heldDrivingData = self.heldDrivingData
+        self.heldDrivingData = []
+
+        self.revertPendingIdle()
+        for heldData in heldDrivingData:
+            self.updPerformance(heldData)
+        self.updPerformance(data)
+        self.countPendingIdle()
+
+    def updPerformance(self, data):
+        """Updates the performance statistics with the next driving data
+        entry"""
+        prevData = self.prevDrivingData
+
+        if prevData:
+            self.updDistance(prevData, data)
+            self.updAccSmoothness(prevData, data)
+            self.updDecSmoothness(prevData, data)
+
+            if self.idleStart:
+                if data['engineOn'] is False:
+                    self.updIdle(self.idleStart, data['time'])
+                    self.idleStart = None
+                elif data['speed'] >= 1:
+                    self.updIdle(self.idleStart, prevData['time'])
+                    self.idleStart = None
+
+        if self.rollups is None:
             self.updGSIAdh(data['speed'], data['gsiIndicating'])
             self.updSpdLimAdh(data['speed'], data['spdLim'])
             self.updMotorwaySpd(data['speed'], data['spdLim'])
 
-            if idleStart is None and data['speed'] < 1 and data['engineOn']:
-                idleStart = data['time']
+        if self.idleStart is None and data['speed'] < 1 and data['engineOn']:
+            self.idleStart = data['time']
+
+        self.prevDrivingData = data
+        self.drivingDataCount += 1
+
+    def countPendingIdle(self):
+        """Counts the idle in progress as if the journey ended at the most
+        recent driving data entry"""
+        if self.idleStart:
+            self.pendingIdle = (
+                self.idleTime, self.idleDur.value, self.idleDur.count
+            )
+            self.updIdle(self.idleStart, self.prevDrivingData['time'])
+
+    def revertPendingIdle(self):
+        """Reverts the counting of the idle in progress so that it can
+        continue"""
+        if self.pendingIdle:
+            (
+                self.idleTime, self.idleDur.value, self.idleDur.count
+            ) = self.pendingIdle
+            self.pendingIdle = None
+
+    def loadRollups(self):
+        """Loads the means that only depend on individual driving data entries
+        from the journey's rollups. Like its entries, they are only counted
+        once the journey has travel time."""
+        if self.travelTime > 0:
+            for name, mean in rollupMeans(self.rollups).items():
+                setattr(self, name, mean)
+
+    # Summary
+    # --------------------------------------------------------------------
+    def isFinished(self):
+        """Returns whether the journey has finished, meaning no more driving
+        data can be added to it"""
+        if self.endTime == 0:
+            return False
+        secsSinceEnd = (datetime.now() - self.endTime).total_seconds()
+        return secsSinceEnd >= db.JOURNEY_INTVL
+
+    def toSummary(self):
+        """Returns a summary of the journey's performance statistics to be
+        stored in the database"""
+        summary = {
+            'journeyID': self.journeyID,
+            'drivingDataCount': self.drivingDataCount,
+            'startTime': self.startTime or None,
+            'endTime': self.endTime or None,
+            'travelTime': self.travelTime,
+            'idleTime': self.idleTime,
+            'distance': self.distance,
+        }
 
-            prevData = data
-            self.drivingDataCount += 1
+        for name, _ in db.JOURNEY_PERF_MEANS:
+            mean = getattr(self, name)
+            summary[name] = {'value': mean.value, 'count': mean.count}
 
-        # Check for idling at end of journey
-        if idleStart:
-            self.updIdle(idleStart, prevData['time'])
+        return summary
+
+    def loadSummary(self, summary):
+        """Loads performance statistics from a stored summary"""
+        self.drivingDataCount = summary['drivingDataCount']
+        self.startTime = summary['startTime'] or 0
+        self.endTime = summary['endTime'] or 0
+        self.travelTime = summary['travelTime']
+        self.idleTime = summary['idleTime']
+        self.distance = summary['distance']
+
+        for name, _ in db.JOURNEY_PERF_MEANS:
+            setattr(self, name, Mean(
+                summary[name]['value'], summary[name]['count']))
 
     # API
     # --------------------------------------------------------------------
     def updateAPI(self):
         """Update API journey performance stats"""
-        if self.drivingDataCount < 2:  
+        if self.drivingDataCount < 2:
             return  # Prevent uploading stats with insufficient driving data
 
-        apiID = db.getJourneyApiID(self.journeyID)
         data = {
             'start': self.startTime.isoformat(),
             'end': self.endTime.isoformat(),
@@ -223,24 +518,22 @@ class JourneyPerformance:
         if self.gsiAdh.value is not None:
             data['gsiAdh'] = self.gsiAdh.value
 
-        if apiID:
-            api.updateJourney(apiID, data)
-        else:
-            apiID = api.createJourney(data)
-            db.updateJourneyApiID(self.journeyID, apiID)
+        spool.sendJourney(self.journeyID, data)
 
 
-# Accumulated Feedback
+# Feedback Window
 # -------------------------------------------------------------------------
-class AccumulatedFeedback:
-    """Accumulated feedback calculated from the drivers eco-driving performance
-    over the last 30 days"""
+class FeedbackTotals:
+    """Performance factor means combined over a group of journeys"""
+
+    MEANS = [
+        'drivAccSmoothness', 'startAccSmoothness', 'decSmoothness', 'gsiAdh',
+        'spdLimAdh', 'motorwaySpd', 'idleDur', 'jrnyIdlePct', 'jrnyDist'
+    ]
 
-    def __init__(self, currentJourney={'id': 0}):
+    def __init__(self):
         self.journeys = []
         self.drivingDataCount = 0
-        self.ecoDrivingScore = None
-        self.plantImg = None
 
         self.drivAccSmoothness = Mean()
         self.startAccSmoothness = Mean()
@@ -252,6 +545,85 @@ class AccumulatedFeedback:
         self.jrnyIdlePct = Mean()
         self.jrnyDist = Mean()
 
+    def addJourney(self, journey):
+        """Adds a journey to the totals and updates the means"""
+        self.journeys.append(journey)
+        self.drivingDataCount += journey.drivingDataCount
+
+        self.drivAccSmoothness.combine(journey.drivAccSmoothness)
+        self.startAccSmoothness.combine(journey.startAccSmoothness)
+        self.decSmoothness.combine(journey.decSmoothness)
+        self.gsiAdh.combine(journey.gsiAdh)
+        self.spdLimAdh.combine(journey.spdLimAdh)
+        self.motorwaySpd.combine(journey.motorwaySpd)
+        self.idleDur.combine(journey.idleDur)
+
+        if journey.travelTime > 0:
+            jrnyIdlePct = (journey.idleTime / journey.travelTime) * 100
+            self.jrnyIdlePct.increment(jrnyIdlePct)
+            self.jrnyDist.increment(journey.distance)
+
+    def combine(self, totals):
+        """Combines the current totals with other totals"""
+        self.journeys.extend(totals.journeys)
+        self.drivingDataCount += totals.drivingDataCount
+        for name in self.MEANS:
+            getattr(self, name).combine(getattr(totals, name))
+
+
+class FeedbackWindow:
+    """Sliding window of daily totals of finished journeys, bucketed by the
+    day each journey started. Finished journeys never change, so each is only
+    added once and the window is moved forward by dropping whole days."""
+
+    def __init__(self, ndays=30):
+        self.ndays = ndays
+        """Number of days before today covered by the window"""
+        self.buckets = {}
+        """Totals of finished journeys keyed by the date they started"""
+        self.journeyIDs = set()
+        """IDs of the journeys held in the buckets"""
+
+    def slide(self, today):
+        """Moves the window forward to end at the given date, dropping any
+        buckets from before the start of the window"""
+        windowStart = today - timedelta(days=self.ndays)
+        for date in list(self.buckets):
+            if date < windowStart:
+                bucket = self.buckets.pop(date)
+                self.journeyIDs.difference_update(
+                    journey.journeyID for journey in bucket.journeys)
+
+    def addJourney(self, journey):
+        """Adds a finished journey to the bucket of the day it started"""
+        date = journey.startTime.date()
+        if date not in self.buckets:
+            self.buckets[date] = FeedbackTotals()
+        self.buckets[date].addJourney(journey)
+        self.journeyIDs.add(journey.journeyID)
+
+    def totals(self):
+        """Returns the totals of every bucket combined"""
+        totals = FeedbackTotals()
+        for date in sorted(self.buckets):
+            totals.combine(self.buckets[date])
+        return totals
+
+
+# Accumulated Feedback
+# -------------------------------------------------------------------------
+class AccumulatedFeedback(FeedbackTotals):
+    """Accumulated feedback calculated from the drivers eco-driving performance
+    over the last 30 days"""
+
+    def __init__(self, currentJourney={'id': 0}, currentJourneyPerf=None,
+            window=None, snapshot=None):
+        super().__init__()
+        self.ecoDrivingScore = None
+        self.plantImg = None
+        self.calculatedAt = datetime.now()
+        """Time at which the accumulated feedback was calculated"""
+
         self.drivAccSmoothnessScore = None
         self.startAccSmoothnessScore = None
         self.decSmoothnessScore = None
@@ -262,35 +634,115 @@ class AccumulatedFeedback:
         self.jrnyIdlePctScore = None
         self.jrnyDistScore = None
 
+        if snapshot:
+            self.loadSnapshot(snapshot)
+            return
+
+        # Journeys that finished before a previous refresh are already held by
+        # the window, so only the remaining journeys are loaded
+        if window is None:
+            window = FeedbackWindow()
+        window.slide(datetime.now().date())
+        self.combine(window.totals())
+
+        journeyIDs = [
+            journeyID
+            for journeyID in db.getJourneyIDsWithinLastNdays(window.ndays)
+            if journeyID not in window.journeyIDs
+        ]
+        if currentJourneyPerf and currentJourney['id'] not in journeyIDs:
+            # Current journey's driving data may not have been stored yet
+            journeyIDs.append(currentJourney['id'])
+
+        # Finished journeys never change, so their stored summaries are used
+        # instead of recalculating them from their driving data
+        summaries = db.getJourneyPerformances(journeyIDs)
+        calcJourneyIDs = [
+            journeyID for journeyID in journeyIDs
+            if journeyID not in summaries and not (
+                currentJourneyPerf and journeyID == currentJourney['id'])
+        ]
+
         # Calculate means per journey so memory isn't filled by all
         # of the time-series driving data from the past 30 days
-        for journeyID in db.getJourneyIDsWithinLastNdays(30):
-            journeyPerf = JourneyPerformance(journeyID)
+        calculated = {}
+        if PERFORMANCE_ENGINE == 'sql':
+            # Only the summaries are retrieved, rather than the driving data
+            for journeyID, summary in db.calcJourneyPerformances(
+                    calcJourneyIDs).items():
+                calculated[journeyID] = JourneyPerformance(journeyID, summary)
+        else:
+            # Means of individual entries are read from the daily rollups, so
+            # only the remaining means are calculated from the driving data
+            rollups = {
+                journeyID: list(journeyRollups)
+                for journeyID, journeyRollups in groupby(
+                    db.getJourneysDailyDrivingData(calcJourneyIDs),
+                    key=lambda rollup: rollup['journeyID'])
+            }
+            for journeyID, drivingData in groupby(
+                db.getJourneysDrivingData(calcJourneyIDs),
+                key=lambda data: data['journeyID']
+            ):
+                calculated[journeyID] = JourneyPerformance(
+                    journeyID, drivingData=drivingData,
+                    rollups=rollups.get(journeyID, []))
+
+        for journeyID in journeyIDs:
+            if currentJourneyPerf and journeyID == currentJourney['id']:
+                # Already kept up to date by the main loop
+                journeyPerf = currentJourneyPerf
+            elif journeyID in summaries:
+                journeyPerf = JourneyPerformance(
+                    journeyID, summaries[journeyID])
+            else:
+                journeyPerf = calculated.get(journeyID) or JourneyPerformance(
+                    journeyID, drivingData=[])
+                if (
+                    journeyID != currentJourney['id'] and
+                    journeyPerf.isFinished()
+                ):
+                    db.createJourneyPerformance(journeyPerf.toSummary())
+
             self.addJourney(journeyPerf)
             if journeyPerf.journeyID == currentJourney['id']:
                 journeyPerf.updateAPI()
+            elif journeyPerf.isFinished():
+                window.addJourney(journeyPerf)
 
         self.updFactorScores()
         self.updEcoDrivingScore()
         self.updateAPI()
 
-    def addJourney(self, journey):
-        """Adds a journey to the accumulated feedback and updates the means"""
-        self.journeys.append(journey)
-        self.drivingDataCount += journey.drivingDataCount
-
-        self.drivAccSmoothness.combine(journey.drivAccSmoothness)
-        self.startAccSmoothness.combine(journey.startAccSmoothness)
-        self.decSmoothness.combine(journey.decSmoothness)
-        self.gsiAdh.combine(journey.gsiAdh)
-        self.spdLimAdh.combine(journey.spdLimAdh)
-        self.motorwaySpd.combine(journey.motorwaySpd)
-        self.idleDur.combine(journey.idleDur)
+    # Snapshot
+    # --------------------------------------------------------------------
+    def toSnapshot(self):
+        """Returns the calculated means and scores to be saved locally"""
+        return {
+            'calculatedAt': self.calculatedAt.isoformat(),
+            'drivingDataCount': self.drivingDataCount,
+            'means': {
+                name: {
+                    'value': getattr(self, name).value,
+                    'count': getattr(self, name).count
+                } for name in self.MEANS
+            },
+            'scores': {
+                name: getattr(self, name + 'Score') for name in self.MEANS
+            },
+            'ecoDrivingScore': self.ecoDrivingScore
+        }
 
-        if journey.travelTime > 0:
-            jrnyIdlePct = (journey.idleTime / journey.travelTime) * 100
-            self.jrnyIdlePct.increment(jrnyIdlePct)
-            self.jrnyDist.increment(journey.distance)
+    def loadSnapshot(self, snapshot):
+        """Loads means and scores from a saved snapshot instead of
+        calculating them"""
+        self.calculatedAt = datetime.fromisoformat(snapshot['calculatedAt'])
+        self.drivingDataCount = snapshot['drivingDataCount']
+        for name in self.MEANS:
+            mean = snapshot['means'][name]
+            setattr(self, name, Mean(mean['value'], mean['count']))
+            setattr(self, name + 'Score', snapshot['scores'][name])
+        self.ecoDrivingScore = snapshot['ecoDrivingScore']
 
     # Factor Scores
     # --------------------------------------------------------------------
@@ -452,4 +904,134 @@ class AccumulatedFeedback:
             if score is not None:
                 scores[name] = score
 
-        api.addScores(scores)
+        spool.sendScores(scores)
+
+
+# Feedback Snapshot
+# -------------------------------------------------------------------------
+def saveFeedbackSnapshot(accFeedback, filename=FEEDBACK_SNAPSHOT_FILE):
+    """Saves a snapshot of accumulated feedback, replacing the previous
+    snapshot in a single step so that a partially written file is never
+    loaded"""
+    tmpFilename = filename.with_name(filename.name + '.tmp')
+    with open(tmpFilename, 'w') as file:
+        json.dump(accFeedback.toSnapshot(), file)
+    os.replace(tmpFilename, filename)
+
+
+def isNumberOrNone(value):
+    """Returns whether a value loaded from JSON is a number or None"""
+    return value is None or (
+        isinstance(value, (int, float)) and not isinstance(value, bool))
+
+
+def isValidFeedbackSnapshot(snapshot):
+    """Returns whether a loaded snapshot has the keys and value types of a
+    saved accumulated feedback snapshot"""
+    try:
+        datetime.fromisoformat(snapshot['calculatedAt'])
+        return (
+            isinstance(snapshot['drivingDataCount'], int) and
+            isNumberOrNone(snapshot['ecoDrivingScore']) and
+            all(
+                isNumberOrNone(snapshot['means'][name]['value']) and
+                isinstance(snapshot['means'][name]['count'], int) and
+                isNumberOrNone(snapshot['scores'][name])
+                for name in FeedbackTotals.MEANS
+            )
+        )
+    except (KeyError, TypeError, ValueError):
+        return False
+
+
+def loadFeedbackSnapshot(filename=FEEDBACK_SNAPSHOT_FILE):
+    """Loads the saved accumulated feedback snapshot, returning None if there
+    isn't a valid snapshot"""
+    try:
+        with open(filename, 'r') as file:
+            snapshot = json.load(file)
+    except (OSError, ValueError):
+        return None
+
+    if not isValidFeedbackSnapshot(snapshot):
+        return None
+    return snapshot
+
+
+# Background Worker
+# -------------------------------------------------------------------------
+class FeedbackWorker:
+    """Recalculates and uploads accumulated feedback on a background thread,
+    publishing each result once it is complete so that the main loop never
+    waits for the database or API"""
+
+    def __init__(self, currentJourney, publish, window=None):
+        self.currentJourney = currentJourney
+        self.publish = publish
+        """Called with each newly calculated accumulated feedback"""
+        self.window = window if window is not None else FeedbackWindow()
+        self.pending = None
+        """Snapshot of the current journey's performance waiting to be used"""
+        self.calculations = 0
+        """Number of accumulated feedback calculations completed"""
+        self.failures = 0
+        """Number of calculations that raised an exception"""
+        self.droppedRequests = 0
+        """Number of requests replaced by a newer request"""
+        self.lastDuration = 0
+        """Seconds taken by the last calculation"""
+        self.running = True
+        self.condition = Condition()
+
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def request(self, currentJourneyPerf):
+        """Requests accumulated feedback to be recalculated, replacing any
+        request that is still waiting. The current journey's performance is
+        copied so that the main loop can continue to update it."""
+        snapshot = deepcopy(currentJourneyPerf)
+        with self.condition:
+            if self.pending:
+                self.droppedRequests += 1
+            self.pending = snapshot
+            self.condition.notify()
+
+    def run(self):
+        """Calculates requested accumulated feedback until stopped"""
+        while True:
+            with self.condition:
+                while self.running and self.pending is None:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                currentJourneyPerf = self.pending
+                self.pending = None
+
+            start = time.perf_counter()
+            try:
+                accFeedback = AccumulatedFeedback(
+                    self.currentJourney, currentJourneyPerf, self.window)
+            except Exception as e:
+                self.failures += 1
+                print(f'Accumulated feedback calculation failed: {e!r}')
+                continue
+
+            self.lastDuration = time.perf_counter() - start
+            self.calculations += 1
+            self.publish(accFeedback)
+
+    def stats(self):
+        """Returns the calculation statistics of the worker"""
+        return {
+            'calculations': self.calculations,
+            'failures': self.failures,
+            'droppedRequests': self.droppedRequests,
+            'lastDuration': self.lastDuration
+        }
+
+    def stop(self):
+        """Stops the background thread after any calculation in progress"""
+        with self.condition:
+            self.running = False
+            self.condition.notify()
@@ -0,0 +1,259 @@
+"""
+Async Device Pipeline
+
+Runs the device as separate asyncio tasks instead of a single scheduler loop.
+OBD polling awaits the emulator's socket stream and GPS coordinates are read
+by their own task. Each later stage has its own bounded queue and task, and
+blocking stages run on their own worker threads. Slow database or network
+I/O in one stage therefore does not delay acquisition, GSI updates or the
+other stages:
+
+- Speed limits are resolved from the queued GPS coordinates
+- Persistence stores queued driving data in the database
+- Feedback adds queued driving data to the current journey's performance and
+  requests accumulated feedback to be recalculated
+
+Run from the device folder with:
+    python device/pipeline.py
+"""
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import db
+from gps import getGPSCoords
+from obd_ii import AsyncOBDConnect
+from scheduler import Job
+from main import (
+    ACQUISITION_INTVL, DRIVING_DATA_INTVL, SPD_LIM_FETCH_INTVL,
+    ACC_FEEDBACK_INTVL, OBD_COMMANDS, Device, obdResponsesToData
+)
+
+COORDS_QUEUE_SIZE = 10
+"""Number of GPS coordinates that can wait for speed limit resolution before
+the oldest are dropped"""
+
+DRIVING_DATA_QUEUE_SIZE = 60
+"""Number of driving data entries that can wait to be stored or added to the
+current journey's performance before the oldest are dropped"""
+
+
+# Stage Queue
+# -------------------------------------------------------------------------
+class StageQueue(asyncio.Queue):
+    """Bounded queue in front of a stage, which drops its oldest item rather
+    than blocking the stage putting items into it"""
+
+    def __init__(self, maxsize):
+        super().__init__(maxsize)
+        self.dropped = 0
+        """Number of items dropped due to the queue being full"""
+
+    def putDroppingOldest(self, item):
+        """Puts an item into the queue, dropping the oldest item if the stage
+        has fallen too far behind"""
+        if self.full():
+            self.get_nowait()
+            self.task_done()
+            self.dropped += 1
+        self.put_nowait(item)
+
+    def stats(self):
+        """Returns the size of the queue and the number of dropped items"""
+        return {'size': self.qsize(), 'dropped': self.dropped}
+
+
+# Pipeline
+# -------------------------------------------------------------------------
+class Pipeline:
+    """Runs the device's stages as asyncio tasks, the sources at their own
+    fixed rates and the rest as soon as items are queued for them"""
+
+    def __init__(self, device, obdConn):
+        self.device = device
+        self.obdConn = obdConn
+        self.jobs = []
+        self.coordsQueue = StageQueue(COORDS_QUEUE_SIZE)
+        """GPS coordinates waiting for speed limit resolution"""
+        self.drivingDataQueue = StageQueue(DRIVING_DATA_QUEUE_SIZE)
+        """Driving data entries waiting to be stored"""
+        self.performanceQueue = StageQueue(DRIVING_DATA_QUEUE_SIZE)
+        """Driving data entries waiting to be added to the current journey's
+        performance"""
+        self.nextSpeedLimitFetch = 0
+        """Monotonic time after which the speed limit is next requested"""
+        self.gpsExecutor = ThreadPoolExecutor(max_workers=1)
+        """Reads GPS coordinates, so a slow GPS read can't block the event
+        loop"""
+        self.persistenceExecutor = ThreadPoolExecutor(max_workers=1)
+        """Stores driving data in the database"""
+        self.feedbackExecutor = ThreadPoolExecutor(max_workers=1)
+        """Updates the current journey's performance and requests accumulated
+        feedback, one at a time as both use the journey's performance"""
+
+    # Sources
+    # --------------------------------------------------------------------
+    async def acquire(self):
+        """Awaits the latest OBD data, then updates the GSI with it"""
+        if not self.obdConn.is_connected:
+            raise BrokenPipeError
+        responses = await self.obdConn.query_many(OBD_COMMANDS)
+        self.device.updateOBDData(obdResponsesToData(responses))
+
+    async def readGPS(self):
+        """Reads the latest GPS coordinates, queueing them for speed limit
+        resolution"""
+        coords = await asyncio.get_running_loop().run_in_executor(
+            self.gpsExecutor, getGPSCoords)
+        self.coordsQueue.putDroppingOldest(coords)
+
+    async def queueDrivingData(self):
+        """Queues the latest driving data to be stored and added to the
+        current journey's performance"""
+        if self.device.obdData is None:
+            return
+
+        data = self.device.drivingDataEntry()
+        self.drivingDataQueue.putDroppingOldest(data)
+        self.performanceQueue.putDroppingOldest(data)
+
+    async def updAccumulatedFeedback(self):
+        """Requests accumulated feedback to be recalculated, copying the
+        current journey's performance on the feedback worker thread"""
+        await asyncio.get_running_loop().run_in_executor(
+            self.feedbackExecutor, self.device.updAccumulatedFeedback)
+
+    # Stages
+    # --------------------------------------------------------------------
+    async def resolveSpeedLimits(self):
+        """Tracks queued GPS coordinates for speed limits until cancelled,
+        requesting the speed limit at a fixed rate. Requests never block as
+        speed limits are fetched in the background or looked up locally."""
+        while True:
+            coords = await self.coordsQueue.get()
+            try:
+                self.device.updateCoords(coords)
+                if time.monotonic() >= self.nextSpeedLimitFetch:
+                    self.device.fetchSpeedLimit()
+                    self.nextSpeedLimitFetch = (
+                        time.monotonic() + SPD_LIM_FETCH_INTVL)
+            finally:
+                self.coordsQueue.task_done()
+
+    async def storeDrivingData(self):
+        """Stores queued driving data on the persistence worker thread until
+        cancelled"""
+        await self.consume(
+            self.drivingDataQueue, self.persistenceExecutor,
+            self.device.storeDrivingData)
+
+    async def addJourneyPerformance(self):
+        """Adds queued driving data to the current journey's performance on
+        the feedback worker thread until cancelled"""
+        await self.consume(
+            self.performanceQueue, self.feedbackExecutor,
+            self.device.addJourneyPerformance)
+
+    async def consume(self, queue, executor, func):
+        """Passes every queued item to a blocking function on a worker thread
+        until cancelled"""
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await queue.get()
+            try:
+                await loop.run_in_executor(executor, func, item)
+            finally:
+                queue.task_done()
+
+    # Running
+    # --------------------------------------------------------------------
+    async def runJob(self, job):
+        """Runs an async job at its fixed rate until cancelled"""
+        while True:
+            delay = job.deadline - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            job.start(time.monotonic())
+            await job.func()
+            job.finish()
+
+    async def run(self):
+        """Runs every stage until one of them raises an exception, such as
+        the OBD-II connection being lost, storing any queued driving data
+        before returning"""
+        now = time.monotonic()
+        self.jobs = [
+            Job('acquisition', self.acquire, ACQUISITION_INTVL, now),
+            Job('gps', self.readGPS, ACQUISITION_INTVL, now),
+            Job('drivingData', self.queueDrivingData, DRIVING_DATA_INTVL, now),
+            Job('accumulatedFeedback', self.updAccumulatedFeedback,
+                ACC_FEEDBACK_INTVL, now + ACC_FEEDBACK_INTVL),
+        ]
+        jobTasks = [asyncio.create_task(self.runJob(job)) for job in self.jobs]
+        stageTasks = {
+            self.coordsQueue: asyncio.create_task(self.resolveSpeedLimits()),
+            self.drivingDataQueue: asyncio.create_task(
+                self.storeDrivingData()),
+            self.performanceQueue: asyncio.create_task(
+                self.addJourneyPerformance()),
+        }
+
+        try:
+            done, _ = await asyncio.wait(
+                jobTasks + list(stageTasks.values()),
+                return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                task.result()
+        finally:
+            for task in jobTasks:
+                task.cancel()
+            await asyncio.gather(*jobTasks, return_exceptions=True)
+
+            # Stages finish their queued items before they are stopped
+            for queue, task in stageTasks.items():
+                if not task.done():
+                    await queue.join()
+                task.cancel()
+            await asyncio.gather(*stageTasks.values(), return_exceptions=True)
+
+    def stats(self):
+        """Returns the timing statistics of every source and the size of
+        every stage's queue"""
+        stats = {job.name: job.stats() for job in self.jobs}
+        stats['coordsQueue'] = self.coordsQueue.stats()
+        stats['drivingDataQueue'] = self.drivingDataQueue.stats()
+        stats['performanceQueue'] = self.performanceQueue.stats()
+        return stats
+
+    def shutdown(self):
+        """Shuts down the worker threads once the stages have stopped"""
+        for executor in [
+            self.gpsExecutor, self.persistenceExecutor, self.feedbackExecutor
+        ]:
+            executor.shutdown()
+
+
+# Main
+# -------------------------------------------------------------------------
+async def main():
+    obdConn = await AsyncOBDConnect()
+    device = Device(obdConn, db.getCurrentJourney())
+    pipeline = Pipeline(device, obdConn)
+
+    try:
+        await pipeline.run()
+    except BrokenPipeError:
+        print('OBD-II Disconnected')
+    finally:
+        print('Exiting...')
+        for name, stats in pipeline.stats().items():
+            print(f'{name}: {stats}')
+        await asyncio.get_running_loop().run_in_executor(
+            pipeline.persistenceExecutor, device.stop)
+        pipeline.shutdown()
+        for name, stats in device.stats().items():
+            print(f'{name}: {stats}')
+        db.conn.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,229 @@
+"""
+Road Segment Index
+
+Looks up speed limits offline from a grid index of road segments, built from
+a GeoJSON export of roads with maxspeed tags such as an OpenStreetMap extract.
+The index is stored as NumPy arrays that are memory-mapped when loaded, so
+lookups only read the grid cells around the queried coordinates.
+
+Build an index from the device folder with:
+    python device/road_index.py roads.geojson [index folder]
+"""
+import re
+import sys
+import json
+import math
+from pathlib import Path
+import numpy as np
+from config import CONFIG
+from utils import EARTH_RADIUS
+
+ROAD_INDEX_DIR = Path(
+    Path(__file__).resolve().parent.parent,
+    CONFIG.get('roadIndexDir', 'road_index')
+)
+"""Folder the road segment index is stored in"""
+
+CELL_SIZE = 0.005  # Degrees
+"""Size of grid cells, roughly 550m by 350m in the UK"""
+
+MAX_DISTANCE = 30  # Metres
+"""Furthest a road segment can be from coordinates to be matched to them"""
+
+MAXSPEED_REGEX = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*(mph|km/h|kmh|kph)?\s*$')
+
+
+# Building
+# -------------------------------------------------------------------------
+def parseMaxspeed(maxspeed):
+    """Converts an OpenStreetMap maxspeed tag to km/h, returning None if it
+    isn't a numeric speed limit"""
+    if maxspeed is None:
+        return None
+
+    match = MAXSPEED_REGEX.match(str(maxspeed))
+    if not match:
+        return None
+
+    speed = float(match.group(1))
+    return speed * 1.609344 if match.group(2) == 'mph' else speed
+
+
+def cellKeys(rows, cols):
+    """Returns the keys of grid cells from their rows and columns"""
+    return rows * int(math.ceil(360 / CELL_SIZE)) + cols
+
+
+def cellRowsCols(latitudes, longitudes):
+    """Returns the rows and columns of the grid cells containing
+    coordinates"""
+    rows = np.floor((np.asarray(latitudes) + 90) / CELL_SIZE).astype(np.int64)
+    cols = np.floor((np.asarray(longitudes) + 180) / CELL_SIZE).astype(
+        np.int64)
+    return rows, cols
+
+
+def readRoadSegments(features):
+    """Splits GeoJSON road features with a numeric maxspeed into segments,
+    returning the segments' coordinates and speed limits"""
+    segments = []
+    speedLimits = []
+
+    for feature in features:
+        speedLimit = parseMaxspeed(
+            (feature.get('properties') or {}).get('maxspeed'))
+        if speedLimit is None:
+            continue
+
+        geometry = feature.get('geometry') or {}
+        if geometry.get('type') == 'LineString':
+            lines = [geometry['coordinates']]
+        elif geometry.get('type') == 'MultiLineString':
+            lines = geometry['coordinates']
+        else:
+            continue
+
+        for line in lines:
+            for (lon1, lat1, *_), (lon2, lat2, *_) in zip(line, line[1:]):
+                segments.append((lat1, lon1, lat2, lon2))
+                speedLimits.append(speedLimit)
+
+    return (
+        np.array(segments, dtype=np.float64).reshape(-1, 4),
+        np.array(speedLimits, dtype=np.float32)
+    )
+
+
+def buildRoadIndex(features, indexDir=ROAD_INDEX_DIR):
+    """Builds a grid index of road segments from GeoJSON road features,
+    listing each segment under every cell its bounding box overlaps"""
+    segments, speedLimits = readRoadSegments(features)
+    minRows, minCols = cellRowsCols(
+        np.minimum(segments[:, 0], segments[:, 2]),
+        np.minimum(segments[:, 1], segments[:, 3]))
+    maxRows, maxCols = cellRowsCols(
+        np.maximum(segments[:, 0], segments[:, 2]),
+        np.maximum(segments[:, 1], segments[:, 3]))
+
+    # Expand each segment into one entry per overlapped cell
+    colCounts = maxCols - minCols + 1
+    cellCounts = (maxRows - minRows + 1) * colCounts
+    segmentIDs = np.repeat(np.arange(len(segments)), cellCounts)
+    offsets = np.arange(cellCounts.sum()) - np.repeat(
+        np.cumsum(cellCounts) - cellCounts, cellCounts)
+    keys = cellKeys(
+        minRows[segmentIDs] + offsets // colCounts[segmentIDs],
+        minCols[segmentIDs] + offsets % colCounts[segmentIDs])
+
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    segmentIDs = segmentIDs[order]
+    uniqueKeys, starts = np.unique(keys, return_index=True)
+
+    indexDir = Path(indexDir)
+    indexDir.mkdir(parents=True, exist_ok=True)
+    np.save(indexDir / 'segments.npy', segments)
+    np.save(indexDir / 'speed_limits.npy', speedLimits)
+    np.save(indexDir / 'cell_keys.npy', uniqueKeys.astype(np.int64))
+    np.save(indexDir / 'cell_starts.npy',
+        np.append(starts, len(keys)).astype(np.int64))
+    np.save(indexDir / 'cell_segments.npy', segmentIDs.astype(np.int32))
+    with open(indexDir / 'index.json', 'w') as file:
+        json.dump({'cellSize': CELL_SIZE, 'segments': len(segments)}, file)
+
+
+# Lookup
+# -------------------------------------------------------------------------
+class RoadIndex:
+    """Memory-mapped grid index of road segments"""
+
+    def __init__(self, indexDir=ROAD_INDEX_DIR):
+        indexDir = Path(indexDir)
+        with open(indexDir / 'index.json', 'r') as file:
+            if json.load(file)['cellSize'] != CELL_SIZE:
+                raise ValueError(
+                    f"Road index '{indexDir}' was built with a different "
+                    'cell size')
+
+        self.segments = np.load(indexDir / 'segments.npy', mmap_mode='r')
+        self.speedLimits = np.load(
+            indexDir / 'speed_limits.npy', mmap_mode='r')
+        self.cellKeys = np.load(indexDir / 'cell_keys.npy', mmap_mode='r')
+        self.cellStarts = np.load(
+            indexDir / 'cell_starts.npy', mmap_mode='r')
+        self.cellSegments = np.load(
+            indexDir / 'cell_segments.npy', mmap_mode='r')
+
+    def nearbySegments(self, coords):
+        """Returns the IDs of segments within the cell containing the
+        coordinates and the cells surrounding it"""
+        rows, cols = cellRowsCols([coords['latitude']], [coords['longitude']])
+        keys = cellKeys(
+            rows[0] + np.array([-1, -1, -1, 0, 0, 0, 1, 1, 1]),
+            cols[0] + np.array([-1, 0, 1, -1, 0, 1, -1, 0, 1]))
+
+        positions = np.searchsorted(self.cellKeys, keys)
+        segmentIDs = [
+            self.cellSegments[self.cellStarts[pos]:self.cellStarts[pos + 1]]
+            for pos, key in zip(positions, keys)
+            if pos < len(self.cellKeys) and self.cellKeys[pos] == key
+        ]
+        if not segmentIDs:
+            return np.array([], dtype=np.int32)
+        return np.unique(np.concatenate(segmentIDs))
+
+    def nearest(self, coords):
+        """Returns the ID of and distance in metres to the nearest segment to
+        the coordinates, or None if there isn't a segment within the grid
+        cells surrounding them"""
+        segmentIDs = self.nearbySegments(coords)
+        if len(segmentIDs) == 0:
+            return None
+
+        # Project onto a plane in metres centred on the coordinates, which is
+        # accurate over the few hundred metres searched
+        lat = math.radians(coords['latitude'])
+        scale = np.array([
+            EARTH_RADIUS * math.pi / 180,
+            EARTH_RADIUS * math.pi / 180 * math.cos(lat)
+        ])
+        point = np.array([coords['latitude'], coords['longitude']])
+        segments = np.asarray(self.segments[segmentIDs])
+        starts = (segments[:, 0:2] - point) * scale
+        ends = (segments[:, 2:4] - point) * scale
+
+        # Distance from the origin to the closest point on each segment
+        direction = ends - starts
+        lengthsSquared = np.einsum('ij,ij->i', direction, direction)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            t = np.clip(
+                -np.einsum('ij,ij->i', starts, direction) / lengthsSquared,
+                0, 1)
+        t[lengthsSquared == 0] = 0
+        closest = starts + direction * t[:, np.newaxis]
+        distances = np.hypot(closest[:, 0], closest[:, 1])
+
+        nearest = np.argmin(distances)
+        return int(segmentIDs[nearest]), float(distances[nearest])
+
+    def getSpeedLimit(self, coords, maxDistance=MAX_DISTANCE):
+        """Returns the speed limit of the nearest road segment to the
+        coordinates, or None if there isn't a segment within the max
+        distance"""
+        nearest = self.nearest(coords)
+        if nearest is None or nearest[1] > maxDistance:
+            return None
+        return float(self.speedLimits[nearest[0]])
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('Usage: python device/road_index.py roads.geojson '
+            '[index folder]')
+        sys.exit(1)
+
+    with open(sys.argv[1], 'r') as file:
+        roads = json.load(file)
+    indexDir = sys.argv[2] if len(sys.argv) > 2 else ROAD_INDEX_DIR
+    buildRoadIndex(roads['features'], indexDir)
+    print(f'Road index saved to {indexDir}')
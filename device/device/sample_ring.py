@@ -0,0 +1,205 @@
+"""
+Shared Memory Sample Ring
+
+Fixed size ring buffer of acquired samples held in shared memory, so that a
+single acquisition process can publish samples to any number of reader
+processes without pickling them through pipes or queues. Samples are stored as
+NumPy structured records, with a write count at the start of the block that is
+only incremented once a sample has been fully written.
+
+Each slot is guarded by a sequence number, which is odd whilst its sample is
+being written and is then set from the sample's write count. Readers check
+the sequence number before and after copying a sample, so a sample that was
+overwritten whilst it was copied is never returned torn.
+"""
+import math
+from multiprocessing import shared_memory
+import numpy as np
+from config import CONFIG
+
+RING_CAPACITY = int(CONFIG.get('sampleRingCapacity', 600))
+"""Number of samples held before the oldest are overwritten, 60 seconds at
+the acquisition rate"""
+
+SAMPLE_DTYPE = np.dtype([
+    ('time', 'f8'),
+    ('rpm', 'f8'),
+    ('speed', 'f8'),
+    ('throttle', 'f8'),
+    ('fuelLevel', 'f8'),
+    ('alt', 'f8'),
+    ('latitude', 'f8'),
+    ('longitude', 'f8'),
+    ('speedLimit', 'f8'),
+    ('gsiIsIndicating', 'i1'),
+    ('gsiDots', 'i1'),
+    ('throttleActive', '?'),
+    ('engineOn', '?'),
+    ('drivingData', '?'),
+])
+"""Fields of a sample, where drivingData marks samples to be stored"""
+
+FLOAT_FIELDS = [
+    name for name in SAMPLE_DTYPE.names if SAMPLE_DTYPE[name].kind == 'f'
+]
+HEADER_SIZE = 8  # Bytes
+"""Size of the write count stored before the sequence numbers"""
+SEQUENCE_SIZE = 8  # Bytes
+"""Size of the sequence number of each slot"""
+
+
+# Conversion
+# -------------------------------------------------------------------------
+def sampleToRecord(sample):
+    """Converts a sample to a tuple of record fields, storing None as NaN or
+    -1 for the GSI indicating state"""
+    values = []
+    for name in SAMPLE_DTYPE.names:
+        value = sample.get(name)
+        if name == 'gsiIsIndicating':
+            value = -1 if value is None else int(value)
+        elif value is None:
+            value = math.nan if name in FLOAT_FIELDS else 0
+        values.append(value)
+    return tuple(values)
+
+
+def recordToSample(record):
+    """Converts a record to a sample, restoring the values stored as NaN or -1
+    to None"""
+    sample = dict(zip(SAMPLE_DTYPE.names, record.tolist()))
+    for name in FLOAT_FIELDS:
+        if math.isnan(sample[name]):
+            sample[name] = None
+    if sample['gsiIsIndicating'] == -1:
+        sample['gsiIsIndicating'] = None
+    else:
+        sample['gsiIsIndicating'] = bool(sample['gsiIsIndicating'])
+    return sample
+
+
+# Ring
+# -------------------------------------------------------------------------
+def sequence(writeCount):
+    """Returns the sequence number of a slot holding the sample with the given
+    write count, which is always even"""
+    return 2 * writeCount + 2
+
+
+class SampleRing:
+    """Ring buffer of samples in a shared memory block, written to by a
+    single process"""
+
+    def __init__(self, shm, capacity):
+        self.shm = shm
+        self.capacity = capacity
+        self.writeCount = np.ndarray((1,), dtype=np.int64, buffer=shm.buf)
+        """Number of samples written since the ring was created"""
+        self.sequences = np.ndarray(
+            (capacity,), dtype=np.int64, buffer=shm.buf, offset=HEADER_SIZE)
+        """Sequence number of each slot, odd whilst it is being written"""
+        self.samples = np.ndarray(
+            (capacity,), dtype=SAMPLE_DTYPE, buffer=shm.buf,
+            offset=HEADER_SIZE + self.sequences.nbytes)
+
+    @classmethod
+    def create(cls, capacity=RING_CAPACITY):
+        """Creates a ring in a new shared memory block"""
+        shm = shared_memory.SharedMemory(
+            create=True,
+            size=HEADER_SIZE + capacity * (
+                SEQUENCE_SIZE + SAMPLE_DTYPE.itemsize))
+        ring = cls(shm, capacity)
+        ring.writeCount[0] = 0
+        ring.sequences[:] = 0
+        return ring
+
+    @classmethod
+    def attach(cls, name, capacity):
+        """Attaches to a ring created by another process"""
+        return cls(shared_memory.SharedMemory(name=name), capacity)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def write(self, sample):
+        """Writes a sample over the oldest slot, marking the slot as being
+        written until it holds the whole sample and only counting the sample
+        once it has been fully written"""
+        count = int(self.writeCount[0])
+        slot = count % self.capacity
+        self.sequences[slot] = 2 * count + 1
+        self.samples[slot] = sampleToRecord(sample)
+        self.sequences[slot] = sequence(count)
+        self.writeCount[0] = count + 1
+
+    def latest(self):
+        """Returns the most recently written sample, or None if no samples
+        have been written"""
+        while True:
+            count = int(self.writeCount[0])
+            if count == 0:
+                return None
+
+            slot = (count - 1) % self.capacity
+            before = int(self.sequences[slot])
+            record = self.samples[slot].copy()
+            if before == sequence(count - 1) == int(self.sequences[slot]):
+                return recordToSample(record)
+
+    def reader(self):
+        """Returns a reader starting from the first sample written, so that
+        samples written before a process attached are not missed whilst they
+        are still held"""
+        return SampleReader(self)
+
+    def close(self):
+        """Detaches from the shared memory block"""
+        # Views must be released before the block can be closed
+        self.writeCount = None
+        self.sequences = None
+        self.samples = None
+        self.shm.close()
+
+    def unlink(self):
+        """Frees the shared memory block, called by the creating process once
+        every other process has detached"""
+        self.shm.unlink()
+
+
+class SampleReader:
+    """Reads the samples written to a ring in order, keeping its own
+    position"""
+
+    def __init__(self, ring, position=0):
+        self.ring = ring
+        self.position = position
+        """Write count of the next sample to read"""
+        self.overruns = 0
+        """Number of samples overwritten before they could be read"""
+
+    def read(self):
+        """Returns every sample written since the last read, skipping any that
+        have been overwritten"""
+        capacity = self.ring.capacity
+        count = int(self.ring.writeCount[0])
+        start = max(self.position, count - capacity)
+        writeCounts = np.arange(start, count)
+        indexes = writeCounts % capacity
+
+        # Fancy indexing copies, so a sample is only intact if its slot held
+        # it both before and after it was copied
+        before = self.ring.sequences[indexes]
+        records = self.ring.samples[indexes]
+        after = self.ring.sequences[indexes]
+        expected = sequence(writeCounts)
+        intact = (before == expected) & (after == expected)
+
+        self.overruns += start - self.position + int(np.sum(~intact))
+        self.position = count
+        return [recordToSample(record) for record in records[intact]]
+
+    def stats(self):
+        """Returns the reader's position and number of missed samples"""
+        return {'position': self.position, 'overruns': self.overruns}
@@ -0,0 +1,122 @@
+"""
+Fixed-rate Scheduler
+
+Runs jobs at their own fixed rates, sleeping until the next job is due rather
+than busy waiting. Each job records its overruns and start time jitter so that
+timing issues on the device can be diagnosed.
+"""
+import time
+
+
+# Job
+# -------------------------------------------------------------------------
+class Job:
+    """Function that is run by the scheduler at a fixed interval"""
+
+    def __init__(self, name, func, interval, deadline):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        """Seconds between each run of the job"""
+        self.deadline = deadline
+        """Monotonic time at which the job is next due to run"""
+        self.runs = 0
+        """Number of times the job has been run"""
+        self.overruns = 0
+        """Number of runs that finished after the job was next due"""
+        self.missedRuns = 0
+        """Number of runs skipped due to overruns"""
+        self.jitter = 0
+        """Seconds between the job being due and it starting on its last
+        run"""
+        self.maxJitter = 0
+        """Largest jitter of all runs"""
+        self.totalJitter = 0
+        """Sum of the jitter of all runs"""
+
+    @property
+    def meanJitter(self):
+        """Mean jitter of all runs"""
+        if self.runs == 0:
+            return 0
+        return self.totalJitter / self.runs
+
+    def run(self, now):
+        """Runs the job, records its timing and schedules its next run"""
+        self.start(now)
+        self.func()
+        self.finish()
+
+    def start(self, now):
+        """Records the jitter of a run starting at the given time"""
+        self.jitter = now - self.deadline
+        self.maxJitter = max(self.maxJitter, self.jitter)
+        self.totalJitter += self.jitter
+        self.runs += 1
+
+    def finish(self):
+        """Schedules the next run once a run has finished"""
+        self.deadline += self.interval
+        finish = time.monotonic()
+        if finish > self.deadline:
+            # Skip any runs that have already been missed to prevent the job
+            # from running repeatedly to catch up
+            self.overruns += 1
+            missed = int((finish - self.deadline) // self.interval) + 1
+            self.missedRuns += missed
+            self.deadline += missed * self.interval
+
+    def stats(self):
+        """Returns the timing statistics of the job"""
+        return {
+            'interval': self.interval,
+            'runs': self.runs,
+            'overruns': self.overruns,
+            'missedRuns': self.missedRuns,
+            'jitter': self.jitter,
+            'meanJitter': self.meanJitter,
+            'maxJitter': self.maxJitter
+        }
+
+
+# Scheduler
+# -------------------------------------------------------------------------
+class Scheduler:
+    """Runs jobs at their own fixed rates until stopped"""
+
+    def __init__(self):
+        self.jobs = []
+        self.running = False
+
+    def add(self, name, func, interval, delay=0):
+        """Adds a job to be run every interval seconds, starting after the
+        given delay"""
+        job = Job(name, func, interval, time.monotonic() + delay)
+        self.jobs.append(job)
+        return job
+
+    def runPending(self):
+        """Runs the job that is most overdue if any are due, otherwise sleeps
+        until the next job is due"""
+        job = min(self.jobs, key=lambda job: job.deadline)
+        now = time.monotonic()
+
+        if job.deadline > now:
+            time.sleep(job.deadline - now)
+            now = time.monotonic()
+
+        job.run(now)
+
+    def run(self, condition=lambda: True):
+        """Runs jobs until stopped or the given condition is no longer met"""
+        self.running = True
+        while self.running and condition():
+            self.runPending()
+
+    def stop(self):
+        """Stops the scheduler after the currently running job"""
+        self.running = False
+
+    def stats(self):
+        """Returns the timing statistics of every job"""
+        return {job.name: job.stats() for job in self.jobs}
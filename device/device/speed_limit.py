@@ -0,0 +1,616 @@
+"""
+Speed Limits
+
+Retrieves speed limits for GPS coordinates using Mapbox's map matching API.
+Requests are made by a background worker so that slow or unavailable network
+connections do not block the main loop.
+"""
+import os
+import json
+import time
+from collections import OrderedDict, deque
+from pathlib import Path
+from threading import Thread, Condition, Lock
+import requests
+from config import CONFIG
+from circuit_breaker import CircuitBreaker
+from utils import geohash, haversine, bearing, angleDifference
+from road_index import RoadIndex
+
+STALE_REQUEST_AGE = 6  # Seconds
+"""Age at which a speed limit request is too old for its result to be used"""
+
+SPEED_LIMIT_CACHE_FILE = Path(
+    Path(__file__).resolve().parent.parent,
+    CONFIG.get('speedLimitCacheFile', 'speed_limits.json')
+)
+"""File the speed limit cache is saved to between runs"""
+
+SPEED_LIMIT_CACHE_SIZE = int(CONFIG.get('speedLimitCacheSize', 20000))
+"""Maximum number of locations with a cached speed limit"""
+
+SPEED_LIMIT_CACHE_TTL = float(CONFIG.get('speedLimitCacheDays', 30)) * 86400
+"""Seconds a cached speed limit is used for before it is fetched again"""
+
+SPEED_LIMIT_CACHE_PRECISION = int(CONFIG.get('speedLimitCachePrecision', 8))
+"""Geohash length of cached locations, 8 characters being a cell of roughly
+38m by 19m"""
+
+SPEED_LIMIT_PROVIDER = CONFIG.get('speedLimitProvider', 'mapbox')
+"""Source of speed limits, either 'mapbox' to match the current and previous
+coordinates, 'trace' to match a trailing window of coordinates at once or
+'offline' to look up the nearest road in the local road segment index"""
+
+TRACE_WINDOW_SIZE = 100
+"""Most coordinates Mapbox's map matching API can match in one request"""
+
+TRACE_MATCH_POINTS = int(CONFIG.get('traceMatchPoints', 10))
+"""Number of new coordinates collected before the trace is matched again"""
+
+TRACE_POINT_DISTANCE = float(CONFIG.get('tracePointDistance', 10))  # Metres
+"""Distance moved after which acquired coordinates are added to the trace, so
+that it isn't filled with GPS noise whilst stationary. Matched coordinates
+within this distance of the vehicle have their speed limit served."""
+
+LOOKUP_DISTANCE = float(CONFIG.get('speedLimitLookupDistance', 50))  # Metres
+"""Distance moved since the last lookup after which the speed limit is looked
+up again, 0 to look up the speed limit every time"""
+
+LOOKUP_HEADING = float(CONFIG.get('speedLimitLookupHeading', 30))  # Degrees
+"""Change in heading since the last lookup after which the speed limit is
+looked up again, such as when turning at a junction"""
+
+MIN_HEADING_DISTANCE = 5  # Metres
+"""Distance that must be moved for a heading to be calculated, as the heading
+between closer coordinates is mostly GPS noise"""
+
+breaker = CircuitBreaker()
+"""Circuit breaker of requests to Mapbox"""
+
+
+# Mapbox
+# -------------------------------------------------------------------------
+def getMostConfidentRoute(matchings):
+    """Retrieves the route with the highest confidence for matchings received
+    from Mapbox"""
+    highestConfidence = 0
+    route = None
+
+    for match in matchings:
+        if match['confidence'] > highestConfidence:
+            highestConfidence = match['confidence']
+            route = match
+
+    return route
+
+
+def maxspeedToKmh(maxspeed):
+    """Converts a Mapbox maxspeed annotation to km/h, returning None if the
+    speed limit is unknown"""
+    if maxspeed.get('unit') == 'km/h':
+        return maxspeed['speed']
+    elif maxspeed.get('unit') == 'mph':
+        return maxspeed['speed'] * 1.609344
+
+
+def requestMatching(coordsList):
+    """Requests Mapbox's map matching API to match coordinates to roads,
+    returning the response data if they were matched. Returns None without a
+    request whilst Mapbox is unreachable."""
+    coordsStr = ';'.join(
+        f'{coords["longitude"]},{coords["latitude"]}' for coords in coordsList)
+
+    if not breaker.allow():
+        return None
+
+    try:
+        response = requests.get(
+            f'https://api.mapbox.com/matching/v5/mapbox/driving/{coordsStr}', {
+                'annotations': 'maxspeed',
+                'overview': 'full',
+                'access_token': CONFIG['mapboxAccessToken']
+            },
+            timeout=5
+        )
+    except Exception:
+        breaker.recordFailure()
+        return None
+    breaker.recordSuccess()
+
+    try:
+        if response.ok:
+            data = response.json()
+            if data['code'] == "Ok":
+                return data
+    except Exception:
+        pass
+
+
+def matchSpeedLimit(coords, prevCoords):
+    """Matches the given coordinates to a road, returning the speed limit of
+    the road and the matched coordinates, or None if they could not be
+    matched. The speed limit is None if it is unknown."""
+    data = requestMatching([coords, prevCoords])
+    if data is None:
+        return None
+
+    try:
+        route = getMostConfidentRoute(data['matchings'])
+        maxSpd = route['legs'][0]['annotation']['maxspeed']
+        speedLimit = maxspeedToKmh(maxSpd[0])
+    except (KeyError, IndexError, TypeError):
+        return None
+
+    tracepoint = (data.get('tracepoints') or [None])[0]
+    if tracepoint is None:
+        return speedLimit, coords
+    longitude, latitude = tracepoint['location']
+    return speedLimit, {'latitude': latitude, 'longitude': longitude}
+
+
+def getSpeedLimit(coords, prevCoords):
+    """Retrieves the speed limit for the route of the given coordinates using
+    Mapbox's map matching API"""
+    match = matchSpeedLimit(coords, prevCoords)
+    return match[0] if match else None
+
+
+def matchTrace(trace):
+    """Matches a trace of coordinates to roads in a single request, returning
+    the coordinates, matched coordinates and speed limit of each coordinate
+    that was matched, in the order of the trace"""
+    data = requestMatching(trace)
+    if data is None:
+        return []
+
+    speedLimits = []
+    for coords, tracepoint in zip(trace, data.get('tracepoints') or []):
+        if tracepoint is None:
+            continue
+
+        try:
+            matching = data['matchings'][tracepoint['matchings_index']]
+            legs = matching['legs']
+            waypoint = tracepoint['waypoint_index']
+            # Use the start of the leg leaving the coordinates, or the end of
+            # the leg arriving at the last coordinates of a matching
+            if waypoint < len(legs):
+                maxSpd = legs[waypoint]['annotation']['maxspeed'][0]
+            else:
+                maxSpd = legs[waypoint - 1]['annotation']['maxspeed'][-1]
+        except (KeyError, IndexError, TypeError):
+            continue
+
+        longitude, latitude = tracepoint['location']
+        speedLimits.append((
+            coords,
+            {'latitude': latitude, 'longitude': longitude},
+            maxspeedToKmh(maxSpd)
+        ))
+
+    return speedLimits
+
+
+# Cache
+# -------------------------------------------------------------------------
+class SpeedLimitCache:
+    """Size bounded cache of speed limits keyed by the geohash of the location
+    they were resolved for, evicting the least recently used speed limits once
+    full"""
+
+    def __init__(self, size=SPEED_LIMIT_CACHE_SIZE, ttl=SPEED_LIMIT_CACHE_TTL,
+            precision=SPEED_LIMIT_CACHE_PRECISION):
+        self.size = size
+        self.ttl = ttl
+        self.precision = precision
+        self.entries = OrderedDict()
+        """Speed limits and the time they were cached keyed by geohash, least
+        recently used first"""
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = Lock()
+
+    def key(self, coords):
+        """Returns the geohash of the cell containing the coordinates"""
+        return geohash(coords['latitude'], coords['longitude'], self.precision)
+
+    def get(self, coords):
+        """Returns whether a speed limit is cached for the coordinates, along
+        with the cached speed limit"""
+        key = self.key(coords)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or time.time() - entry[1] >= self.ttl:
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return False, None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True, entry[0]
+
+    def put(self, coords, speedLimit, cachedAt=None):
+        """Caches the speed limit of the coordinates"""
+        key = self.key(coords)
+        with self.lock:
+            self.entries[key] = (
+                speedLimit, time.time() if cachedAt is None else cachedAt)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        """Returns the hit rate statistics of the cache"""
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hitRate': self.hits / lookups if lookups else None,
+            'evictions': self.evictions,
+            'entries': len(self.entries)
+        }
+
+    def save(self, filename=SPEED_LIMIT_CACHE_FILE):
+        """Saves the cache, replacing the previously saved cache in a single
+        step so that a partially written file is never loaded"""
+        with self.lock:
+            cache = {
+                'precision': self.precision,
+                'entries': [
+                    [key, speedLimit, cachedAt]
+                    for key, (speedLimit, cachedAt) in self.entries.items()
+                ]
+            }
+
+        tmpFilename = filename.with_name(filename.name + '.tmp')
+        with open(tmpFilename, 'w') as file:
+            json.dump(cache, file)
+        os.replace(tmpFilename, filename)
+
+    def load(self, filename=SPEED_LIMIT_CACHE_FILE):
+        """Loads the saved cache, ignoring it if it isn't valid or was saved
+        with a different precision"""
+        try:
+            with open(filename, 'r') as file:
+                cache = json.load(file)
+        except (OSError, ValueError):
+            return
+
+        if cache.get('precision') != self.precision:
+            return
+
+        with self.lock:
+            for key, speedLimit, cachedAt in cache['entries']:
+                if time.time() - cachedAt < self.ttl:
+                    self.entries[key] = (speedLimit, cachedAt)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+# Background Fetcher
+# -------------------------------------------------------------------------
+class SpeedLimitFetcher:
+    """Fetches speed limits on a background thread, publishing the most
+    recent speed limit to be read without blocking"""
+
+    def __init__(self, cache=None):
+        self.cache = cache
+        """Speed limit cache checked before fetching a speed limit"""
+        self.speedLimit = None
+        """Most recently fetched speed limit"""
+        self.speedLimitTime = None
+        """Timestamp of the request the current speed limit was fetched for"""
+        self.pending = None
+        """Latest request waiting to be fetched"""
+        self.droppedRequests = 0
+        """Number of requests dropped for being superseded or stale"""
+        self.fetches = 0
+        """Number of requests sent to be fetched"""
+        self.running = True
+        self.condition = Condition()
+
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def request(self, coords, prevCoords):
+        """Requests the speed limit for the given coordinates, replacing any
+        request that is still waiting to be fetched. Cached speed limits are
+        published straight away."""
+        if self.cache:
+            isCached, speedLimit = self.cache.get(coords)
+            if isCached:
+                self.publish(time.time(), speedLimit)
+                return
+
+        with self.condition:
+            if self.pending:
+                self.droppedRequests += 1
+            self.pending = (time.time(), coords, prevCoords)
+            self.condition.notify()
+
+    def run(self):
+        """Fetches requested speed limits until stopped"""
+        while True:
+            with self.condition:
+                while self.running and self.pending is None:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                requestTime, *request = self.pending
+                self.pending = None
+
+            if time.time() - requestTime >= STALE_REQUEST_AGE:
+                self.droppedRequests += 1
+                continue
+
+            self.fetches += 1
+            self.publish(requestTime, self.fetch(*request))
+
+    def fetch(self, coords, prevCoords):
+        """Fetches the speed limit of a request, caching it if the
+        coordinates were matched to a road"""
+        match = matchSpeedLimit(coords, prevCoords)
+        if match is None:
+            return None
+
+        speedLimit, matchedCoords = match
+        if self.cache:
+            self.cache.put(coords, speedLimit)
+            self.cache.put(matchedCoords, speedLimit)
+        return speedLimit
+
+    def publish(self, requestTime, speedLimit):
+        """Publishes a fetched speed limit unless it is stale or a newer
+        speed limit has already been published"""
+        with self.condition:
+            if (
+                time.time() - requestTime >= STALE_REQUEST_AGE or
+                (self.speedLimitTime and requestTime < self.speedLimitTime)
+            ):
+                self.droppedRequests += 1
+                return
+
+            self.speedLimit = speedLimit
+            self.speedLimitTime = requestTime
+
+    def track(self, coords):
+        """Does nothing, as speed limits are only fetched when requested"""
+
+    def stats(self):
+        """Returns the request statistics of the fetcher"""
+        return {
+            'fetches': self.fetches,
+            'droppedRequests': self.droppedRequests
+        }
+
+    def stop(self):
+        """Stops the background thread"""
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+
+class TraceSpeedLimitFetcher(SpeedLimitFetcher):
+    """Fetches speed limits by matching a trailing window of coordinates in a
+    single request, caching the speed limit of every matched coordinate.
+    Every acquired coordinate is tracked, so between matches the speed limit
+    of the vehicle's current position is served from the latest match, or
+    otherwise from the cache, and the last speed limit is kept if neither has
+    one."""
+
+    def __init__(self, cache=None, matchPoints=TRACE_MATCH_POINTS,
+            pointDistance=TRACE_POINT_DISTANCE):
+        self.trace = deque(maxlen=TRACE_WINDOW_SIZE)
+        """Trailing window of tracked coordinates"""
+        self.matchPoints = matchPoints
+        self.pointDistance = pointDistance
+        self.newPoints = 0
+        """Number of coordinates added since the trace was last requested"""
+        self.matched = []
+        """Coordinates, matched coordinates and speed limits of the latest
+        match, in the order of the trace"""
+        self.matchedIndex = 0
+        """Index of the matched coordinates the vehicle was last nearest to,
+        which only moves forward along the trace"""
+        self.matches = 0
+        """Number of traces successfully matched"""
+        super().__init__(cache if cache is not None else SpeedLimitCache())
+
+    def request(self, coords, prevCoords):
+        """Tracks the requested coordinates, which are skipped if they were
+        already tracked when acquired"""
+        self.track(coords)
+
+    def track(self, coords):
+        """Adds acquired coordinates to the trace once the vehicle has moved
+        far enough from the last coordinates added, publishing the speed limit
+        of its position and requesting the trace to be matched once enough new
+        coordinates have been added"""
+        if self.trace and haversine(
+            self.trace[-1]['latitude'], self.trace[-1]['longitude'],
+            coords['latitude'], coords['longitude']
+        ) < self.pointDistance:
+            return
+
+        self.trace.append(coords)
+        self.newPoints += 1
+        self.publishPosition(coords)
+
+        # Match straight away until a trace has been matched, so that a speed
+        # limit is available soon after starting
+        if len(self.trace) < 2 or (
+            self.newPoints < self.matchPoints and self.matches > 0
+        ):
+            return
+
+        self.newPoints = 0
+        with self.condition:
+            if self.pending:
+                self.droppedRequests += 1
+            self.pending = (time.time(), list(self.trace))
+            self.condition.notify()
+
+    def publishPosition(self, coords):
+        """Publishes the speed limit of the matched coordinates nearest to the
+        vehicle's position, searching from those it was last nearest to
+        onwards, or the cached speed limit of its position if it isn't near
+        any"""
+        with self.condition:
+            nearest = None
+            for i in range(self.matchedIndex, len(self.matched)):
+                distance = haversine(
+                    self.matched[i][1]['latitude'],
+                    self.matched[i][1]['longitude'],
+                    coords['latitude'], coords['longitude'])
+                if distance <= self.pointDistance and (
+                    nearest is None or distance < nearest[1]
+                ):
+                    nearest = (i, distance)
+
+            if nearest is not None:
+                self.matchedIndex = nearest[0]
+                self.publish(time.time(), self.matched[nearest[0]][2])
+                return
+
+        isCached, speedLimit = self.cache.get(coords)
+        if isCached:
+            self.publish(time.time(), speedLimit)
+
+    def fetch(self, trace):
+        """Matches a trace, caching the speed limit of every matched
+        coordinate and returning the speed limit of the most recent"""
+        speedLimits = matchTrace(trace)
+        if not speedLimits:
+            return None
+
+        for coords, matchedCoords, speedLimit in speedLimits:
+            self.cache.put(coords, speedLimit)
+            self.cache.put(matchedCoords, speedLimit)
+        with self.condition:
+            self.matched = speedLimits
+            self.matchedIndex = 0
+        self.matches += 1
+        return speedLimits[-1][2]
+
+    def stats(self):
+        """Returns the request statistics of the fetcher"""
+        return {**super().stats(), 'matches': self.matches}
+
+
+class OfflineSpeedLimitFetcher:
+    """Looks up speed limits in a local road segment index. Lookups are fast
+    enough to be made by the main loop, so there is no background thread."""
+
+    def __init__(self, roadIndex):
+        self.roadIndex = roadIndex
+        self.speedLimit = None
+        """Most recently looked up speed limit"""
+        self.speedLimitTime = None
+        """Time the current speed limit was looked up"""
+        self.lookups = 0
+        self.misses = 0
+        """Number of lookups without a road segment nearby"""
+
+    def request(self, coords, prevCoords):
+        """Looks up the speed limit of the nearest road to the given
+        coordinates"""
+        self.speedLimit = self.roadIndex.getSpeedLimit(coords)
+        self.speedLimitTime = time.time()
+        self.lookups += 1
+        if self.speedLimit is None:
+            self.misses += 1
+
+    def track(self, coords):
+        """Does nothing, as speed limits are only looked up when requested"""
+
+    def stats(self):
+        """Returns the lookup statistics of the fetcher"""
+        return {'lookups': self.lookups, 'misses': self.misses}
+
+    def stop(self):
+        """Does nothing, as there is no background thread to stop"""
+
+
+# Throttle
+# -------------------------------------------------------------------------
+class SpeedLimitThrottle:
+    """Decides whether the speed limit needs to be looked up again, which is
+    only once the vehicle has moved far enough or changed heading since the
+    last lookup. Otherwise the last speed limit remains valid, such as whilst
+    stationary or driving along the same road."""
+
+    def __init__(self, distance=LOOKUP_DISTANCE, heading=LOOKUP_HEADING):
+        self.distance = distance
+        self.heading = heading
+        self.lookupCoords = None
+        """Coordinates the speed limit was last looked up for"""
+        self.lookupHeading = None
+        """Heading when the speed limit was last looked up"""
+        self.prevCoords = None
+        self.currHeading = None
+        self.lookups = 0
+        self.avoidedLookups = 0
+
+    def updateHeading(self, coords):
+        """Updates the current heading once far enough from the coordinates
+        the heading was last calculated from"""
+        if self.prevCoords is None:
+            self.prevCoords = coords
+            return
+
+        latLons = (
+            self.prevCoords['latitude'], self.prevCoords['longitude'],
+            coords['latitude'], coords['longitude']
+        )
+        if haversine(*latLons) >= MIN_HEADING_DISTANCE:
+            self.currHeading = bearing(*latLons)
+            self.prevCoords = coords
+
+    def shouldLookup(self, coords):
+        """Returns whether the speed limit should be looked up for the given
+        coordinates"""
+        self.updateHeading(coords)
+        if self.lookupHeading is None:
+            # Compare against the first heading known since the last lookup
+            self.lookupHeading = self.currHeading
+
+        if self.lookupCoords is None:
+            lookup = True
+        elif haversine(
+            self.lookupCoords['latitude'], self.lookupCoords['longitude'],
+            coords['latitude'], coords['longitude']
+        ) >= self.distance:
+            lookup = True
+        else:
+            lookup = (
+                self.currHeading is not None and
+                self.lookupHeading is not None and
+                angleDifference(self.currHeading, self.lookupHeading) >=
+                self.heading
+            )
+
+        if not lookup:
+            self.avoidedLookups += 1
+            return False
+
+        self.lookupCoords = coords
+        self.lookupHeading = self.currHeading
+        self.lookups += 1
+        return True
+
+    def stats(self):
+        """Returns the number of lookups made and avoided"""
+        return {'lookups': self.lookups, 'avoidedLookups': self.avoidedLookups}
+
+
+def createSpeedLimitFetcher(cache=None):
+    """Creates the speed limit fetcher of the configured speed limit
+    provider"""
+    if SPEED_LIMIT_PROVIDER == 'trace':
+        return TraceSpeedLimitFetcher(cache)
+    elif SPEED_LIMIT_PROVIDER == 'offline':
+        return OfflineSpeedLimitFetcher(RoadIndex())
+    return SpeedLimitFetcher(cache)
@@ -0,0 +1,176 @@
+"""
+API Spool
+
+Sends journey and score uploads to the API, spooling them in the database when
+the API is unreachable so that they are not lost. Spooled uploads are replayed
+in batches by a background flusher once the API can be reached again.
+"""
+from threading import Thread, Condition, Lock
+import api
+import db
+from config import CONFIG
+
+SPOOL_BATCH_SIZE = int(CONFIG.get('spoolBatchSize', 50))
+"""Number of spooled uploads retrieved from the database at once"""
+
+SPOOL_RETRY_INTVL = float(CONFIG.get('spoolRetryInterval', 30))  # Seconds
+"""Time waited before trying to replay spooled uploads again"""
+
+SPOOL_MAX_ATTEMPTS = int(CONFIG.get('spoolMaxAttempts', 10))
+"""Number of times the API can fail to handle a spooled upload before it is
+dropped"""
+
+SPOOL_MAX_SCORES = int(CONFIG.get('spoolMaxScores', 10080))
+"""Number of spooled scores kept, a week of accumulated feedback, beyond which
+the oldest are dropped"""
+
+journeyLock = Lock()
+"""Held whilst a journey is sent, so that the flusher and feedback worker
+can't both create the same journey on the API"""
+
+
+# Sending
+# -------------------------------------------------------------------------
+def postJourney(journeyID, data):
+    """Sends a journey update to the API, creating the API journey if it does
+    not yet exist. Returns True if it was sent, False if the API rejected it
+    or None if it could not be sent."""
+    with journeyLock:
+        apiID = db.getJourneyApiID(journeyID)
+        if apiID:
+            return api.updateJourney(apiID, data)
+
+        apiID = api.createJourney(data)
+        if apiID is None or apiID is False:
+            return apiID
+        db.updateJourneyApiID(journeyID, apiID)
+        return True
+
+
+def sendJourney(journeyID, data):
+    """Sends a journey update to the API, spooling it if it could not be
+    sent. Updates rejected by the API are not spooled, as they would be
+    rejected again."""
+    sent = postJourney(journeyID, data)
+    if sent:
+        # Prevent an older spooled update replacing this one when replayed
+        db.deleteSpooledJourney(journeyID)
+    elif sent is None and CONFIG['apiURL']:
+        db.spoolJourney(journeyID, data)
+
+
+def sendScores(scores):
+    """Sends scores to the API, spooling them if they could not be sent"""
+    if api.addScores(scores) is None and CONFIG['apiURL']:
+        db.spoolScores(scores, SPOOL_MAX_SCORES)
+
+
+def replay(upload):
+    """Sends a spooled upload to the API, returning True if it was sent, False
+    if the API rejected it or None if it could not be sent"""
+    if upload['kind'] == 'journey':
+        return postJourney(upload['journeyID'], upload['payload'])
+    return api.addScores(upload['payload'])
+
+
+# Background Flusher
+# -------------------------------------------------------------------------
+class SpoolFlusher:
+    """Replays spooled uploads on a background thread, retrying at a regular
+    interval whilst the API is unreachable"""
+
+    def __init__(self, retryInterval=SPOOL_RETRY_INTVL,
+            maxAttempts=SPOOL_MAX_ATTEMPTS):
+        self.retryInterval = retryInterval
+        self.maxAttempts = maxAttempts
+        self.replayed = 0
+        """Number of spooled uploads sent"""
+        self.rejected = 0
+        """Number of spooled uploads dropped as the API rejected them"""
+        self.abandoned = 0
+        """Number of spooled uploads dropped after too many failed attempts"""
+        self.failedFlushes = 0
+        """Number of flushes stopped by an upload that could not be sent"""
+        self.running = True
+        self.condition = Condition()
+
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        """Flushes the spool at every retry interval until stopped"""
+        while True:
+            with self.condition:
+                if self.running:
+                    self.condition.wait(self.retryInterval)
+                if not self.running:
+                    return
+
+            try:
+                self.flush()
+            except Exception as e:
+                self.failedFlushes += 1
+                print(f'API spool flush failed: {e!r}')
+
+    def flush(self):
+        """Replays spooled uploads in batches, oldest first, stopping at the
+        first upload that could not be sent. Uploads rejected by the API are
+        dropped rather than blocking the rest of the spool. Returns True if
+        the spool was emptied."""
+        while True:
+            uploads = db.getSpooled(SPOOL_BATCH_SIZE)
+            finished = []
+            for upload in uploads:
+                sent = replay(upload)
+                if sent is None and not self.abandon(upload):
+                    break
+
+                finished.append(upload['id'])
+                if sent:
+                    self.replayed += 1
+                elif sent is False:
+                    self.rejected += 1
+                    print(f'Dropped spooled {upload["kind"]} upload rejected '
+                        'by the API')
+
+            if finished:
+                db.deleteSpooled(finished)
+
+            if len(finished) < len(uploads):
+                self.failedFlushes += 1
+                return False
+            if len(uploads) < SPOOL_BATCH_SIZE:
+                return True
+
+    def abandon(self, upload):
+        """Counts a failed attempt to replay an upload, returning True if it
+        should be dropped as the API has failed to handle it too many times.
+        Attempts whilst the API is unreachable aren't counted, so uploads are
+        kept for as long as the device is offline."""
+        if api.breaker.isOpen():
+            return False
+
+        if upload['attempts'] + 1 < self.maxAttempts:
+            db.recordSpoolAttempt(upload['id'])
+            return False
+
+        self.abandoned += 1
+        print(f'Dropped spooled {upload["kind"]} upload after '
+            f'{self.maxAttempts} failed attempts')
+        return True
+
+    def stats(self):
+        """Returns the replay statistics of the flusher"""
+        return {
+            'replayed': self.replayed,
+            'rejected': self.rejected,
+            'abandoned': self.abandoned,
+            'failedFlushes': self.failedFlushes,
+            'pending': db.getSpooledCount()
+        }
+
+    def stop(self):
+        """Stops the background thread after any flush in progress"""
+        with self.condition:
+            self.running = False
+            self.condition.notify()
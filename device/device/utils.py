@@ -4,8 +4,79 @@ Utility functions
 Provides simple helper/utility functions that are used throughout the programs
 modules and do not alter its state.
 """
+import math
+
+EARTH_RADIUS = 6371000  # Metres
 
 
 def kmhToMps(kmh):
     """Converts kilometers/hour to metres/second"""
     return kmh * (5 / 18)
+
+
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+
+def geohash(latitude, longitude, precision):
+    """Encodes coordinates as a geohash of a given number of characters, each
+    character narrowing the cell containing the coordinates"""
+    latRange = [-90.0, 90.0]
+    lonRange = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    bitCount = 0
+    isLon = True
+
+    while len(chars) < precision:
+        # Bits alternate between halving the longitude and latitude ranges
+        value, valueRange = (
+            (longitude, lonRange) if isLon else (latitude, latRange))
+        mid = (valueRange[0] + valueRange[1]) / 2
+        bits <<= 1
+        if value >= mid:
+            bits |= 1
+            valueRange[0] = mid
+        else:
+            valueRange[1] = mid
+        isLon = not isLon
+        bitCount += 1
+
+        if bitCount == 5:
+            chars.append(GEOHASH_ALPHABET[bits])
+            bits = 0
+            bitCount = 0
+
+    return ''.join(chars)
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """Calculates the great-circle distance in metres between two
+    coordinates"""
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    a = (
+        math.sin((phi2 - phi1) / 2) ** 2 +
+        math.cos(phi1) * math.cos(phi2) *
+        math.sin(math.radians(lon2 - lon1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
+
+def bearing(lat1, lon1, lat2, lon2):
+    """Calculates the initial bearing in degrees clockwise from north when
+    travelling from one coordinate to another"""
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    deltaLon = math.radians(lon2 - lon1)
+    x = math.sin(deltaLon) * math.cos(phi2)
+    y = (
+        math.cos(phi1) * math.sin(phi2) -
+        math.sin(phi1) * math.cos(phi2) * math.cos(deltaLon)
+    )
+    return math.degrees(math.atan2(x, y)) % 360
+
+
+def angleDifference(angle1, angle2):
+    """Calculates the smallest difference in degrees between two angles"""
+    difference = abs(angle1 - angle2) % 360
+    return 360 - difference if difference > 180 else difference
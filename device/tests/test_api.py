@@ -0,0 +1,202 @@
+import pytest
+import gzip
+import json
+from threading import Thread
+from unittest import mock
+import requests.exceptions as reqExcs
+import device  # noqa: F401
+import api
+import circuit_breaker as cb
+
+
+# Before Each
+# ------------------------------------------------------------------------
+@pytest.fixture(autouse=True)
+def mockConfig():
+    config = {'apiURL': 'http://api.test', 'apiAccessToken': 'token'}
+    with mock.patch('api.CONFIG', config):
+        yield config
+
+
+@pytest.fixture(autouse=True)
+def breaker():
+    with mock.patch('api.breaker', cb.CircuitBreaker()) as breaker:
+        yield breaker
+
+
+@pytest.fixture
+def requestMock():
+    with mock.patch.object(api.getSession(), 'request') as requestMock:
+        requestMock.return_value = mockResponse()
+        yield requestMock
+
+
+# Helpers
+# ------------------------------------------------------------------------
+def mockResponse(ok=True, data=None, statusCode=None):
+    """Returns a mock API response"""
+    response = mock.Mock()
+    response.ok = ok
+    response.status_code = statusCode or (200 if ok else 500)
+    response.json.return_value = data
+    return response
+
+
+def sentJSON(requestMock):
+    """Returns the JSON body of the last request sent"""
+    kwargs = requestMock.call_args[1]
+    body = kwargs['data']
+    if kwargs['headers'].get('Content-Encoding') == 'gzip':
+        body = gzip.decompress(body)
+    return json.loads(body)
+
+
+# Tests
+# ------------------------------------------------------------------------
+# createSession
+# -----------------------------------
+class Test_createSession:
+    def test_authorization(self):
+        session = api.createSession()
+        assert session.headers['Authorization'] == 'Bearer token'
+
+    def test_noAccessToken(self, mockConfig):
+        del mockConfig['apiAccessToken']
+        assert 'Authorization' not in api.createSession().headers
+
+    def test_poolSize(self):
+        with mock.patch('api.API_POOL_SIZE', 4):
+            session = api.createSession()
+        adapter = session.get_adapter('https://api.test')
+        assert adapter._pool_maxsize == 4
+
+
+# getSession
+# -----------------------------------
+class Test_getSession:
+    def test_reusedWithinThread(self):
+        assert api.getSession() is api.getSession()
+
+    def test_sessionPerThread(self):
+        sessions = []
+        thread = Thread(target=lambda: sessions.append(api.getSession()))
+        thread.start()
+        thread.join()
+        assert sessions[0] is not api.getSession()
+
+
+# apiRequest
+# -----------------------------------
+class Test_apiRequest:
+    def test_baseCase(self, requestMock):
+        api.apiRequest('POST', '/scores', {'ecoDriving': 80})
+        args, kwargs = requestMock.call_args
+        assert args == ('POST', 'http://api.test/scores')
+        assert kwargs['headers'] == {'Content-Type': 'application/json'}
+        assert sentJSON(requestMock) == {'ecoDriving': 80}
+
+    def test_gzip(self, requestMock):
+        with mock.patch('api.API_GZIP', True):
+            api.apiRequest('POST', '/scores', {'ecoDriving': 80})
+        assert requestMock.call_args[1]['headers'] == {
+            'Content-Type': 'application/json',
+            'Content-Encoding': 'gzip'
+        }
+        assert sentJSON(requestMock) == {'ecoDriving': 80}
+
+    def test_failsFastWhilstOpen(self, breaker, requestMock):
+        requestMock.side_effect = reqExcs.ConnectTimeout
+        for _ in range(breaker.failureThreshold):
+            with pytest.raises(reqExcs.ConnectTimeout):
+                api.apiRequest('POST', '/scores', {'ecoDriving': 80})
+        assert breaker.isOpen()
+        with pytest.raises(cb.CircuitOpenError):
+            api.apiRequest('POST', '/scores', {'ecoDriving': 80})
+        assert requestMock.call_count == breaker.failureThreshold
+
+    def test_responseClosesBreaker(self, breaker, requestMock):
+        requestMock.return_value = mockResponse(ok=False, statusCode=400)
+        api.apiRequest('POST', '/scores', {'ecoDriving': 80})
+        breaker.recordFailure()
+        assert not breaker.isOpen(), """
+            Client error response counted as the API being unreachable
+        """
+
+    def test_serverErrorOpensBreaker(self, breaker, requestMock):
+        requestMock.return_value = mockResponse(ok=False, statusCode=503)
+        for _ in range(breaker.failureThreshold):
+            api.apiRequest('POST', '/scores', {'ecoDriving': 80})
+        assert breaker.isOpen()
+
+
+# API Calls
+# -----------------------------------
+class Test_createJourney:
+    def test_baseCase(self, requestMock):
+        requestMock.return_value = mockResponse(data={'id': 5})
+        assert api.createJourney({'distance': 2}) == 5
+        assert requestMock.call_args[0] == (
+            'POST', 'http://api.test/journeys')
+        assert api.lastRequestSuccessful is True
+
+    def test_failed(self, requestMock):
+        requestMock.return_value = mockResponse(ok=False)
+        assert api.createJourney({'distance': 2}) is None
+        assert api.lastRequestSuccessful is False
+
+    def test_rejected(self, requestMock):
+        requestMock.return_value = mockResponse(ok=False, statusCode=400)
+        assert api.createJourney({'distance': 2}) is False
+
+    def test_noApiURL(self, mockConfig, requestMock):
+        mockConfig['apiURL'] = ''
+        assert api.createJourney({'distance': 2}) is None
+        requestMock.assert_not_called()
+
+
+class Test_updateJourney:
+    def test_baseCase(self, requestMock):
+        assert api.updateJourney(5, {'distance': 2}) is True
+        assert requestMock.call_args[0] == (
+            'PUT', 'http://api.test/journeys/5')
+        assert sentJSON(requestMock) == {'distance': 2}
+        assert api.lastRequestSuccessful is True
+
+    def test_rejected(self, requestMock):
+        requestMock.return_value = mockResponse(ok=False, statusCode=404)
+        assert api.updateJourney(5, {'distance': 2}) is False
+
+
+class Test_addScores:
+    def test_baseCase(self, requestMock):
+        assert api.addScores({'ecoDriving': 80}) is True
+        assert requestMock.call_args[0] == ('POST', 'http://api.test/scores')
+
+    def test_failed(self, requestMock):
+        requestMock.return_value = mockResponse(ok=False)
+        assert api.addScores({'ecoDriving': 80}) is None
+        assert api.lastRequestSuccessful is False
+
+    @pytest.mark.parametrize('statusCode, expectedResult', [
+        (400, False),
+        (422, False),
+        (408, None),
+        (429, None),
+        (503, None),
+    ])
+    def test_rejected(self, requestMock, statusCode, expectedResult):
+        requestMock.return_value = mockResponse(
+            ok=False, statusCode=statusCode)
+        assert api.addScores({'ecoDriving': 80}) is expectedResult
+
+    def test_connectionError(self, requestMock):
+        requestMock.side_effect = reqExcs.ConnectionError
+        api.addScores({'ecoDriving': 80})
+        assert api.lastRequestSuccessful is False
+
+    def test_circuitOpen(self, breaker, requestMock):
+        breaker.state = cb.OPEN
+        breaker.retryTime = float('inf')
+        assert api.addScores({'ecoDriving': 80}) is None
+        assert api.lastRequestSuccessful is False
+        requestMock.assert_not_called()
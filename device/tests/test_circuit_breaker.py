@@ -0,0 +1,80 @@
+import pytest
+from unittest import mock
+import device  # noqa: F401
+import circuit_breaker as cb
+
+
+# Helpers
+# ------------------------------------------------------------------------
+@pytest.fixture
+def breaker():
+    return cb.CircuitBreaker(failureThreshold=2, baseBackoff=5, maxBackoff=15)
+
+
+def openBreaker(breaker, now=100):
+    """Records enough failures at the given time to open the breaker"""
+    with mock.patch('time.time', return_value=now):
+        for _ in range(breaker.failureThreshold):
+            breaker.allow()
+            breaker.recordFailure()
+
+
+# Tests
+# ------------------------------------------------------------------------
+class Test_CircuitBreaker:
+    def test_closed(self, breaker):
+        breaker.recordFailure()
+        assert breaker.state == cb.CLOSED
+        assert breaker.allow() is True
+
+    def test_opensAtThreshold(self, breaker):
+        openBreaker(breaker)
+        assert breaker.state == cb.OPEN
+        assert breaker.isOpen()
+        with mock.patch('time.time', return_value=104.9):
+            assert breaker.allow() is False
+        assert breaker.rejectedRequests == 1
+
+    def test_successResetsFailures(self, breaker):
+        breaker.recordFailure()
+        breaker.recordSuccess()
+        breaker.recordFailure()
+        assert breaker.state == cb.CLOSED
+
+    def test_singleProbe(self, breaker):
+        openBreaker(breaker)
+        with mock.patch('time.time', return_value=105):
+            assert breaker.allow() is True
+            assert breaker.state == cb.HALF_OPEN
+            assert breaker.allow() is False, """
+                More than one probe allowed whilst half-open
+            """
+
+    def test_probeSuccessCloses(self, breaker):
+        openBreaker(breaker)
+        with mock.patch('time.time', return_value=105):
+            breaker.allow()
+        breaker.recordSuccess()
+        assert breaker.state == cb.CLOSED
+        assert breaker.failures == 0
+        assert breaker.backoff == 5
+
+    def test_probeFailureBacksOff(self, breaker):
+        openBreaker(breaker)
+        for now, expectedBackoff in [(105, 10), (115, 15), (130, 15)]:
+            with mock.patch('time.time', return_value=now):
+                assert breaker.allow() is True
+                breaker.recordFailure()
+            assert breaker.state == cb.OPEN
+            assert breaker.backoff == expectedBackoff
+            assert breaker.retryTime == now + expectedBackoff
+        assert breaker.timesOpened == 4
+
+    def test_stats(self, breaker):
+        openBreaker(breaker)
+        assert breaker.stats() == {
+            'state': cb.OPEN,
+            'failures': 2,
+            'rejectedRequests': 0,
+            'timesOpened': 1
+        }
@@ -26,3 +26,8 @@ INSERT INTO driving_data (time, journey_id, speed, rpm, fuel_level, altitude, la
     VALUES ('2022-02-02 15:00:00', 3, 10, 11, 12, 13, 14, 15, True, 16);
 INSERT INTO driving_data (time, journey_id, speed, rpm, fuel_level, altitude, latitude, longitude, gsi_is_indicating, speed_limit)
     VALUES ('2022-02-02 20:00:00', 3, 10, 11, 12, 13, 14, 15, True, 16);
+
+
+-- Journey start and end times
+-- ----------------------------------------------
+SELECT refresh_journey_times();
@@ -57,3 +57,8 @@ INSERT INTO journey (passenger_cnt, cargo_weight, roof_att_id)
     VALUES (0, 0, null);
 INSERT INTO driving_data (time, journey_id, speed, rpm, fuel_level, altitude, latitude, longitude, gsi_is_indicating, speed_limit)
     VALUES ('2022-01-01 23:59:59', 9, 0, 0, 0, 0, 0, 0, False, 0);
+
+
+-- Journey start and end times
+-- ----------------------------------------------
+SELECT refresh_journey_times();
@@ -125,4 +125,8 @@ INSERT INTO journey (api_journey_id, passenger_cnt, cargo_weight, roof_att_id)
 -- ----------------------------------------------
 -- JourneyID: 7
 INSERT INTO journey (passenger_cnt, cargo_weight, roof_att_id)
-    VALUES (0, 0, null);
\ No newline at end of file
+    VALUES (0, 0, null);
+
+-- Journey start and end times
+-- ----------------------------------------------
+SELECT refresh_journey_times();
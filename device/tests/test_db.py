@@ -1,6 +1,8 @@
 import pytest
+from unittest import mock
 import time
 from pathlib import Path
+from threading import Thread, Event
 from freezegun import freeze_time
 from datetime import datetime, timedelta
 import device  # noqa: F401
@@ -12,6 +14,7 @@ import db
 @pytest.fixture(autouse=True)
 def dbBeforeEachAndAfterEach():
     yield
+    db.cur.execute('DELETE FROM api_spool')
     db.cur.execute('DELETE FROM driving_data')
     db.cur.execute('DELETE FROM journey')
     db.cur.execute('DELETE FROM roof_att')
@@ -432,6 +435,68 @@ class Test_getJourneyDrivingData:
         assert db.getJourneyDrivingData(journeyID) == expectedDrivingData
 
 
+# iterJourneyDrivingData
+# -----------------------------------
+class Test_iterJourneyDrivingData:
+    @pytest.mark.parametrize('journeyID', [1, 2, 3])
+    @pytest.mark.parametrize('itersize', [1, 2, db.DRIVING_DATA_ITERSIZE])
+    def test_baseCase(self, journeyID, itersize):
+        executeSQLFile('test_data/db/getJourneyDrivingData.sql')
+        assert (
+            list(db.iterJourneyDrivingData(journeyID, itersize)) ==
+            db.getJourneyDrivingData(journeyID)
+        )
+
+    def test_commitWhilstStreaming(self):
+        executeSQLFile('test_data/db/getJourneyDrivingData.sql')
+        drivingData = []
+        for data in db.iterJourneyDrivingData(3, itersize=1):
+            db.getJourneyApiID(3)  # Commits the connection's transaction
+            drivingData.append(data)
+        assert drivingData == db.getJourneyDrivingData(3), """
+            Streaming is interrupted by a commit on the same connection
+        """
+
+    def test_unlockedBetweenBatches(self):
+        executeSQLFile('test_data/db/getJourneyDrivingData.sql')
+        stream = db.iterJourneyDrivingData(3, itersize=1)
+        next(stream)
+
+        acquired = Event()
+
+        def acquireLock():
+            if db.lock.acquire(timeout=1):
+                acquired.set()
+                db.lock.release()
+
+        thread = Thread(target=acquireLock)
+        thread.start()
+        thread.join()
+        assert acquired.is_set(), "Lock held between batches"
+
+        stream.close()
+        db.cur.execute("SELECT COUNT(*) FROM pg_cursors WHERE name LIKE "
+            "'driving_data_stream_%'")
+        assert db.cur.fetchone()[0] == 0, """
+            Abandoned stream's cursor left open
+        """
+
+
+# getJourneysDrivingData
+# -----------------------------------
+class Test_getJourneysDrivingData:
+    def test_baseCase(self):
+        executeSQLFile('test_data/db/getJourneyDrivingData.sql')
+        expected = (
+            db.getJourneyDrivingData(3) + db.getJourneyDrivingData(2)
+        )
+        expected.sort(key=lambda data: (data['journeyID'], data['time']))
+        assert list(db.getJourneysDrivingData([3, 1, 2])) == expected
+
+    def test_noJourneyIDs(self):
+        assert list(db.getJourneysDrivingData([])) == []
+
+
 # createDrivingData
 # -----------------------------------
 class Test_createDrivingData:
@@ -472,6 +537,13 @@ class Test_createDrivingData:
             113
         )
 
+    def test_updatesJourneyTimes(self, mockJourney):
+        ts = time.time()
+        db.createDrivingData(mockDrivingDataEntry(ts, mockJourney['id']))
+        db.createDrivingData(mockDrivingDataEntry(ts + 5, mockJourney['id']))
+        assert journeyTimes(mockJourney['id']) == (
+            datetime.fromtimestamp(ts), datetime.fromtimestamp(ts + 5))
+
     def test_noSpdLim(self, mockJourney):
         ts = time.time()
         datetimeTs = datetime.fromtimestamp(ts)
@@ -508,3 +580,339 @@ class Test_createDrivingData:
             True,
             None
         ), "Doesn't return correctly when speed limit is None"
+
+
+# drivingDataToRow
+# -----------------------------------
+class Test_drivingDataToRow:
+    def test_baseCase(self):
+        ts = time.time()
+        assert db.drivingDataToRow(mockDrivingDataEntry(ts, 7)) == (
+            datetime.fromtimestamp(ts), 7, True, 45.55, 2000, 65.55, 22.22,
+            50.894064, -0.999009, True, 113
+        )
+
+    @pytest.mark.parametrize('speedLimit, expectedSpeedLimit', [
+        (112.654, 113),
+        (48.28032, 48),
+        (32.5, 33),
+        (None, None),
+    ])
+    def test_roundsSpeedLimit(self, speedLimit, expectedSpeedLimit):
+        data = mockDrivingDataEntry(time.time(), 7)
+        data['speedLimit'] = speedLimit
+        assert db.drivingDataToRow(data)[-1] == expectedSpeedLimit
+
+
+# DrivingDataBuffer
+# -----------------------------------
+def mockDrivingDataEntry(ts, journeyID):
+    return {
+        'obdData': {
+            'time': ts,
+            'speed': 45.55,
+            'rpm': 2000,
+            'fuelLevel': 65.55,
+            'alt': 22.22
+        },
+        'journeyID': journeyID,
+        'engineOn': True,
+        'coords': {
+            'latitude': 50.894064,
+            'longitude': -0.999009
+        },
+        'gsiIsIndicating': True,
+        'speedLimit': 113
+    }
+
+
+def journeyTimes(journeyID):
+    db.cur.execute(
+        'SELECT start_time, end_time FROM journey WHERE journey_id=%s',
+        [journeyID]
+    )
+    db.conn.commit()
+    return db.cur.fetchone()
+
+
+def drivingDataCount():
+    db.cur.execute('SELECT COUNT(*) FROM driving_data')
+    db.conn.commit()
+    return db.cur.fetchone()[0]
+
+
+class Test_DrivingDataBuffer:
+    def test_belowThresholds(self, mockJourney):
+        buffer = db.DrivingDataBuffer(maxRows=3, maxAge=60)
+        buffer.add(mockDrivingDataEntry(time.time(), mockJourney['id']))
+        buffer.add(mockDrivingDataEntry(time.time() + 1, mockJourney['id']))
+        assert drivingDataCount() == 0, """
+            Driving data written before a flush threshold was reached
+        """
+        assert len(buffer.rows) == 2
+
+    def test_maxRows(self, mockJourney):
+        buffer = db.DrivingDataBuffer(maxRows=3, maxAge=60)
+        for i in range(3):
+            ts = time.time() + i
+            buffer.add(mockDrivingDataEntry(ts, mockJourney['id']))
+        assert drivingDataCount() == 3
+        assert buffer.rows == []
+
+    def test_maxAge(self, mockJourney):
+        buffer = db.DrivingDataBuffer(maxRows=100, maxAge=30)
+        with mock.patch('time.monotonic', return_value=0):
+            buffer.add(mockDrivingDataEntry(time.time(), mockJourney['id']))
+        with mock.patch('time.monotonic', return_value=30):
+            ts = time.time() + 1
+            buffer.add(mockDrivingDataEntry(ts, mockJourney['id']))
+        assert drivingDataCount() == 2
+
+    def test_flush(self, mockJourney):
+        ts = time.time()
+        buffer = db.DrivingDataBuffer(maxRows=100, maxAge=60)
+        buffer.add(mockDrivingDataEntry(ts, mockJourney['id']))
+        buffer.flush()
+        db.cur.execute('SELECT * FROM driving_data WHERE time=%s',
+            [datetime.fromtimestamp(ts)])
+        assert db.cur.fetchone() == db.drivingDataToRow(
+            mockDrivingDataEntry(ts, mockJourney['id']))
+
+    def test_updatesJourneyTimes(self, mockJourney):
+        ts = time.time()
+        buffer = db.DrivingDataBuffer(maxRows=100, maxAge=60)
+        for secs in [0, 2, 1]:
+            buffer.add(mockDrivingDataEntry(ts + secs, mockJourney['id']))
+        assert journeyTimes(mockJourney['id']) == (None, None)
+        buffer.flush()
+        assert journeyTimes(mockJourney['id']) == (
+            datetime.fromtimestamp(ts), datetime.fromtimestamp(ts + 2))
+
+    def test_flushDeferredWhilstLocked(self, mockJourney):
+        buffer = db.DrivingDataBuffer(maxRows=1, maxAge=60)
+        locked = Event()
+        release = Event()
+
+        def holdLock():
+            with db.lock:
+                locked.set()
+                release.wait()
+
+        thread = Thread(target=holdLock)
+        thread.start()
+        locked.wait()
+        buffer.add(mockDrivingDataEntry(time.time(), mockJourney['id']))
+        release.set()
+        thread.join()
+        assert buffer.deferredFlushes == 1
+        assert len(buffer.rows) == 1
+
+        buffer.add(mockDrivingDataEntry(time.time() + 1, mockJourney['id']))
+        assert buffer.rows == []
+        assert drivingDataCount() == 2
+
+    def test_flushEmpty(self):
+        buffer = db.DrivingDataBuffer()
+        buffer.flush()
+        assert buffer.flushCount == 0
+
+    def test_stats(self, mockJourney):
+        buffer = db.DrivingDataBuffer(maxRows=2, maxAge=60)
+        for i in range(5):
+            ts = time.time() + i
+            buffer.add(mockDrivingDataEntry(ts, mockJourney['id']))
+        stats = buffer.stats()
+        assert stats['flushes'] == 2
+        assert stats['rows'] == 4
+        assert stats['bufferedRows'] == 1
+        assert stats['lastFlushRows'] == 2
+        assert stats['meanRowsPerFlush'] == 2
+        assert stats['maxFlushLatency'] >= stats['lastFlushLatency'] > 0
+
+
+# Journey Performance
+# -----------------------------------
+def mockJourneyPerfSummary(journeyID):
+    summary = {
+        'journeyID': journeyID,
+        'drivingDataCount': 20,
+        'startTime': datetime.fromisoformat('2022-02-01 00:00:00'),
+        'endTime': datetime.fromisoformat('2022-02-01 00:10:00'),
+        'travelTime': 600,
+        'idleTime': 30.5,
+        'distance': 2.25,
+    }
+    for i, (name, _) in enumerate(db.JOURNEY_PERF_MEANS):
+        summary[name] = {'value': i + 0.5, 'count': i}
+    summary['motorwaySpd'] = {'value': None, 'count': 0}
+    return summary
+
+
+class Test_journeyPerformanceRowToDict:
+    def test_baseCase(self):
+        row = (
+            1, 20, datetime.fromisoformat('2022-02-01 00:00:00'),
+            datetime.fromisoformat('2022-02-01 00:10:00'), 600, 30.5, 2.25,
+            0.5, 0, 1.5, 1, 2.5, 2, 3.5, 3, 4.5, 4, None, 0, 6.5, 6
+        )
+        assert db.journeyPerformanceRowToDict(row) == mockJourneyPerfSummary(1)
+
+
+class Test_getJourneyPerformances:
+    def test_noSummaries(self, mockJourney):
+        assert db.getJourneyPerformances([mockJourney['id']]) == {}
+
+    def test_noJourneyIDs(self):
+        assert db.getJourneyPerformances([]) == {}
+
+
+class Test_calcJourneyPerformances:
+    def test_baseCase(self):
+        executeSQLFile('test_data/db/getJourneyDrivingData.sql')
+        summaries = db.calcJourneyPerformances([3, 1, 2])
+        assert list(summaries) == [2, 3]
+        assert summaries[2]['drivingDataCount'] == len(
+            db.getJourneyDrivingData(2))
+        assert summaries[2]['startTime'] == db.getJourneyDrivingData(2)[0][
+            'time']
+
+    def test_noDrivingData(self, mockJourney):
+        assert db.calcJourneyPerformances([mockJourney['id']]) == {}
+
+    def test_noJourneyIDs(self):
+        assert db.calcJourneyPerformances([]) == {}
+
+
+class Test_createJourneyPerformance:
+    def test_baseCase(self, mockJourney):
+        summary = mockJourneyPerfSummary(mockJourney['id'])
+        db.createJourneyPerformance(summary)
+        assert db.getJourneyPerformances([mockJourney['id'], 0]) == {
+            mockJourney['id']: summary
+        }
+
+    def test_replacesExisting(self, mockJourney):
+        summary = mockJourneyPerfSummary(mockJourney['id'])
+        db.createJourneyPerformance(summary)
+        summary['distance'] = 4.5
+        summary['gsiAdh'] = {'value': 80, 'count': 10}
+        db.createJourneyPerformance(summary)
+        assert db.getJourneyPerformances([mockJourney['id']]) == {
+            mockJourney['id']: summary
+        }
+
+
+# Daily Driving Data Rollups
+# ------------------------------------------------------------------------
+class Test_getJourneysDailyDrivingData:
+    def test_baseCase(self):
+        executeSQLFile('test_data/db/getJourneyDrivingData.sql')
+        rollups = db.getJourneysDailyDrivingData([2])
+        drivingData = db.getJourneyDrivingData(2)
+        assert [rollup['journeyID'] for rollup in rollups] == [2] * len(
+            rollups)
+        assert sum(rollup['drivingDataCount'] for rollup in rollups) == len(
+            drivingData)
+        assert sum(rollup['speedSum'] for rollup in rollups) == pytest.approx(
+            sum(data['speed'] for data in drivingData), rel=1e-6)
+
+    def test_noJourneyIDs(self):
+        assert db.getJourneysDailyDrivingData([]) == []
+
+    def test_counts(self, mockJourney):
+        db.createDrivingData(
+            mockDrivingDataEntry(time.time(), mockJourney['id']))
+        rollup = db.getJourneysDailyDrivingData([mockJourney['id']])[0]
+        assert rollup['day'].date() == datetime.now().date()
+        assert rollup['drivingDataCount'] == 1
+        assert rollup['gsiCount'] == 1
+        assert rollup['gsiAdhCount'] == 0
+        assert rollup['spdLimCount'] == 1
+        assert rollup['spdLimAdhCount'] == 1
+        assert rollup['motorwayCount'] == 1
+        assert rollup['motorwaySpdSum'] == pytest.approx(45.55)
+        assert rollup['idleCount'] == 0
+
+
+class Test_getDailyDrivingData:
+    def test_baseCase(self, mockJourney):
+        db.createDrivingData(
+            mockDrivingDataEntry(time.time(), mockJourney['id']))
+        rollups = db.getDailyDrivingData(1)
+        assert rollups[-1]['day'].date() == datetime.now().date()
+        assert rollups[-1]['drivingDataCount'] >= 1
+
+
+# API Spool
+# ------------------------------------------------------------------------
+class Test_spoolJourney:
+    def test_baseCase(self, mockJourney):
+        db.spoolJourney(mockJourney['id'], {'distance': 2})
+        [upload] = db.getSpooled(10)
+        assert upload['kind'] == 'journey'
+        assert upload['journeyID'] == mockJourney['id']
+        assert upload['payload'] == {'distance': 2}
+
+    def test_collapsesUpdates(self, mockJourney):
+        db.spoolJourney(mockJourney['id'], {'distance': 2})
+        db.spoolJourney(mockJourney['id'], {'distance': 5})
+        uploads = db.getSpooled(10)
+        assert [upload['payload'] for upload in uploads] == [
+            {'distance': 5}], "Journey has more than one spooled update"
+
+
+class Test_spoolScores:
+    def test_keepsEveryUpload(self):
+        db.spoolScores({'ecoDriving': 70})
+        db.spoolScores({'ecoDriving': 75})
+        assert [upload['payload'] for upload in db.getSpooled(10)] == [
+            {'ecoDriving': 70}, {'ecoDriving': 75}]
+        assert db.getSpooledCount() == 2
+
+    def test_maxScores(self):
+        for score in [70, 75, 80]:
+            db.spoolScores({'ecoDriving': score}, maxScores=2)
+        assert [upload['payload'] for upload in db.getSpooled(10)] == [
+            {'ecoDriving': 75}, {'ecoDriving': 80}]
+
+
+class Test_getSpooled:
+    def test_limit(self, mockJourney):
+        db.spoolScores({'ecoDriving': 70})
+        db.spoolJourney(mockJourney['id'], {'distance': 2})
+        db.spoolScores({'ecoDriving': 75})
+        uploads = db.getSpooled(2)
+        assert [upload['kind'] for upload in uploads] == ['scores', 'journey']
+
+
+class Test_recordSpoolAttempt:
+    def test_baseCase(self, mockJourney):
+        db.spoolJourney(mockJourney['id'], {'distance': 2})
+        [upload] = db.getSpooled(10)
+        assert upload['attempts'] == 0
+        db.recordSpoolAttempt(upload['id'])
+        assert db.getSpooled(10)[0]['attempts'] == 1
+
+    def test_newUpdateResetsAttempts(self, mockJourney):
+        db.spoolJourney(mockJourney['id'], {'distance': 2})
+        db.recordSpoolAttempt(db.getSpooled(10)[0]['id'])
+        db.spoolJourney(mockJourney['id'], {'distance': 5})
+        assert db.getSpooled(10)[0]['attempts'] == 0
+
+
+class Test_deleteSpooled:
+    def test_baseCase(self):
+        db.spoolScores({'ecoDriving': 70})
+        db.spoolScores({'ecoDriving': 75})
+        first = db.getSpooled(1)[0]
+        db.deleteSpooled([first['id']])
+        assert [upload['payload'] for upload in db.getSpooled(10)] == [
+            {'ecoDriving': 75}]
+
+
+class Test_deleteSpooledJourney:
+    def test_keepsScores(self, mockJourney):
+        db.spoolScores({'ecoDriving': 70})
+        db.spoolJourney(mockJourney['id'], {'distance': 2})
+        db.deleteSpooledJourney(mockJourney['id'])
+        assert [upload['kind'] for upload in db.getSpooled(10)] == ['scores']
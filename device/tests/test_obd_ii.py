@@ -0,0 +1,115 @@
+import pytest
+import json
+import asyncio
+from unittest import mock
+import device  # noqa: F401
+import obd_ii
+
+
+# Helpers
+# ------------------------------------------------------------------------
+def runWithServer(respond, test):
+    """Runs an async test against a local server speaking the OBD2 AC app's
+    protocol, which responds to each message using the given function"""
+    async def handle(reader, writer):
+        while True:
+            try:
+                header = await reader.readexactly(obd_ii.HEADER_SIZE)
+                msg = await reader.readexactly(int(header.decode()))
+            except asyncio.IncompleteReadError:
+                break
+            if msg == b'!disconnect':
+                break
+            response = respond(msg.decode())
+            if response is None:
+                break
+            writer.write(obd_ii.encodeMessage(response))
+            await writer.drain()
+        writer.close()
+
+    async def run():
+        server = await asyncio.start_server(handle, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        with mock.patch('obd_ii.SERVER_HOST', '127.0.0.1'), \
+                mock.patch('obd_ii.SERVER_PORT', port):
+            try:
+                return await test()
+            finally:
+                server.close()
+
+    return asyncio.run(run())
+
+
+def batchedResponse(msg):
+    """Responds to a batched query with each PID's value set to its PID"""
+    return json.dumps({pid: pid for pid in json.loads(msg)})
+
+
+# Tests
+# ------------------------------------------------------------------------
+# encodeMessage
+# -----------------------------------
+def test_encodeMessage():
+    msg = obd_ii.encodeMessage('0C')
+    assert len(msg) == obd_ii.HEADER_SIZE + 2
+    assert msg[:obd_ii.HEADER_SIZE].decode().strip() == '2'
+    assert msg[obd_ii.HEADER_SIZE:] == b'0C'
+
+
+# AsyncEmulatorClient
+# -----------------------------------
+class Test_AsyncEmulatorClient:
+    def test_queryMany(self):
+        async def test():
+            client = obd_ii.AsyncEmulatorClient()
+            await client.connect()
+            msg = await client.queryMany(['0C', '0D'])
+            await client.disconnect()
+            return msg
+
+        msg = runWithServer(batchedResponse, test)
+        assert json.loads(msg) == {'0C': '0C', '0D': '0D'}
+
+    def test_largeMessage(self):
+        async def test():
+            client = obd_ii.AsyncEmulatorClient()
+            await client.connect()
+            msg = await client.query('0C')
+            await client.disconnect()
+            return msg
+
+        msg = runWithServer(lambda msg: 'x' * 100000, test)
+        assert len(msg) == 100000
+
+    def test_connectionClosed(self):
+        async def test():
+            client = obd_ii.AsyncEmulatorClient()
+            await client.connect()
+            return await client.query('0C')
+
+        assert runWithServer(lambda msg: None, test) is None
+
+
+# AsyncEmulatedOBD
+# -----------------------------------
+class Test_AsyncEmulatedOBD:
+    def test_query_many(self):
+        async def test():
+            obdConn = await obd_ii.AsyncOBDConnect()
+            assert obdConn.is_connected
+            responses = await obdConn.query_many([
+                obd_ii.obd.commands.RPM, obd_ii.obd.commands.SPEED])
+            await obdConn.close()
+            assert not obdConn.is_connected
+            return responses
+
+        responses = runWithServer(batchedResponse, test)
+        assert [response.value for response in responses] == ['12', '13']
+
+    def test_disconnected(self):
+        async def test():
+            obdConn = await obd_ii.AsyncOBDConnect()
+            with pytest.raises(BrokenPipeError):
+                await obdConn.query_many([obd_ii.obd.commands.RPM])
+
+        runWithServer(lambda msg: None, test)
@@ -1,4 +1,6 @@
 import pytest
+import time
+import json
 from unittest import mock
 from pathlib import Path
 from datetime import datetime
@@ -41,6 +43,41 @@ def dtFromISO(iso):
     return datetime.fromisoformat(iso)
 
 
+def mockDrivingData(secs, speed, engineOn=True):
+    """Returns a mock driving data entry"""
+    return {
+        'time': secsToDatetime(secs),
+        'engineOn': engineOn,
+        'speed': speed,
+        'gsiIndicating': None,
+        'spdLim': None
+    }
+
+
+def assertSamePerformance(journey, expected):
+    """Asserts that two journeys have the same performance statistics"""
+    for attr in ['drivingDataCount', 'startTime', 'endTime', 'travelTime']:
+        assert getattr(journey, attr) == getattr(expected, attr), \
+            f"{attr} doesn't match"
+
+    for attr in ['idleTime', 'distance']:
+        assert getattr(journey, attr) == pytest.approx(
+            getattr(expected, attr)), f"{attr} doesn't match"
+
+    for attr in [
+        'drivAccSmoothness', 'startAccSmoothness', 'decSmoothness', 'gsiAdh',
+        'spdLimAdh', 'motorwaySpd', 'idleDur'
+    ]:
+        mean = getattr(journey, attr)
+        expectedMean = getattr(expected, attr)
+        assert mean.count == expectedMean.count, f"{attr} count doesn't match"
+        if expectedMean.value is None:
+            assert mean.value is None, f"{attr} doesn't match"
+        else:
+            assert pytest.approx(mean.value) == expectedMean.value, \
+                f"{attr} doesn't match"
+
+
 # Mean Tests
 # ------------------------------------------------------------------------
 class Test_Mean:
@@ -97,6 +134,45 @@ class Test_Mean:
             assert pytest.approx(mean1.value, rel=1e-6) == expectedMean
 
 
+# rollupMeans Tests
+# ------------------------------------------------------------------------
+def mockRollup(counts=(0, 0, 0, 0, 0, 0), motorwaySpdSum=0):
+    """Returns a mock daily driving data rollup"""
+    (gsiCount, gsiAdhCount, spdLimCount, spdLimAdhCount, motorwayCount,
+        idleCount) = counts
+    return {
+        'drivingDataCount': max(counts),
+        'speedSum': motorwaySpdSum,
+        'gsiCount': gsiCount,
+        'gsiAdhCount': gsiAdhCount,
+        'spdLimCount': spdLimCount,
+        'spdLimAdhCount': spdLimAdhCount,
+        'motorwayCount': motorwayCount,
+        'motorwaySpdSum': motorwaySpdSum,
+        'idleCount': idleCount
+    }
+
+
+class Test_rollupMeans:
+    def test_noRollups(self):
+        means = perf.rollupMeans([])
+        assert means['gsiAdh'].value is None
+        assert means['spdLimAdh'].value is None
+        assert means['motorwaySpd'].value is None
+
+    def test_baseCase(self):
+        means = perf.rollupMeans([
+            mockRollup((4, 3, 2, 2, 1, 0), 110),
+            mockRollup((4, 1, 0, 0, 1, 3), 120),
+        ])
+        assert means['gsiAdh'].value == pytest.approx(50)
+        assert means['gsiAdh'].count == 8
+        assert means['spdLimAdh'].value == pytest.approx(100)
+        assert means['spdLimAdh'].count == 2
+        assert means['motorwaySpd'].value == pytest.approx(115)
+        assert means['motorwaySpd'].count == 2
+
+
 # JourneyPerformance Tests
 # ------------------------------------------------------------------------
 class Test_JourneyPerformance:
@@ -468,6 +544,175 @@ class Test_JourneyPerformance:
 
             assert pytest.approx(journey.distance, 1e-6) == expectedDistance
 
+    # addDrivingData
+    # -----------------------------------
+    class Test_addDrivingData:
+        @pytest.mark.parametrize('journeyID', [2, 3, 4, 5])
+        def test_matchesCalcPerformance(self, journeyID):
+            journey = perf.JourneyPerformance(1)
+            for data in db.getJourneyDrivingData(journeyID):
+                journey.addDrivingData(data)
+
+            expected = perf.JourneyPerformance(journeyID)
+            assertSamePerformance(journey, expected)
+
+        def test_pendingIdle(self):
+            journey = perf.JourneyPerformance(1)
+            for secs, speed in [(0, 10), (1, 0), (7, 0)]:
+                journey.addDrivingData(mockDrivingData(secs, speed))
+            assert journey.idleTime == 6, """
+                Idle in progress isn't counted as if the journey has ended
+            """
+            assert journey.idleDur.value == 6
+
+            journey.addDrivingData(mockDrivingData(10, 0))
+            journey.addDrivingData(mockDrivingData(11, 10))
+            assert journey.idleTime == 9, """
+                Idle in progress is counted more than once
+            """
+            assert journey.idleDur.value == 9
+            assert journey.idleDur.count == 1
+
+        def test_heldUntilTravelTime(self):
+            journey = perf.JourneyPerformance(1)
+            journey.addDrivingData(mockDrivingData(0, 10))
+            assert journey.drivingDataCount == 0
+            assert journey.startTime == secsToDatetime(0)
+
+            journey.addDrivingData(mockDrivingData(1, 10))
+            assert journey.drivingDataCount == 2
+            assert journey.travelTime == 1
+            assert pytest.approx(journey.distance, 1e-6) == 0.00277778
+
+        def test_mphSpeedLimitMatchesStored(self):
+            journeyID = db.createJourney()['id']
+            try:
+                journey = perf.JourneyPerformance(journeyID)
+                for secs, speed in [(0, 100), (1, 110), (2, 120)]:
+                    data = {
+                        'obdData': {
+                            'time': secs, 'speed': speed, 'rpm': 2000,
+                            'fuelLevel': 50, 'alt': 10
+                        },
+                        'journeyID': journeyID,
+                        'engineOn': True,
+                        'coords': {'latitude': 50.9, 'longitude': -1},
+                        'gsiIsIndicating': False,
+                        'speedLimit': 70 * 1.609344  # 70 mph
+                    }
+                    db.createDrivingData(data)
+                    journey.addDrivingData(
+                        db.drivingDataRowToDict(db.drivingDataToRow(data)))
+
+                assertSamePerformance(
+                    journey, perf.JourneyPerformance(journeyID))
+                assert journey.motorwaySpd.count == 3
+            finally:
+                for table in ['driving_data', 'journey']:
+                    db.cur.execute(
+                        f'DELETE FROM {table} WHERE journey_id = %s',
+                        (journeyID,))
+                db.conn.commit()
+
+    # calcPerformanceArrays
+    # -----------------------------------
+    class Test_calcPerformanceArrays:
+        @pytest.mark.parametrize('journeyID', [1, 2, 3, 4, 5])
+        def test_matchesPythonEngine(self, journeyID):
+            expected = perf.JourneyPerformance(journeyID)
+            with mock.patch('performance.PERFORMANCE_ENGINE', 'numpy'):
+                journey = perf.JourneyPerformance(journeyID)
+            assertSamePerformance(journey, expected)
+
+        @pytest.mark.parametrize('secsSpeedAndEngineOn', [
+            [(0, 10, True), (1, 0, True), (7, 0, True), (8, 10, True)],
+            [(0, 10, True), (1, 0, True), (7, 0, True), (9, 0, False)],
+            [(0, 0, True), (3, 0, True), (9, 0, True)],
+            [(0, 0, True), (6, 20, True), (8, 0, True), (20, 0, False)],
+            [(0, 5, True), (0, 0, True)],
+        ])
+        def test_idles(self, secsSpeedAndEngineOn):
+            drivingData = [
+                mockDrivingData(*entry) for entry in secsSpeedAndEngineOn
+            ]
+            expected = perf.JourneyPerformance(1, drivingData=drivingData)
+            with mock.patch('performance.PERFORMANCE_ENGINE', 'numpy'):
+                journey = perf.JourneyPerformance(1, drivingData=drivingData)
+            assertSamePerformance(journey, expected)
+            assert journey.heldDrivingData == expected.heldDrivingData
+
+        def test_continuesIncrementally(self):
+            drivingData = [
+                mockDrivingData(0, 10), mockDrivingData(1, 0),
+                mockDrivingData(7, 0)
+            ]
+            with mock.patch('performance.PERFORMANCE_ENGINE', 'numpy'):
+                journey = perf.JourneyPerformance(1, drivingData=drivingData)
+            expected = perf.JourneyPerformance(1, drivingData=drivingData)
+
+            for data in [mockDrivingData(10, 0), mockDrivingData(11, 10)]:
+                journey.addDrivingData(data)
+                expected.addDrivingData(data)
+            assertSamePerformance(journey, expected)
+
+    # journey_performance_stats
+    # -----------------------------------
+    class Test_sqlPerformance:
+        @pytest.mark.parametrize('journeyID', [2, 3, 4, 5])
+        def test_matchesPythonEngine(self, journeyID):
+            summary = db.calcJourneyPerformances([journeyID])[journeyID]
+            journey = perf.JourneyPerformance(journeyID, summary)
+            expected = perf.JourneyPerformance(journeyID)
+            assertSamePerformance(journey, expected)
+
+    # loadRollups
+    # -----------------------------------
+    class Test_loadRollups:
+        @pytest.mark.parametrize('engine', ['python', 'numpy'])
+        @pytest.mark.parametrize('journeyID', [1, 2, 3, 4, 5])
+        def test_matchesDrivingData(self, engine, journeyID):
+            rollups = db.getJourneysDailyDrivingData([journeyID])
+            with mock.patch('performance.PERFORMANCE_ENGINE', engine):
+                journey = perf.JourneyPerformance(journeyID, rollups=rollups)
+            expected = perf.JourneyPerformance(journeyID)
+            assertSamePerformance(journey, expected)
+
+        def test_heldUntilTravelTime(self):
+            journey = perf.JourneyPerformance(
+                1, drivingData=[mockDrivingData(0, 10)],
+                rollups=[mockRollup((1, 1, 0, 0, 0, 0))])
+            assert journey.gsiAdh.value is None
+            assert journey.gsiAdh.count == 0
+
+    # Summary
+    # -----------------------------------
+    class Test_isFinished:
+        def test_noDrivingData(self):
+            assert perf.JourneyPerformance(1).isFinished() is False
+
+        @pytest.mark.parametrize('currentTime, expectedFinished', [
+            ('2022-02-02 00:00:01', False),
+            ('2022-02-02 00:10:00', False),
+            ('2022-02-02 00:10:01', True),
+        ])
+        def test_baseCase(self, currentTime, expectedFinished):
+            journey = perf.JourneyPerformance(3)
+            with freeze_time(dtFromISO(currentTime)):
+                assert journey.isFinished() is expectedFinished
+
+    class Test_summary:
+        @pytest.mark.parametrize('journeyID', [1, 2, 3, 4, 5])
+        def test_roundTrip(self, journeyID):
+            journey = perf.JourneyPerformance(journeyID)
+            loaded = perf.JourneyPerformance(journeyID, journey.toSummary())
+            assertSamePerformance(loaded, journey)
+
+        def test_noDrivingData(self):
+            summary = perf.JourneyPerformance(1).toSummary()
+            assert summary['startTime'] is None
+            assert summary['endTime'] is None
+            assert summary['gsiAdh'] == {'value': None, 'count': 0}
+
     # updateAPI
     # -----------------------------------
     class Test_updateAPI:
@@ -575,6 +820,58 @@ class Test_JourneyPerformance:
             assert db.getJourneyApiID(7) is None
 
 
+# FeedbackWindow Tests
+# ------------------------------------------------------------------------
+def mockFinishedJourney(journeyID, startISO, speeds=(0, 10, 20)):
+    """Returns a mock finished journey starting at the given time with a
+    driving data entry every second"""
+    startSecs = dtFromISO(startISO).timestamp()
+    return perf.JourneyPerformance(journeyID, drivingData=[
+        mockDrivingData(startSecs + secs, speed)
+        for secs, speed in enumerate(speeds)
+    ])
+
+
+class Test_FeedbackWindow:
+    def test_bucketsByStartDate(self):
+        window = perf.FeedbackWindow()
+        window.addJourney(mockFinishedJourney(1, '2022-02-01 23:59:59'))
+        window.addJourney(mockFinishedJourney(2, '2022-02-01 08:00:00'))
+        window.addJourney(mockFinishedJourney(3, '2022-02-02 08:00:00'))
+        assert sorted(window.buckets) == [
+            dtFromISO('2022-02-01').date(), dtFromISO('2022-02-02').date()
+        ]
+        assert window.journeyIDs == {1, 2, 3}
+
+    def test_totals(self):
+        journeys = [
+            mockFinishedJourney(1, '2022-02-01 08:00:00', (0, 10, 20)),
+            mockFinishedJourney(2, '2022-02-02 08:00:00', (30, 10, 0, 0)),
+        ]
+        window = perf.FeedbackWindow()
+        expected = perf.FeedbackTotals()
+        for journey in journeys:
+            window.addJourney(journey)
+            expected.addJourney(journey)
+
+        totals = window.totals()
+        assert totals.journeys == journeys
+        assert totals.drivingDataCount == expected.drivingDataCount
+        for name in perf.FeedbackTotals.MEANS:
+            mean = getattr(totals, name)
+            expectedMean = getattr(expected, name)
+            assert mean.count == expectedMean.count
+            assert mean.value == pytest.approx(expectedMean.value)
+
+    def test_slide(self):
+        window = perf.FeedbackWindow()
+        window.addJourney(mockFinishedJourney(1, '2022-01-02 08:00:00'))
+        window.addJourney(mockFinishedJourney(2, '2022-01-03 08:00:00'))
+        window.slide(dtFromISO('2022-02-02').date())
+        assert list(window.buckets) == [dtFromISO('2022-01-03').date()]
+        assert window.journeyIDs == {2}
+
+
 # AccumulatedFeedback Tests
 # ------------------------------------------------------------------------
 class Test_AccumulatedFeedback:
@@ -633,6 +930,64 @@ class Test_AccumulatedFeedback:
                 })
                 updateApiIDMock.assert_called_once_with(3, 32)
 
+        def test_storesFinishedJourneys(self):
+            with freeze_time(dtFromISO('2022-03-04 12:00:00')):
+                accFeedback = perf.AccumulatedFeedback({'id': 3})
+                summaries = db.getJourneyPerformances([2, 3, 4, 5])
+                assert 3 not in summaries, """
+                    Current journey's performance summary was stored
+                """
+                for journey in accFeedback.journeys:
+                    if journey.journeyID != 3:
+                        assert (summaries[journey.journeyID] ==
+                            journey.toSummary())
+
+        def test_usesStoredSummaries(self):
+            with freeze_time(dtFromISO('2022-03-04 12:00:00')):
+                expected = perf.AccumulatedFeedback()
+                with mock.patch('db.getJourneysDrivingData') as dataMock:
+                    accFeedback = perf.AccumulatedFeedback()
+                    dataMock.assert_called_once_with([])
+                assert accFeedback.ecoDrivingScore == expected.ecoDrivingScore
+                assert (accFeedback.drivingDataCount ==
+                    expected.drivingDataCount)
+
+        def test_sqlEngine(self):
+            with freeze_time(dtFromISO('2022-03-04 12:00:00')):
+                expected = perf.AccumulatedFeedback()
+                db.cur.execute('DELETE FROM journey_performance')
+                db.conn.commit()
+                with mock.patch('performance.PERFORMANCE_ENGINE', 'sql'), \
+                        mock.patch('db.getJourneysDrivingData') as dataMock:
+                    accFeedback = perf.AccumulatedFeedback()
+                    dataMock.assert_not_called()
+                assert accFeedback.ecoDrivingScore == pytest.approx(
+                    expected.ecoDrivingScore)
+                assert (accFeedback.drivingDataCount ==
+                    expected.drivingDataCount)
+
+        def test_reusesWindow(self):
+            with freeze_time(dtFromISO('2022-03-04 12:00:00')):
+                window = perf.FeedbackWindow()
+                expected = perf.AccumulatedFeedback(window=window)
+                assert window.journeyIDs == {2, 3}
+                with mock.patch('db.getJourneyPerformances',
+                        wraps=db.getJourneyPerformances) as summariesMock:
+                    accFeedback = perf.AccumulatedFeedback(window=window)
+                    summariesMock.assert_called_once_with([])
+                assert accFeedback.ecoDrivingScore == expected.ecoDrivingScore
+                assert (accFeedback.drivingDataCount ==
+                    expected.drivingDataCount)
+
+        def test_windowSlides(self):
+            window = perf.FeedbackWindow()
+            with freeze_time(dtFromISO('2022-03-01 12:00:00')):
+                perf.AccumulatedFeedback(window=window)
+            with freeze_time(dtFromISO('2022-03-04 12:00:00')):
+                accFeedback = perf.AccumulatedFeedback(window=window)
+            assert window.journeyIDs == {2, 3}
+            assert len(accFeedback.journeys) == 2
+
     # addJourney
     # -----------------------------------
     class Test_addJourney:
@@ -995,3 +1350,98 @@ class Test_AccumulatedFeedback:
             accFeedback.drivingDataCount = 1
             accFeedback.updateAPI()
             addScoresMock.assert_not_called()
+
+
+# Feedback Snapshot Tests
+# ------------------------------------------------------------------------
+class Test_feedbackSnapshot:
+    def test_roundTrip(self, tmp_path):
+        filename = tmp_path / 'feedback.json'
+        with freeze_time(dtFromISO('2022-02-01 12:00:00')):
+            accFeedback = perf.AccumulatedFeedback()
+        perf.saveFeedbackSnapshot(accFeedback, filename)
+
+        with mock.patch('db.getJourneyIDsWithinLastNdays') as journeyIDsMock:
+            loaded = perf.AccumulatedFeedback(
+                snapshot=perf.loadFeedbackSnapshot(filename))
+            journeyIDsMock.assert_not_called()
+
+        assert loaded.toSnapshot() == accFeedback.toSnapshot()
+        assert loaded.calculatedAt == dtFromISO('2022-02-01 12:00:00')
+        assert loaded.ecoDrivingScore == accFeedback.ecoDrivingScore
+        assert loaded.jrnyDist.count == accFeedback.jrnyDist.count
+
+    def test_noSnapshot(self, tmp_path):
+        assert perf.loadFeedbackSnapshot(tmp_path / 'feedback.json') is None
+
+    def test_invalidSnapshot(self, tmp_path):
+        filename = tmp_path / 'feedback.json'
+        filename.write_text('{"calculatedAt": ')
+        assert perf.loadFeedbackSnapshot(filename) is None
+
+    @pytest.mark.parametrize('malform', [
+        lambda snapshot: [snapshot],
+        lambda snapshot: {**snapshot, 'calculatedAt': 'yesterday'},
+        lambda snapshot: {**snapshot, 'ecoDrivingScore': '50'},
+        lambda snapshot: {k: v for k, v in snapshot.items() if k != 'means'},
+        lambda snapshot: {**snapshot, 'means': {
+            **snapshot['means'], 'gsiAdh': {'value': 50}}},
+        lambda snapshot: {**snapshot, 'scores': {
+            **snapshot['scores'], 'gsiAdh': [50]}},
+    ])
+    def test_malformedSnapshot(self, tmp_path, malform):
+        filename = tmp_path / 'feedback.json'
+        with freeze_time(dtFromISO('2022-02-01 12:00:00')):
+            snapshot = perf.AccumulatedFeedback().toSnapshot()
+        filename.write_text(json.dumps(malform(snapshot)))
+        assert perf.loadFeedbackSnapshot(filename) is None
+
+
+# FeedbackWorker Tests
+# ------------------------------------------------------------------------
+def waitForCalculation(worker, calculations=1, timeout=1):
+    """Waits for the worker to finish a number of calculations"""
+    start = time.time()
+    while (
+        worker.calculations + worker.failures < calculations and
+        time.time() - start < timeout
+    ):
+        time.sleep(0.001)
+
+
+class Test_FeedbackWorker:
+    @mock.patch('performance.AccumulatedFeedback')
+    def test_publishes(self, accFeedbackMock):
+        published = []
+        worker = perf.FeedbackWorker({'id': 3}, published.append)
+        journeyPerf = perf.JourneyPerformance(3)
+        worker.request(journeyPerf)
+        waitForCalculation(worker)
+        worker.stop()
+        assert published == [accFeedbackMock.return_value]
+        journey, snapshot, window = accFeedbackMock.call_args[0]
+        assert journey == {'id': 3}
+        assert window is worker.window
+        assert snapshot is not journeyPerf, """
+            Current journey's performance wasn't copied before being used by
+            the worker
+        """
+        assertSamePerformance(snapshot, journeyPerf)
+
+    @mock.patch('performance.AccumulatedFeedback', side_effect=Exception)
+    def test_failure(self, accFeedbackMock):
+        published = []
+        worker = perf.FeedbackWorker({'id': 3}, published.append)
+        worker.request(perf.JourneyPerformance(3))
+        waitForCalculation(worker)
+        worker.stop()
+        assert worker.failures == 1
+        assert published == []
+
+    def test_supersededRequest(self):
+        worker = perf.FeedbackWorker({'id': 3}, lambda accFeedback: None)
+        worker.stop()
+        worker.thread.join()
+        worker.request(perf.JourneyPerformance(3))
+        worker.request(perf.JourneyPerformance(3))
+        assert worker.droppedRequests == 1
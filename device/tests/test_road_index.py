@@ -0,0 +1,115 @@
+import pytest
+import device  # noqa: F401
+import road_index as ri
+
+
+# Helpers
+# ------------------------------------------------------------------------
+def road(coordinates, maxspeed, geometryType='LineString'):
+    """Returns a GeoJSON road feature"""
+    return {
+        'type': 'Feature',
+        'properties': {'maxspeed': maxspeed},
+        'geometry': {'type': geometryType, 'coordinates': coordinates}
+    }
+
+
+ROADS = [
+    # East to west road along latitude 50.894
+    road([[-1.002, 50.894], [-0.999, 50.894], [-0.996, 50.894]], '30 mph'),
+    # North to south road crossing a cell boundary
+    road([[-0.9975, 50.8935], [-0.9975, 50.9060]], '50'),
+    road([[-0.99, 50.89], [-0.98, 50.89]], 'national'),
+]
+
+
+@pytest.fixture
+def roadIndex(tmp_path):
+    ri.buildRoadIndex(ROADS, tmp_path)
+    return ri.RoadIndex(tmp_path)
+
+
+# Tests
+# ------------------------------------------------------------------------
+# parseMaxspeed
+# -----------------------------------
+@pytest.mark.parametrize('maxspeed, expectedSpeedLimit', [
+    ('50', 50),
+    ('48 km/h', 48),
+    ('30 mph', 48.28032),
+    ('30mph', 48.28032),
+    (60, 60),
+    ('none', None),
+    ('GB:national', None),
+    ('50;30', None),
+    (None, None),
+])
+def test_parseMaxspeed(maxspeed, expectedSpeedLimit):
+    assert ri.parseMaxspeed(maxspeed) == pytest.approx(expectedSpeedLimit)
+
+
+# readRoadSegments
+# -----------------------------------
+class Test_readRoadSegments:
+    def test_baseCase(self):
+        segments, speedLimits = ri.readRoadSegments(ROADS)
+        assert segments.tolist() == [
+            [50.894, -1.002, 50.894, -0.999],
+            [50.894, -0.999, 50.894, -0.996],
+            [50.8935, -0.9975, 50.906, -0.9975],
+        ]
+        assert speedLimits.tolist() == pytest.approx([48.28032] * 2 + [50])
+
+    def test_multiLineString(self):
+        segments, _ = ri.readRoadSegments([road([
+            [[0, 0], [0, 1]], [[1, 0], [1, 1], [1, 2]]
+        ], '20', 'MultiLineString')])
+        assert len(segments) == 3
+
+    def test_noRoads(self):
+        segments, speedLimits = ri.readRoadSegments([])
+        assert segments.shape == (0, 4)
+        assert len(speedLimits) == 0
+
+
+# RoadIndex
+# -----------------------------------
+class Test_RoadIndex:
+    def test_memoryMapped(self, roadIndex):
+        assert roadIndex.segments.filename is not None
+
+    def test_segmentInEveryOverlappedCell(self, roadIndex):
+        # Segment 2 spans 3 rows of cells
+        for latitude in [50.8940, 50.8990, 50.9050]:
+            segmentIDs = roadIndex.nearbySegments(
+                {'latitude': latitude, 'longitude': -0.9975})
+            assert 2 in segmentIDs
+
+    @pytest.mark.parametrize('coords, expectedSpeedLimit', [
+        ({'latitude': 50.89401, 'longitude': -1.001}, 48.28032),
+        ({'latitude': 50.89900, 'longitude': -0.99751}, 50),
+        ({'latitude': 50.90000, 'longitude': -0.98}, None),
+    ])
+    def test_getSpeedLimit(self, roadIndex, coords, expectedSpeedLimit):
+        assert roadIndex.getSpeedLimit(coords) == pytest.approx(
+            expectedSpeedLimit)
+
+    def test_nearest(self, roadIndex):
+        segmentID, distance = roadIndex.nearest(
+            {'latitude': 50.8941, 'longitude': -1.001})
+        assert segmentID == 0
+        assert distance == pytest.approx(11.1, abs=0.1)
+
+    def test_nearestSegmentEnd(self, roadIndex):
+        _, distance = roadIndex.nearest(
+            {'latitude': 50.894, 'longitude': -1.0023})
+        assert distance == pytest.approx(21, abs=0.5)
+
+    def test_outsideIndex(self, roadIndex):
+        assert roadIndex.nearest({'latitude': 0, 'longitude': 0}) is None
+
+    def test_differentCellSize(self, tmp_path, monkeypatch):
+        ri.buildRoadIndex(ROADS, tmp_path)
+        monkeypatch.setattr(ri, 'CELL_SIZE', 0.01)
+        with pytest.raises(ValueError):
+            ri.RoadIndex(tmp_path)
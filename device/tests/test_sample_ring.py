@@ -0,0 +1,176 @@
+import pytest
+import multiprocessing
+import device  # noqa: F401
+import sample_ring as sr
+
+
+# Helpers
+# ------------------------------------------------------------------------
+@pytest.fixture
+def ring():
+    ring = sr.SampleRing.create(capacity=4)
+    yield ring
+    ring.close()
+    ring.unlink()
+
+
+def sample(time, **fields):
+    """Returns a sample acquired at the given time"""
+    return {
+        'time': time,
+        'rpm': 2000,
+        'speed': 50,
+        'throttle': 20,
+        'fuelLevel': 80,
+        'alt': 10,
+        'latitude': 50.894064,
+        'longitude': -0.999009,
+        'speedLimit': 48.28032,
+        'gsiIsIndicating': False,
+        'gsiDots': 3,
+        'throttleActive': True,
+        'engineOn': True,
+        'drivingData': False,
+        **fields
+    }
+
+
+def times(samples):
+    return [s['time'] for s in samples]
+
+
+def writeSamples(name, capacity, count):
+    """Writes samples whose float fields all equal their time to a ring,
+    run by a separate writer process"""
+    ring = sr.SampleRing.attach(name, capacity)
+    try:
+        for time in range(count):
+            ring.write({
+                **sample(time), **{field: time for field in sr.FLOAT_FIELDS}
+            })
+    finally:
+        ring.close()
+
+
+# Tests
+# ------------------------------------------------------------------------
+# Conversion
+# -----------------------------------
+@pytest.mark.parametrize('fields', [
+    {},
+    {'speedLimit': None, 'gsiIsIndicating': None, 'latitude': None},
+    {'gsiIsIndicating': True, 'engineOn': False, 'drivingData': True},
+])
+def test_sampleRoundTrip(fields):
+    record = sr.sampleToRecord(sample(1.5, **fields))
+    assert sr.recordToSample(
+        sr.np.array(record, dtype=sr.SAMPLE_DTYPE)) == sample(1.5, **fields)
+
+
+# SampleRing
+# -----------------------------------
+class Test_SampleRing:
+    def test_latest(self, ring):
+        assert ring.latest() is None
+        for time in range(6):
+            ring.write(sample(time))
+        assert ring.latest() == sample(5)
+
+    def test_attach(self, ring):
+        attached = sr.SampleRing.attach(ring.name, ring.capacity)
+        try:
+            ring.write(sample(1, gsiIsIndicating=True))
+            assert attached.latest() == sample(1, gsiIsIndicating=True)
+        finally:
+            attached.close()
+
+
+# SampleReader
+# -----------------------------------
+class Test_SampleReader:
+    def test_readsInOrder(self, ring):
+        reader = ring.reader()
+        ring.write(sample(0))
+        ring.write(sample(1))
+        assert times(reader.read()) == [0, 1]
+        assert reader.read() == []
+        ring.write(sample(2))
+        assert times(reader.read()) == [2]
+
+    def test_readsAcrossWrap(self, ring):
+        reader = ring.reader()
+        for time in range(3):
+            ring.write(sample(time))
+        reader.read()
+        for time in range(3, 6):
+            ring.write(sample(time))
+        assert times(reader.read()) == [3, 4, 5]
+        assert reader.overruns == 0
+
+    def test_readsSamplesWrittenBeforeCreated(self, ring):
+        ring.write(sample(0))
+        assert times(ring.reader().read()) == [0]
+
+    def test_overrun(self, ring):
+        reader = ring.reader()
+        for time in range(7):
+            ring.write(sample(time))
+        assert times(reader.read()) == [3, 4, 5, 6]
+        assert reader.stats() == {'position': 7, 'overruns': 3}
+
+    def test_skipsSlotBeingWritten(self, ring):
+        reader = ring.reader()
+        for time in range(4):
+            ring.write(sample(time))
+
+        # Writer has started overwriting the oldest slot
+        ring.sequences[0] = 2 * 4 + 1
+        assert times(reader.read()) == [1, 2, 3]
+        assert reader.overruns == 1
+
+    def test_overwrittenWhilstCopying(self, ring, monkeypatch):
+        reader = ring.reader()
+        for time in range(4):
+            ring.write(sample(time))
+
+        # Writer overwrites 2 samples whilst the reader copies them
+        samples = ring.samples
+
+        class OverwritingSamples:
+            def __getitem__(self, indexes):
+                records = samples[indexes]
+                monkeypatch.setattr(ring, 'samples', samples)
+                ring.write(sample(4))
+                ring.write(sample(5))
+                return records
+
+        monkeypatch.setattr(ring, 'samples', OverwritingSamples())
+        assert times(reader.read()) == [2, 3]
+        assert reader.overruns == 2
+
+    def test_concurrentWriter(self):
+        ring = sr.SampleRing.create(capacity=8)
+        count = 20000
+        writer = multiprocessing.get_context('spawn').Process(
+            target=writeSamples, args=(ring.name, ring.capacity, count))
+        try:
+            reader = ring.reader()
+            read = []
+            writer.start()
+            # Samples written before the writer exited are read once more
+            while True:
+                writing = writer.is_alive()
+                read.extend(reader.read())
+                if not writing:
+                    break
+            assert writer.exitcode == 0
+
+            for s in read:
+                assert all(s[field] == s['time'] for field in sr.FLOAT_FIELDS)
+            assert times(read) == sorted(set(times(read)))
+            assert len(read) + reader.overruns == count
+        finally:
+            if writer.is_alive():
+                writer.terminate()
+            ring.close()
+            ring.unlink()
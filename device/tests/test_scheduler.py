@@ -0,0 +1,111 @@
+import pytest
+from unittest import mock
+import device  # noqa: F401
+import scheduler as sched
+
+
+# Mock Time
+# ------------------------------------------------------------------------
+class MockTime:
+    """Mock clock that only advances when slept or when a job takes time"""
+
+    def __init__(self):
+        self.now = 0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, secs):
+        self.now += secs
+
+
+@pytest.fixture
+def mockTime():
+    mockTime = MockTime()
+    with mock.patch('scheduler.time', mockTime):
+        yield mockTime
+
+
+# Job Tests
+# ------------------------------------------------------------------------
+class Test_Job:
+    class Test_run:
+        def test_onTime(self, mockTime):
+            job = sched.Job('test', lambda: None, 1, 0)
+            job.run(0)
+            assert job.runs == 1
+            assert job.deadline == 1
+            assert job.jitter == 0
+            assert job.overruns == 0
+
+        def test_jitter(self, mockTime):
+            job = sched.Job('test', lambda: None, 1, 0)
+            mockTime.now = 0.25
+            job.run(0.25)
+            mockTime.now = 1.5
+            job.run(1.5)
+            assert job.jitter == 0.5
+            assert job.maxJitter == 0.5
+            assert job.meanJitter == 0.375
+            assert job.deadline == 2, "Jitter shouldn't shift the schedule"
+
+        def test_overrun(self, mockTime):
+            def slowJob():
+                mockTime.now += 2.5
+
+            job = sched.Job('test', slowJob, 1, 0)
+            job.run(0)
+            assert job.overruns == 1
+            assert job.missedRuns == 2
+            assert job.deadline == 3, "Missed runs should be skipped"
+
+        def test_startAndFinish(self, mockTime):
+            job = sched.Job('test', lambda: None, 1, 0)
+            job.start(0.25)
+            assert job.runs == 1
+            assert job.deadline == 0, "Deadline moved before finishing"
+            mockTime.now = 0.5
+            job.finish()
+            assert job.deadline == 1
+            assert job.jitter == 0.25
+
+    def test_meanJitterNoRuns(self):
+        assert sched.Job('test', lambda: None, 1, 0).meanJitter == 0
+
+
+# Scheduler Tests
+# ------------------------------------------------------------------------
+class Test_Scheduler:
+    def test_runsAtRates(self, mockTime):
+        scheduler = sched.Scheduler()
+        calls = []
+        scheduler.add('fast', lambda: calls.append(('fast', mockTime.now)), 1)
+        scheduler.add('slow', lambda: calls.append(('slow', mockTime.now)), 3)
+        scheduler.run(lambda: mockTime.now < 4)
+        assert calls == [
+            ('fast', 0), ('slow', 0), ('fast', 1), ('fast', 2),
+            ('fast', 3), ('slow', 3), ('fast', 4)
+        ]
+
+    def test_delay(self, mockTime):
+        scheduler = sched.Scheduler()
+        calls = []
+        scheduler.add('delayed', lambda: calls.append(mockTime.now), 2,
+            delay=5)
+        scheduler.run(lambda: len(calls) < 2)
+        assert calls == [5, 7]
+
+    def test_stop(self, mockTime):
+        scheduler = sched.Scheduler()
+        scheduler.add('stop', scheduler.stop, 1)
+        scheduler.run()
+        assert scheduler.running is False
+        assert scheduler.stats()['stop']['runs'] == 1
+
+    def test_sleepsUntilDue(self, mockTime):
+        scheduler = sched.Scheduler()
+        scheduler.add('test', lambda: None, 10, delay=4)
+        with mock.patch.object(mockTime, 'sleep',
+                wraps=mockTime.sleep) as sleepMock:
+            scheduler.runPending()
+            sleepMock.assert_called_once_with(4)
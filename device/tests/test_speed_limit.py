@@ -0,0 +1,487 @@
+import pytest
+import time
+from unittest import mock
+import device  # noqa: F401
+import speed_limit as spdLim
+import circuit_breaker as cb
+
+
+# Before Each
+# ------------------------------------------------------------------------
+@pytest.fixture(autouse=True)
+def mockConfig():
+    with mock.patch('speed_limit.CONFIG', {'mapboxAccessToken': 'token'}):
+        yield
+
+
+@pytest.fixture(autouse=True)
+def breaker():
+    with mock.patch('speed_limit.breaker', cb.CircuitBreaker()) as breaker:
+        yield breaker
+
+
+# Helpers
+# ------------------------------------------------------------------------
+def mockResponse(maxspeed, code='Ok', ok=True, tracepoints=None):
+    """Returns a mock Mapbox map matching response"""
+    response = mock.Mock()
+    response.ok = ok
+    response.json.return_value = {
+        'tracepoints': tracepoints,
+        'code': code,
+        'matchings': [
+            {
+                'confidence': 0.2,
+                'legs': [{'annotation': {'maxspeed': [{'unknown': True}]}}]
+            },
+            {
+                'confidence': 0.9,
+                'legs': [{'annotation': {'maxspeed': [maxspeed]}}]
+            }
+        ]
+    }
+    return response
+
+
+def waitForSpeedLimit(fetcher, timeout=1):
+    """Waits for the fetcher to publish a speed limit"""
+    start = time.time()
+    while fetcher.speedLimitTime is None and time.time() - start < timeout:
+        time.sleep(0.001)
+
+
+COORDS = {'latitude': 50.894064, 'longitude': -0.999009}
+PREV_COORDS = {'latitude': 50.894001, 'longitude': -0.999102}
+
+
+# Tests
+# ------------------------------------------------------------------------
+# getMostConfidentRoute
+# -----------------------------------
+class Test_getMostConfidentRoute:
+    def test_baseCase(self):
+        matchings = [
+            {'confidence': 0.1}, {'confidence': 0.7}, {'confidence': 0.3}
+        ]
+        assert spdLim.getMostConfidentRoute(matchings) == {'confidence': 0.7}
+
+    def test_noMatchings(self):
+        assert spdLim.getMostConfidentRoute([]) is None
+
+
+# getSpeedLimit
+# -----------------------------------
+class Test_getSpeedLimit:
+    @pytest.mark.parametrize('maxspeed, expectedSpeedLimit', [
+        ({'speed': 48, 'unit': 'km/h'}, 48),
+        ({'speed': 70, 'unit': 'mph'}, 112.65408),
+        ({'unknown': True}, None),
+    ])
+    def test_baseCase(self, maxspeed, expectedSpeedLimit):
+        with mock.patch('requests.get', return_value=mockResponse(maxspeed)):
+            speedLimit = spdLim.getSpeedLimit(COORDS, PREV_COORDS)
+            assert speedLimit == pytest.approx(expectedSpeedLimit)
+
+    def test_noMatch(self):
+        response = mockResponse({'speed': 48, 'unit': 'km/h'}, 'NoMatch')
+        with mock.patch('requests.get', return_value=response):
+            assert spdLim.getSpeedLimit(COORDS, PREV_COORDS) is None
+
+    def test_connectionError(self):
+        with mock.patch('requests.get', side_effect=ConnectionError):
+            assert spdLim.getSpeedLimit(COORDS, PREV_COORDS) is None
+
+    def test_failsFastWhilstOpen(self, breaker):
+        with mock.patch('requests.get', side_effect=ConnectionError) as get:
+            for _ in range(breaker.failureThreshold + 1):
+                assert spdLim.getSpeedLimit(COORDS, PREV_COORDS) is None
+        assert get.call_count == breaker.failureThreshold
+        assert breaker.rejectedRequests == 1
+
+    def test_noMatchClosesBreaker(self, breaker):
+        response = mockResponse({'speed': 48, 'unit': 'km/h'}, 'NoMatch')
+        breaker.recordFailure()
+        with mock.patch('requests.get', return_value=response):
+            spdLim.getSpeedLimit(COORDS, PREV_COORDS)
+        assert breaker.failures == 0
+
+
+# matchSpeedLimit
+# -----------------------------------
+class Test_matchSpeedLimit:
+    def test_matchedCoords(self):
+        response = mockResponse({'speed': 48, 'unit': 'km/h'}, tracepoints=[
+            {'location': [-0.99901, 50.89407]}, None
+        ])
+        with mock.patch('requests.get', return_value=response):
+            assert spdLim.matchSpeedLimit(COORDS, PREV_COORDS) == (
+                48, {'latitude': 50.89407, 'longitude': -0.99901})
+
+    def test_unknownSpeedLimit(self):
+        response = mockResponse({'unknown': True})
+        with mock.patch('requests.get', return_value=response):
+            assert spdLim.matchSpeedLimit(COORDS, PREV_COORDS) == (
+                None, COORDS)
+
+    def test_noMatch(self):
+        response = mockResponse({'speed': 48, 'unit': 'km/h'}, 'NoMatch')
+        with mock.patch('requests.get', return_value=response):
+            assert spdLim.matchSpeedLimit(COORDS, PREV_COORDS) is None
+
+
+# matchTrace
+# -----------------------------------
+class Test_matchTrace:
+    def test_baseCase(self):
+        trace = [{'latitude': i, 'longitude': i} for i in range(4)]
+        response = mock.Mock()
+        response.ok = True
+        response.json.return_value = {
+            'code': 'Ok',
+            'matchings': [{'confidence': 0.9, 'legs': [
+                {'annotation': {'maxspeed': [
+                    {'speed': 48, 'unit': 'km/h'}, {'unknown': True}]}},
+                {'annotation': {'maxspeed': [
+                    {'speed': 30, 'unit': 'mph'}, {'speed': 64,
+                        'unit': 'km/h'}]}},
+            ]}],
+            'tracepoints': [
+                {'matchings_index': 0, 'waypoint_index': 0,
+                    'location': [0.1, 0.2]},
+                None,
+                {'matchings_index': 0, 'waypoint_index': 1,
+                    'location': [2.1, 2.2]},
+                {'matchings_index': 0, 'waypoint_index': 2,
+                    'location': [3.1, 3.2]},
+            ]
+        }
+        with mock.patch('requests.get', return_value=response) as get:
+            speedLimits = spdLim.matchTrace(trace)
+        assert get.call_args[0][0].endswith('/0,0;1,1;2,2;3,3')
+        assert speedLimits == [
+            (trace[0], {'latitude': 0.2, 'longitude': 0.1}, 48),
+            (trace[2], {'latitude': 2.2, 'longitude': 2.1},
+                pytest.approx(48.28032)),
+            (trace[3], {'latitude': 3.2, 'longitude': 3.1}, 64),
+        ]
+
+    def test_noMatch(self):
+        response = mockResponse({'speed': 48, 'unit': 'km/h'}, 'NoMatch')
+        with mock.patch('requests.get', return_value=response):
+            assert spdLim.matchTrace([COORDS, PREV_COORDS]) == []
+
+
+# SpeedLimitCache
+# -----------------------------------
+class Test_SpeedLimitCache:
+    def test_miss(self):
+        cache = spdLim.SpeedLimitCache()
+        assert cache.get(COORDS) == (False, None)
+        assert cache.misses == 1
+
+    def test_hit(self):
+        cache = spdLim.SpeedLimitCache()
+        cache.put(COORDS, 48)
+        assert cache.get({'latitude': 50.89407, 'longitude': -0.99902}) == (
+            True, 48), "Coordinates within the same cell not cached"
+        assert cache.stats() == {
+            'hits': 1, 'misses': 0, 'hitRate': 1, 'evictions': 0,
+            'entries': 1
+        }
+
+    def test_unknownSpeedLimit(self):
+        cache = spdLim.SpeedLimitCache()
+        cache.put(COORDS, None)
+        assert cache.get(COORDS) == (True, None)
+
+    def test_expired(self):
+        cache = spdLim.SpeedLimitCache(ttl=60)
+        cache.put(COORDS, 48, cachedAt=time.time() - 60)
+        assert cache.get(COORDS) == (False, None)
+        assert cache.entries == {}
+
+    def test_evictsLeastRecentlyUsed(self):
+        cache = spdLim.SpeedLimitCache(size=2)
+        cache.put({'latitude': 1, 'longitude': 1}, 32)
+        cache.put({'latitude': 2, 'longitude': 2}, 48)
+        cache.get({'latitude': 1, 'longitude': 1})
+        cache.put({'latitude': 3, 'longitude': 3}, 64)
+        assert cache.get({'latitude': 2, 'longitude': 2}) == (False, None)
+        assert cache.get({'latitude': 1, 'longitude': 1}) == (True, 32)
+        assert cache.evictions == 1
+
+    def test_saveAndLoad(self, tmp_path):
+        filename = tmp_path / 'speed_limits.json'
+        cache = spdLim.SpeedLimitCache()
+        cache.put(COORDS, 48)
+        cache.put({'latitude': 1, 'longitude': 1}, 32,
+            cachedAt=time.time() - cache.ttl)
+        cache.save(filename)
+
+        loadedCache = spdLim.SpeedLimitCache()
+        loadedCache.load(filename)
+        assert loadedCache.get(COORDS) == (True, 48)
+        assert len(loadedCache.entries) == 1, "Expired speed limit loaded"
+
+    def test_loadDifferentPrecision(self, tmp_path):
+        filename = tmp_path / 'speed_limits.json'
+        cache = spdLim.SpeedLimitCache(precision=6)
+        cache.put(COORDS, 48)
+        cache.save(filename)
+
+        loadedCache = spdLim.SpeedLimitCache(precision=8)
+        loadedCache.load(filename)
+        assert loadedCache.entries == {}
+
+    def test_loadMissingFile(self, tmp_path):
+        cache = spdLim.SpeedLimitCache()
+        cache.load(tmp_path / 'speed_limits.json')
+        assert cache.entries == {}
+
+
+# SpeedLimitFetcher
+# -----------------------------------
+class Test_SpeedLimitFetcher:
+    @mock.patch('speed_limit.matchSpeedLimit', return_value=(48, COORDS))
+    def test_request(self, matchSpeedLimitMock):
+        fetcher = spdLim.SpeedLimitFetcher()
+        fetcher.request(COORDS, PREV_COORDS)
+        waitForSpeedLimit(fetcher)
+        fetcher.stop()
+        matchSpeedLimitMock.assert_called_once_with(COORDS, PREV_COORDS)
+        assert fetcher.speedLimit == 48
+
+    @mock.patch('speed_limit.matchSpeedLimit', return_value=(48, COORDS))
+    def test_cachesFetchedSpeedLimit(self, matchSpeedLimitMock):
+        cache = spdLim.SpeedLimitCache()
+        fetcher = spdLim.SpeedLimitFetcher(cache)
+        fetcher.request(COORDS, PREV_COORDS)
+        waitForSpeedLimit(fetcher)
+        fetcher.stop()
+        assert cache.entries[cache.key(COORDS)][0] == 48
+
+    @mock.patch('speed_limit.matchSpeedLimit')
+    def test_cachedRequest(self, matchSpeedLimitMock):
+        cache = spdLim.SpeedLimitCache()
+        cache.put(COORDS, 64)
+        fetcher = spdLim.SpeedLimitFetcher(cache)
+        fetcher.request(COORDS, PREV_COORDS)
+        fetcher.stop()
+        assert fetcher.speedLimit == 64
+        assert fetcher.pending is None
+        matchSpeedLimitMock.assert_not_called()
+
+    @mock.patch('speed_limit.getSpeedLimit', return_value=48)
+    def test_supersededRequest(self, getSpeedLimitMock):
+        fetcher = spdLim.SpeedLimitFetcher()
+        fetcher.stop()
+        fetcher.thread.join()
+        fetcher.request(COORDS, PREV_COORDS)
+        fetcher.request(PREV_COORDS, COORDS)
+        assert fetcher.droppedRequests == 1
+        assert fetcher.pending[1:] == (PREV_COORDS, COORDS)
+
+    def test_publish(self):
+        fetcher = spdLim.SpeedLimitFetcher()
+        fetcher.stop()
+        with mock.patch('time.time', return_value=100):
+            fetcher.publish(99, 48)
+        assert fetcher.speedLimit == 48
+        assert fetcher.speedLimitTime == 99
+
+    def test_publishOutdated(self):
+        fetcher = spdLim.SpeedLimitFetcher()
+        fetcher.stop()
+        with mock.patch('time.time', return_value=100):
+            fetcher.publish(99, 48)
+            fetcher.publish(98, 64)
+        assert fetcher.speedLimit == 48, """
+            Result of an older request replaced a newer speed limit
+        """
+        assert fetcher.droppedRequests == 1
+
+    def test_publishStale(self):
+        fetcher = spdLim.SpeedLimitFetcher()
+        fetcher.stop()
+        with mock.patch('time.time',
+                return_value=100 + spdLim.STALE_REQUEST_AGE):
+            fetcher.publish(100, 48)
+        assert fetcher.speedLimit is None
+        assert fetcher.droppedRequests == 1
+
+
+# TraceSpeedLimitFetcher
+# -----------------------------------
+def traceCoords(i):
+    """Returns coordinates roughly 100m apart along a trace"""
+    return {'latitude': 50 + i * 0.001, 'longitude': -1}
+
+
+class Test_TraceSpeedLimitFetcher:
+    @pytest.fixture
+    def fetcher(self):
+        fetcher = spdLim.TraceSpeedLimitFetcher(matchPoints=3)
+        fetcher.stop()
+        fetcher.thread.join()
+        return fetcher
+
+    def test_matchesFirstTraceStraightAway(self, fetcher):
+        fetcher.request(traceCoords(0), None)
+        assert fetcher.pending is None
+        fetcher.request(traceCoords(1), traceCoords(0))
+        assert fetcher.pending[1] == [traceCoords(0), traceCoords(1)]
+
+    def test_matchesAfterNewPoints(self, fetcher):
+        fetcher.matches = 1
+        for i in range(3):
+            fetcher.pending = None
+            fetcher.request(traceCoords(i), None)
+        assert fetcher.pending[1] == [traceCoords(i) for i in range(3)]
+        assert fetcher.newPoints == 0
+
+    def test_traceWindowSize(self, fetcher):
+        for i in range(spdLim.TRACE_WINDOW_SIZE + 5):
+            fetcher.request(traceCoords(i), None)
+        assert len(fetcher.pending[1]) == spdLim.TRACE_WINDOW_SIZE
+        assert fetcher.pending[1][0] == traceCoords(5)
+
+    def test_fetch(self, fetcher):
+        trace = [traceCoords(i) for i in range(3)]
+        with mock.patch('speed_limit.matchTrace', return_value=[
+            (trace[0], trace[0], 48), (trace[2], trace[2], 64)
+        ]):
+            assert fetcher.fetch(trace) == 64
+        assert fetcher.cache.get(trace[0]) == (True, 48)
+        assert fetcher.cache.get(trace[1]) == (False, None)
+        assert fetcher.matches == 1
+
+    def test_publishesCachedSpeedLimit(self, fetcher):
+        fetcher.cache.put(traceCoords(0), 48)
+        fetcher.request(traceCoords(0), None)
+        assert fetcher.speedLimit == 48
+
+    def test_tracksCoordsOnceMoved(self, fetcher):
+        fetcher.track(traceCoords(0))
+        fetcher.track({'latitude': 50.00001, 'longitude': -1})
+        fetcher.request(traceCoords(0), None)
+        assert list(fetcher.trace) == [traceCoords(0)]
+        fetcher.track(traceCoords(1))
+        assert list(fetcher.trace) == [traceCoords(0), traceCoords(1)]
+
+    def test_publishesMatchedSpeedLimitOfPosition(self, fetcher):
+        trace = [traceCoords(i) for i in range(3)]
+        with mock.patch('speed_limit.matchTrace', return_value=[
+            (trace[0], trace[0], 48), (trace[1], trace[1], 64),
+            (trace[2], trace[2], 96)
+        ]):
+            fetcher.fetch(trace)
+
+        fetcher.cache = spdLim.SpeedLimitCache()
+        fetcher.track(traceCoords(1))
+        assert fetcher.speedLimit == 64
+        assert fetcher.matchedIndex == 1
+        # Matched coordinates behind the vehicle are no longer served
+        fetcher.track(traceCoords(0))
+        assert fetcher.speedLimit == 64
+        fetcher.track(traceCoords(2))
+        assert fetcher.speedLimit == 96
+
+    def test_keepsSpeedLimitAwayFromMatch(self, fetcher):
+        with mock.patch('speed_limit.matchTrace', return_value=[
+            (traceCoords(0), traceCoords(0), 48)
+        ]):
+            fetcher.fetch([traceCoords(0)])
+        fetcher.track(traceCoords(0))
+        fetcher.track(traceCoords(5))
+        assert fetcher.speedLimit == 48
+
+    @mock.patch('speed_limit.matchTrace')
+    def test_request(self, matchTraceMock):
+        matchTraceMock.side_effect = lambda trace: [
+            (coords, coords, 48) for coords in trace]
+        fetcher = spdLim.TraceSpeedLimitFetcher()
+        fetcher.request(traceCoords(0), None)
+        fetcher.request(traceCoords(1), traceCoords(0))
+        waitForSpeedLimit(fetcher)
+        fetcher.stop()
+        assert fetcher.speedLimit == 48
+        assert fetcher.stats() == {
+            'fetches': 1, 'droppedRequests': 0, 'matches': 1}
+
+
+# OfflineSpeedLimitFetcher
+# -----------------------------------
+class Test_OfflineSpeedLimitFetcher:
+    def test_request(self):
+        roadIndex = mock.Mock()
+        roadIndex.getSpeedLimit.side_effect = [48, None]
+        fetcher = spdLim.OfflineSpeedLimitFetcher(roadIndex)
+        fetcher.request(COORDS, PREV_COORDS)
+        assert fetcher.speedLimit == 48
+        roadIndex.getSpeedLimit.assert_called_once_with(COORDS)
+        fetcher.request(COORDS, PREV_COORDS)
+        assert fetcher.speedLimit is None
+        assert fetcher.stats() == {'lookups': 2, 'misses': 1}
+
+
+# SpeedLimitThrottle
+# -----------------------------------
+def offsetCoords(northMetres, eastMetres):
+    """Returns coordinates offset from COORDS by a number of metres"""
+    return {
+        'latitude': COORDS['latitude'] + northMetres / 111195,
+        'longitude': COORDS['longitude'] + eastMetres / 70150
+    }
+
+
+class Test_SpeedLimitThrottle:
+    @pytest.fixture
+    def throttle(self):
+        return spdLim.SpeedLimitThrottle(distance=50, heading=30)
+
+    def test_firstLookup(self, throttle):
+        assert throttle.shouldLookup(COORDS) is True
+
+    def test_stationary(self, throttle):
+        throttle.shouldLookup(COORDS)
+        for _ in range(5):
+            assert throttle.shouldLookup(offsetCoords(1, -1)) is False
+        assert throttle.stats() == {'lookups': 1, 'avoidedLookups': 5}
+
+    def test_movedDistance(self, throttle):
+        throttle.shouldLookup(COORDS)
+        assert throttle.shouldLookup(offsetCoords(30, 0)) is False
+        assert throttle.shouldLookup(offsetCoords(55, 0)) is True
+        assert throttle.shouldLookup(offsetCoords(80, 0)) is False
+
+    def test_turned(self, throttle):
+        throttle.shouldLookup(COORDS)
+        assert throttle.shouldLookup(offsetCoords(20, 0)) is False
+        assert throttle.shouldLookup(offsetCoords(25, 10)) is True, """
+            Turning right at a junction did not cause a lookup
+        """
+
+    def test_gpsNoiseIgnored(self, throttle):
+        throttle.shouldLookup(COORDS)
+        throttle.shouldLookup(offsetCoords(20, 0))
+        assert throttle.shouldLookup(offsetCoords(20, 2)) is False
+
+    def test_noThrottling(self):
+        throttle = spdLim.SpeedLimitThrottle(distance=0)
+        assert throttle.shouldLookup(COORDS) is True
+        assert throttle.shouldLookup(COORDS) is True
+
+
+# createSpeedLimitFetcher
+# -----------------------------------
+@pytest.mark.parametrize('provider, expectedType', [
+    ('mapbox', spdLim.SpeedLimitFetcher),
+    ('trace', spdLim.TraceSpeedLimitFetcher),
+    ('offline', spdLim.OfflineSpeedLimitFetcher),
+])
+def test_createSpeedLimitFetcher(provider, expectedType):
+    with mock.patch('speed_limit.SPEED_LIMIT_PROVIDER', provider), \
+            mock.patch('speed_limit.RoadIndex'):
+        fetcher = spdLim.createSpeedLimitFetcher()
+    fetcher.stop()
+    assert type(fetcher) is expectedType
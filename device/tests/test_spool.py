@@ -0,0 +1,190 @@
+import pytest
+from unittest import mock
+import device  # noqa: F401
+import db
+import spool
+import circuit_breaker as cb
+
+
+# Before Each and After Each
+# ------------------------------------------------------------------------
+@pytest.fixture(autouse=True)
+def dbBeforeEachAndAfterEach():
+    with mock.patch('spool.CONFIG', {'apiURL': 'http://api.test'}):
+        yield
+    db.cur.execute('DELETE FROM api_spool')
+    db.cur.execute('DELETE FROM driving_data')
+    db.cur.execute('DELETE FROM journey_performance')
+    db.cur.execute('DELETE FROM journey')
+    db.cur.execute('ALTER SEQUENCE journey_journey_id_seq RESTART')
+    db.conn.commit()
+
+
+@pytest.fixture(autouse=True)
+def breaker():
+    with mock.patch('api.breaker', cb.CircuitBreaker()) as breaker:
+        yield breaker
+
+
+@pytest.fixture()
+def journeyID():
+    return db.createJourney()['id']
+
+
+@pytest.fixture()
+def flusher():
+    flusher = spool.SpoolFlusher()
+    flusher.stop()
+    flusher.thread.join()
+    return flusher
+
+
+# Tests
+# ------------------------------------------------------------------------
+# sendJourney
+# -----------------------------------
+class Test_sendJourney:
+    @mock.patch('api.createJourney', return_value=12)
+    def test_create(self, createJourneyMock, journeyID):
+        spool.sendJourney(journeyID, {'distance': 2})
+        createJourneyMock.assert_called_once_with({'distance': 2})
+        assert db.getJourneyApiID(journeyID) == 12
+        assert db.getSpooledCount() == 0
+
+    @mock.patch('api.createJourney', return_value=None)
+    def test_spoolsWhenUnsent(self, createJourneyMock, journeyID):
+        spool.sendJourney(journeyID, {'distance': 2})
+        spool.sendJourney(journeyID, {'distance': 3})
+        assert [upload['payload'] for upload in db.getSpooled(10)] == [
+            {'distance': 3}]
+        assert db.getJourneyApiID(journeyID) is None
+
+    @mock.patch('api.updateJourney', return_value=True)
+    def test_removesOlderSpooledUpdate(self, updateJourneyMock, journeyID):
+        db.updateJourneyApiID(journeyID, 12)
+        db.spoolJourney(journeyID, {'distance': 2})
+        spool.sendJourney(journeyID, {'distance': 3})
+        updateJourneyMock.assert_called_once_with(12, {'distance': 3})
+        assert db.getSpooledCount() == 0
+
+    @mock.patch('api.updateJourney', return_value=False)
+    def test_rejectedNotSpooled(self, updateJourneyMock, journeyID):
+        db.updateJourneyApiID(journeyID, 12)
+        spool.sendJourney(journeyID, {'distance': 2})
+        assert db.getSpooledCount() == 0
+
+    def test_createsJourneyOnce(self, journeyID):
+        def createJourney(data):
+            assert spool.journeyLock.locked(), """
+                Journey created without holding the journey lock
+            """
+            return 12
+
+        with mock.patch('api.createJourney', side_effect=createJourney):
+            spool.sendJourney(journeyID, {'distance': 2})
+        with mock.patch('api.updateJourney', return_value=True) as updMock:
+            spool.sendJourney(journeyID, {'distance': 3})
+        updMock.assert_called_once_with(12, {'distance': 3})
+
+    @mock.patch('api.createJourney', return_value=None)
+    def test_noApiURL(self, createJourneyMock, journeyID):
+        with mock.patch('spool.CONFIG', {'apiURL': ''}):
+            spool.sendJourney(journeyID, {'distance': 2})
+        assert db.getSpooledCount() == 0
+
+
+# sendScores
+# -----------------------------------
+class Test_sendScores:
+    @mock.patch('api.addScores', return_value=True)
+    def test_sent(self, addScoresMock):
+        spool.sendScores({'ecoDriving': 80})
+        assert db.getSpooledCount() == 0
+
+    @mock.patch('api.addScores', return_value=None)
+    def test_spoolsWhenUnsent(self, addScoresMock):
+        spool.sendScores({'ecoDriving': 80})
+        assert db.getSpooled(10)[0]['payload'] == {'ecoDriving': 80}
+
+    @mock.patch('api.addScores', return_value=False)
+    def test_rejectedNotSpooled(self, addScoresMock):
+        spool.sendScores({'ecoDriving': 80})
+        assert db.getSpooledCount() == 0
+
+    @mock.patch('api.addScores', return_value=None)
+    def test_keepsMaxScores(self, addScoresMock):
+        with mock.patch('spool.SPOOL_MAX_SCORES', 2):
+            for score in [70, 75, 80]:
+                spool.sendScores({'ecoDriving': score})
+        assert [upload['payload'] for upload in db.getSpooled(10)] == [
+            {'ecoDriving': 75}, {'ecoDriving': 80}]
+
+
+# SpoolFlusher
+# -----------------------------------
+class Test_SpoolFlusher:
+    @mock.patch('api.addScores', return_value=True)
+    @mock.patch('api.createJourney', return_value=12)
+    def test_flush(self, createJourneyMock, addScoresMock, flusher,
+            journeyID):
+        db.spoolScores({'ecoDriving': 70})
+        db.spoolJourney(journeyID, {'distance': 2})
+        db.spoolScores({'ecoDriving': 75})
+        assert flusher.flush() is True
+        assert addScoresMock.call_args_list == [
+            mock.call({'ecoDriving': 70}), mock.call({'ecoDriving': 75})]
+        createJourneyMock.assert_called_once_with({'distance': 2})
+        assert db.getJourneyApiID(journeyID) == 12
+        assert flusher.stats() == {
+            'replayed': 3, 'rejected': 0, 'abandoned': 0, 'failedFlushes': 0,
+            'pending': 0}
+
+    @mock.patch('api.addScores', side_effect=[True, None])
+    def test_stopsAtFirstFailure(self, addScoresMock, flusher):
+        for score in [70, 75, 80]:
+            db.spoolScores({'ecoDriving': score})
+        assert flusher.flush() is False
+        assert addScoresMock.call_count == 2
+        assert [upload['payload'] for upload in db.getSpooled(10)] == [
+            {'ecoDriving': 75}, {'ecoDriving': 80}]
+        assert flusher.stats() == {
+            'replayed': 1, 'rejected': 0, 'abandoned': 0, 'failedFlushes': 1,
+            'pending': 2}
+        assert db.getSpooled(1)[0]['attempts'] == 1
+
+    @mock.patch('api.addScores', side_effect=[False, True])
+    def test_dropsRejected(self, addScoresMock, flusher):
+        for score in [70, 75]:
+            db.spoolScores({'ecoDriving': score})
+        assert flusher.flush() is True
+        assert db.getSpooledCount() == 0
+        assert flusher.replayed == 1
+        assert flusher.rejected == 1
+
+    @mock.patch('api.addScores', return_value=None)
+    def test_abandonsAfterMaxAttempts(self, addScoresMock, flusher):
+        flusher.maxAttempts = 3
+        db.spoolScores({'ecoDriving': 70})
+        for _ in range(2):
+            assert flusher.flush() is False
+        assert flusher.flush() is True
+        assert addScoresMock.call_count == 3
+        assert flusher.abandoned == 1
+        assert db.getSpooledCount() == 0
+
+    @mock.patch('api.addScores', return_value=None)
+    def test_unreachableNotCounted(self, addScoresMock, flusher, breaker):
+        breaker.state = cb.OPEN
+        db.spoolScores({'ecoDriving': 70})
+        assert flusher.flush() is False
+        assert db.getSpooled(1)[0]['attempts'] == 0
+
+    @mock.patch('api.addScores', return_value=True)
+    def test_batches(self, addScoresMock, flusher):
+        for score in range(5):
+            db.spoolScores({'ecoDriving': score})
+        with mock.patch('spool.SPOOL_BATCH_SIZE', 2):
+            with mock.patch('db.getSpooled', wraps=db.getSpooled) as getMock:
+                assert flusher.flush() is True
+        assert getMock.call_count == 3
+        assert addScoresMock.call_count == 5
@@ -13,3 +13,53 @@ import utils
 ])
 def test_kmhToMps(kmh, expectedMps):
     assert utils.kmhToMps(kmh) == expectedMps
+
+
+# geohash
+# -----------------------------------
+@pytest.mark.parametrize('latitude, longitude, precision, expectedGeohash', [
+    (57.64911, 10.40744, 11, 'u4pruydqqvj'),
+    (50.894064, -0.999009, 8, 'gcp392bx'),
+    (-25.382708, -49.265506, 7, '6gkzwgj'),
+    (0, 0, 1, 's'),
+])
+def test_geohash(latitude, longitude, precision, expectedGeohash):
+    assert utils.geohash(latitude, longitude, precision) == expectedGeohash
+
+
+# haversine
+# -----------------------------------
+@pytest.mark.parametrize('coords1, coords2, expectedDistance', [
+    ((50.894064, -0.999009), (50.894064, -0.999009), 0),
+    ((50.894064, -0.999009), (50.895064, -0.999009), 111.19),
+    ((51.5007, -0.1246), (40.6892, -74.0445), 5574840),
+])
+def test_haversine(coords1, coords2, expectedDistance):
+    assert utils.haversine(*coords1, *coords2) == pytest.approx(
+        expectedDistance, rel=1e-3)
+
+
+# bearing
+# -----------------------------------
+@pytest.mark.parametrize('coords1, coords2, expectedBearing', [
+    ((50, -1), (51, -1), 0),
+    ((50, -1), (50, -0.99), 90),
+    ((50, -1), (49, -1), 180),
+    ((50, -1), (50, -1.01), 270),
+])
+def test_bearing(coords1, coords2, expectedBearing):
+    assert utils.bearing(*coords1, *coords2) == pytest.approx(
+        expectedBearing, abs=0.01)
+
+
+# angleDifference
+# -----------------------------------
+@pytest.mark.parametrize('angle1, angle2, expectedDifference', [
+    (10, 40, 30),
+    (350, 10, 20),
+    (10, 350, 20),
+    (0, 180, 180),
+    (90, 90, 0),
+])
+def test_angleDifference(angle1, angle2, expectedDifference):
+    assert utils.angleDifference(angle1, angle2) == expectedDifference